@@ -8,7 +8,7 @@ Source0:	%{name}-%{version}.tar.gz
 Source1:	node_modules.tar.gz
 
 BuildRequires:  python3-setuptools
-Requires:  aops-vulcanus >= v2.1.0 python3-Authlib aops-zeus >= v2.1.0 python3-Flask-SQLAlchemy uwsgi
+Requires:  aops-vulcanus >= v2.1.0 python3-Authlib aops-zeus >= v2.1.0 python3-Flask-SQLAlchemy uwsgi python3-requests python3-cryptography
 Provides:  authhub
 
 %description
@@ -52,6 +52,8 @@ popd
 %files
 %attr(0644,root,root) %{_sysconfdir}/aops/conf.d/authhub.yml
 %attr(0755,root,root) %{_unitdir}/authhub.service
+%attr(0755,root,root) %{_unitdir}/authhub-webhook.service
+%attr(0755,root,root) %{_bindir}/authhub-cli
 %attr(0755, root, root) /opt/aops/database/*
 %{python3_sitelib}/authhub*.egg-info
 %{python3_sitelib}/oauth2_provider/*
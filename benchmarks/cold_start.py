@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+"""
+Import time of the authhub modules and cold start time of the application, every case runs in a fresh
+interpreter. Run on a host with authhub installed and configured:
+
+    python3 benchmarks/cold_start.py --runs 5 --top 15
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+CASES = [
+    ("import oauth2_provider.app", "import oauth2_provider.app"),
+    ("import core.token", "import oauth2_provider.app.core.token"),
+    ("import cli", "import oauth2_provider.cli"),
+    ("create_app()", "from oauth2_provider.app import create_app; create_app()"),
+    ("import manage", "import oauth2_provider.manage"),
+]
+TIMED = "import time; started = time.perf_counter(); {statement}; print(time.perf_counter() - started)"
+
+
+def measure(statement):
+    """
+    :return: (seconds spent in the statement, seconds of the whole interpreter run)
+    """
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", TIMED.format(statement=statement)], capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1]), time.perf_counter() - started
+
+
+def slowest_imports(statement, top):
+    """
+    The modules with the largest cumulative import time, read from python -X importtime
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, check=True
+    ).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        modules.append((int(cumulative), module.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per case")
+    parser.add_argument("--top", type=int, default=0, help="show the slowest imports of create_app()")
+    args = parser.parse_args()
+
+    print(f"{'case':<28}{'median ms':>11}{'min ms':>10}{'process ms':>12}")
+    for name, statement in CASES:
+        runs = [measure(statement) for _ in range(args.runs)]
+        elapsed = [inner * 1000 for inner, _ in runs]
+        process = statistics.median(outer * 1000 for _, outer in runs)
+        print(f"{name:<28}{statistics.median(elapsed):>11.1f}{min(elapsed):>10.1f}{process:>12.1f}")
+
+    if args.top:
+        print("\nslowest imports of create_app()")
+        for cumulative, module in slowest_imports(CASES[3][1], args.top):
+            print(f"{cumulative / 1000:>10.1f} ms  {module}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+"""
+Micro-benchmarks of the hot paths of authhub. They run offline: the application uses a temporary SQLite
+database and a fakeredis client, only authhub and its python dependencies plus fakeredis with its Lua
+scripting support are needed. The MySQL statements are rendered for SQLite by benchmarks/sqlite_compat.py:
+
+    pip install "fakeredis[lua]"
+
+Save a baseline, then compare a later run against it, the comparison exits with 1 when the median of a
+case is slower than the baseline by more than the tolerance:
+
+    python3 benchmarks/core_primitives.py --save baseline.json
+    python3 benchmarks/core_primitives.py --compare baseline.json --tolerance 0.2
+    python3 benchmarks/core_primitives.py -k token --rounds 10
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+from types import SimpleNamespace
+
+PASSWORD = "changeme"
+APPLICATIONS = 50
+
+
+def measure(func, rounds, min_time):
+    """
+    Calibrate the loops of a round to last at least min_time seconds, then time rounds rounds
+
+    :return: dict of the seconds per call
+    """
+    timer = timeit.Timer(func)
+    loops, elapsed = timer.autorange()
+    if elapsed < min_time:
+        loops = max(loops, int(loops * min_time / elapsed) if elapsed else loops)
+    per_call = [total / loops for total in timer.repeat(repeat=rounds, number=loops)]
+    return dict(
+        median=statistics.median(per_call),
+        min=min(per_call),
+        mean=statistics.mean(per_call),
+        stdev=statistics.stdev(per_call) if len(per_call) > 1 else 0,
+        rounds=rounds,
+        loops=loops,
+    )
+
+
+def create_bench_app(database):
+    import fakeredis
+    import sqlite_compat  # noqa: F401
+
+    from oauth2_provider.app import cache, create_app
+
+    client = fakeredis.FakeRedis(decode_responses=True)
+    try:
+        # the generations, the introspection cache and the admission control run redis scripts
+        client.eval("return 1", 0)
+    except Exception as error:
+        raise SystemExit(f'fakeredis can not run Lua scripts, install "fakeredis[lua]": {error}')
+    cache.bind(client)
+    return create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{database}", "SQLALCHEMY_ENGINE_OPTIONS": dict()})
+
+
+def seed():
+    """
+    One administrator owning APPLICATIONS clients, one user and one token of the first client
+    """
+    from oauth2_provider.app import db
+    from oauth2_provider.app.core.applications import ApplicationProxy
+    from oauth2_provider.app.core.token import jwt_token
+    from oauth2_provider.database.table import ManageUser, OAuth2Client, OAuth2Token, User
+
+    db.create_all()
+    db.session.add(ManageUser(username="bench-admin", password=ManageUser.hash_password(PASSWORD)))
+    user = User(username="bench-user", password=User.hash_password(PASSWORD), email="bench@example.com")
+    db.session.add(user)
+    db.session.commit()
+    for index in range(APPLICATIONS):
+        ApplicationProxy().create_application(
+            dict(
+                username="bench-admin",
+                client_name=f"bench-app-{index}",
+                client_uri="http://127.0.0.1/bench",
+                skip_authorization=index == 0,
+                register_callback_uris=["http://127.0.0.1/bench/register"],
+                logout_callback_uris=["http://127.0.0.1/bench/logout"],
+                redirect_uris=["http://127.0.0.1/bench/callback"],
+                grant_types=["authorization_code", "refresh_token"],
+                response_types=["code"],
+                token_endpoint_auth_method="client_secret_post",
+            )
+        )
+    skip_client, consent_client = db.session.query(OAuth2Client).order_by(OAuth2Client.id).limit(2).all()
+    issued = jwt_token.generate("authorization_code", skip_client, user, scope="openid username email")
+    token = OAuth2Token(
+        client_id=skip_client.client_id,
+        username=user.username,
+        user_id=user.id,
+        token_type="Bearer",
+        access_token=issued["access_token"],
+        refresh_token=issued["refresh_token"],
+        scope=issued["scope"],
+        issued_at=int(time.time()),
+        expires_in=3600,
+        _metadata=issued["_metadata"],
+    )
+    db.session.add(token)
+    db.session.commit()
+    return SimpleNamespace(
+        user=user, skip_client=skip_client, consent_client=consent_client, token=token, issued=issued
+    )
+
+
+def cases(app, data):
+    """
+    :return: list of (name, func), every func runs inside the application context
+    """
+    from oauth2_provider.app.core.applications import ApplicationProxy
+    from oauth2_provider.app.core.token import jwt_token
+    from oauth2_provider.app.serialize.oauth2 import OauthTokenIntrospectSchema
+    from oauth2_provider.app.views import validate_request
+
+    client, token, user = data.skip_client, data.token, data.user
+    server = app.extensions["authorization"]
+    access_token = data.issued["access_token"]
+    skip_request = SimpleNamespace(client=client, user=user.username, client_id=client.client_id)
+    consent_request = SimpleNamespace(
+        client=data.consent_client, user=user.username, client_id=data.consent_client.client_id
+    )
+
+    @validate_request(schema=OauthTokenIntrospectSchema)
+    def introspect(request_body):
+        return request_body
+
+    introspect_context = app.test_request_context(
+        "/oauth2/introspect", method="POST", json=dict(token=access_token, client_id=client.client_id)
+    )
+
+    def validated_introspect():
+        with introspect_context:
+            return introspect()
+
+    def token_metadata_cold():
+        token.__dict__.pop("token_metadata", None)
+        return token.token_metadata
+
+    return [
+        ("token.generate", lambda: jwt_token.generate("authorization_code", client, user, scope="openid username")),
+        ("token.decode", lambda: jwt_token.decode(access_token, client.client_secret, client.client_id)),
+        ("token.timedelta", lambda: jwt_token.timedelta(3600)),
+        ("user.check_password", lambda: user.check_password(PASSWORD)),
+        ("views.validate_request", validated_introspect),
+        (
+            "server.validate_requested_scope[skip]",
+            lambda: server.validate_requested_scope("openid", request=skip_request),
+        ),
+        (
+            "server.validate_requested_scope[consent]",
+            lambda: server.validate_requested_scope("openid", request=consent_request),
+        ),
+        ("table.token_metadata[cold]", token_metadata_cold),
+        ("table.token_metadata[cached]", lambda: token.token_metadata),
+        ("table.is_revoked", token.is_revoked),
+        ("applications.get_all_applications", lambda: ApplicationProxy().get_all_applications("bench-admin")),
+    ]
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: names of the cases slower than the baseline by more than tolerance
+    """
+    regressions = []
+    print(f"{'case':<42}{'baseline us':>13}{'current us':>13}{'change':>9}")
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<42}{'-':>13}{result['median'] * 1e6:>13.2f}{'new':>9}")
+            continue
+        change = result["median"] / before["median"] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<42}{before['median'] * 1e6:>13.2f}{result['median'] * 1e6:>13.2f}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="keyword", help="only run the cases whose name contains keyword")
+    parser.add_argument("--rounds", type=int, default=7, help="timed rounds per case")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds of one round")
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--compare", help="compare the results with this json file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown of a median, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_bench_app(os.path.join(directory, "authhub.db"))
+        with app.app_context():
+            data = seed()
+            results = dict()
+            for name, func in cases(app, data):
+                if args.keyword and args.keyword not in name:
+                    continue
+                func()
+                results[name] = measure(func, args.rounds, args.min_time)
+                result = results[name]
+                print(f"{name:<42}{result['median'] * 1e6:>12.2f} us  (min {result['min'] * 1e6:.2f} us)")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(
+                dict(
+                    created_at=int(time.time()),
+                    python=platform.python_version(),
+                    platform=platform.platform(),
+                    results=results,
+                ),
+                file,
+                indent=2,
+            )
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        print()
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} cases regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+"""
+Login throughput of the password hashers and the latency of a cheap request served by the same worker during
+the login burst, run on a host with authhub installed and configured:
+
+    python3 benchmarks/login_throughput.py --logins 64 --concurrency 16
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+PASSWORD = "changeme"
+
+
+def probe(stop, latencies):
+    """
+    A cheap request every 10ms, its latency shows how much the login burst stalls the worker
+    """
+    while not stop.is_set():
+        started = time.perf_counter()
+        json.dumps([dict(id=index, name="client") for index in range(200)])
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.01)
+
+
+def burst(verify, logins, concurrency):
+    stop, latencies = threading.Event(), []
+    prober = threading.Thread(target=probe, args=(stop, latencies))
+    prober.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        assert all(executor.map(lambda _: verify(), range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    prober.join()
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+    return logins / elapsed, statistics.median(latencies) * 1000 if latencies else 0, p99 * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=64, help="logins of the burst")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent login requests")
+    parser.add_argument("--max-workers", type=int, default=4, help="threads of the hashing pool")
+    args = parser.parse_args()
+
+    from oauth2_provider.app.core.password import PasswordHasher, argon2
+
+    legacy_hash = generate_password_hash(PASSWORD, method="pbkdf2:sha256:260000")
+    cases = [("legacy pbkdf2 inline", lambda: check_password_hash(legacy_hash, PASSWORD))]
+    algorithms = ["pbkdf2", "scrypt"] + (["argon2id"] if argon2 else [])
+    for algorithm in algorithms:
+        hasher = PasswordHasher(algorithm=algorithm, max_workers=args.max_workers, max_pending=args.logins)
+        stored = hasher.hash(PASSWORD)
+        cases.append((f"{algorithm} pool", lambda hasher=hasher, stored=stored: hasher.verify(stored, PASSWORD)))
+
+    print(f"{'case':<22}{'logins/s':>10}{'probe p50 ms':>14}{'probe p99 ms':>14}")
+    for name, verify in cases:
+        rate, p50, p99 = burst(verify, args.logins, args.concurrency)
+        print(f"{name:<22}{rate:>10.1f}{p50:>14.2f}{p99:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
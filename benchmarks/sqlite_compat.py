@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+"""
+SQLite renderings of the MySQL constructs authhub uses, so the offline benchmarks run the production
+statements on a temporary SQLite database. Import it before the application executes a statement:
+
+- ``INSERT ... ON DUPLICATE KEY UPDATE`` becomes ``INSERT ... ON CONFLICT DO UPDATE``, the inserted values
+  are read from ``excluded``. The conflict target is omitted, which needs SQLite 3.35 or later.
+- ``greatest(a, b)`` becomes the scalar ``max(a, b)``.
+"""
+from sqlalchemy import literal_column
+from sqlalchemy.dialects.mysql.dml import OnDuplicateClause
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.functions import GenericFunction
+
+
+class greatest(GenericFunction):
+    inherit_cache = True
+
+
+@compiles(greatest, "sqlite")
+def compile_greatest(element, compiler, **kw):
+    return f"max({compiler.process(element.clauses, **kw)})"
+
+
+@compiles(OnDuplicateClause, "sqlite")
+def compile_on_duplicate_key_update(clause, compiler, **kw):
+    inserted = clause.inserted_alias
+
+    def excluded(element):
+        if getattr(element, "table", None) is inserted:
+            return literal_column(f"excluded.{element.name}")
+        return None
+
+    assignments = []
+    for name in clause._parameter_ordering or clause.update:
+        value = visitors.replacement_traverse(clause.update[name], {}, excluded)
+        assignments.append(f"{compiler.preparer.quote(name)} = {compiler.process(value.self_group(), **kw)}")
+    return "ON CONFLICT DO UPDATE SET " + ", ".join(assignments)
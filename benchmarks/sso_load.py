@@ -0,0 +1,417 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+"""
+Load harness of the complete SSO flow of a user:
+
+    login -> authorize -> token -> introspect (repeated) -> refresh-token -> login-status -> logout
+
+login-status asks for a token of a second application, the SSO check of a user already logged in. The
+callbacks of both applications go to a local stub server, logout calls back both of them. Reports the
+throughput and the p50/p95/p99 latency of every endpoint and of the whole flow, plus the database queries
+of a flow when the application runs in process.
+
+In process, on a temporary SQLite database and fakeredis, admission control disabled. The MySQL statements
+of authhub are rendered for SQLite by benchmarks/sqlite_compat.py:
+
+    python3 benchmarks/sso_load.py --flows 200 --concurrency 8
+
+Against a running authhub, the users and applications are registered with the administrator account:
+
+    python3 benchmarks/sso_load.py --url http://127.0.0.1:11120 --manager admin:changeme --flows 500
+
+--think-time spaces the steps like a real user.
+"""
+import argparse
+import base64
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PASSWORD = "Load@2024pass"
+SCOPE = "openid username email"
+ENDPOINTS = ["login", "authorize", "token", "introspect", "refresh-token", "login-status", "logout"]
+
+
+class FlowError(Exception):
+    pass
+
+
+class CallbackStub:
+    """
+    Local server answering the login, logout and register callbacks like a healthy application
+    """
+
+    def __init__(self, label):
+        stub = self
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                with stub._lock:
+                    stub.calls[self.path] += 1
+                body = json.dumps(dict(label=label, code=200, message="")).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, name="callback-stub", daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+
+
+class QueryCounter:
+    """
+    Statements executed by the current thread, the flows of the in process application run in their thread
+    """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self._local = threading.local()
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    def take(self):
+        count = getattr(self._local, "count", 0)
+        self._local.count = 0
+        return count
+
+
+class InProcessSession:
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, path, json=None, params=None, headers=None):
+        response = self._client.open(path, method=method, json=json, query_string=params, headers=headers)
+        return response.status_code, response.headers, response.get_json(silent=True)
+
+
+class HttpSession:
+    def __init__(self, url):
+        import requests
+
+        self._url = url.rstrip("/")
+        self._session = requests.Session()
+
+    def request(self, method, path, json=None, params=None, headers=None):
+        response = self._session.request(
+            method, self._url + path, json=json, params=params, headers=headers, allow_redirects=False, timeout=30
+        )
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return response.status_code, response.headers, body
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.flows = []
+        self.flow_errors = Counter()
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def request(self, endpoint, elapsed, error=None):
+        with self._lock:
+            self.latencies[endpoint].append(elapsed)
+            if error:
+                self.errors[endpoint][error] += 1
+
+    def flow(self, elapsed, queries, error=None):
+        with self._lock:
+            if error:
+                self.flow_errors[error] += 1
+                return
+            self.flows.append(elapsed)
+            if queries is not None:
+                self.queries.append(queries)
+
+
+def basic_auth(username, password):
+    return "Basic " + base64.b64encode(f"{username}:{password}".encode()).decode()
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(math.ceil(percent / 100 * len(values)) - 1, 0))]
+
+
+class Flow:
+    def __init__(self, session, recorder, succeed, think_time):
+        self.session = session
+        self.recorder = recorder
+        self.succeed = succeed
+        self.think_time = think_time
+
+    def call(self, endpoint, method, path, redirect=False, **kwargs):
+        started = time.perf_counter()
+        status, headers, body = self.session.request(method, path, **kwargs)
+        elapsed = time.perf_counter() - started
+        if redirect:
+            error = None if status in (301, 302, 303) else f"status {status}"
+        else:
+            label = (body or dict()).get("label")
+            error = None if status == 200 and label == self.succeed else (label or f"status {status}")
+        self.recorder.request(endpoint, elapsed, error)
+        if error:
+            raise FlowError(f"{endpoint}: {error}")
+        if self.think_time:
+            time.sleep(self.think_time)
+        return headers, body
+
+    def run(self, username, client, sso_client, redirect_uri, introspections):
+        self.call("login", "POST", "/oauth2/login", json=dict(username=username, password=PASSWORD))
+        headers, _ = self.call(
+            "authorize",
+            "GET",
+            "/oauth2/authorize",
+            redirect=True,
+            params=dict(
+                response_type="code",
+                client_id=client["client_id"],
+                redirect_uri=redirect_uri,
+                scope=SCOPE,
+                state=uuid.uuid4().hex,
+                nonce=uuid.uuid4().hex,
+            ),
+        )
+        code = parse_qs(urlparse(headers.get("Location", "")).query).get("code")
+        if not code:
+            self.recorder.errors["authorize"]["no code in redirect"] += 1
+            raise FlowError("authorize: no code in redirect")
+        _, body = self.call(
+            "token",
+            "POST",
+            "/oauth2/token",
+            json=dict(
+                grant_type="authorization_code",
+                code=code[0],
+                redirect_uri=redirect_uri,
+                client_id=client["client_id"],
+            ),
+            headers=dict(Authorization=basic_auth(client["client_id"], client["client_secret"])),
+        )
+        tokens = body["data"]
+        for _ in range(introspections):
+            self.call(
+                "introspect",
+                "POST",
+                "/oauth2/introspect",
+                json=dict(token=tokens["access_token"], client_id=client["client_id"]),
+            )
+        self.call(
+            "refresh-token",
+            "POST",
+            "/oauth2/refresh-token",
+            json=dict(refresh_token=tokens["refresh_token"], client_id=client["client_id"]),
+        )
+        self.call("login-status", "POST", "/oauth2/login-status", json=dict(client_id=sso_client["client_id"]))
+        self.call("logout", "GET", "/oauth2/logout", redirect=True, params=dict(redirect_uri=redirect_uri))
+
+
+def provision(session, succeed, manager, users, stub_url, run_id):
+    """
+    Register two applications with the administrator and the users of the run
+
+    :return: (applications, usernames)
+    """
+    status, _, body = session.request(
+        "POST", "/oauth2/manager-login", json=dict(username=manager[0], password=manager[1])
+    )
+    if status != 200 or (body or dict()).get("label") != succeed:
+        raise SystemExit(f"administrator login failed: {body}")
+    authorization = dict(Authorization=body["data"]["user_token"])
+    applications = []
+    for name in ("a", "b"):
+        _, _, body = session.request(
+            "POST",
+            "/oauth2/applications/register",
+            headers=authorization,
+            json=dict(
+                client_name=f"load-{name}-{run_id}",
+                client_uri=stub_url,
+                redirect_uris=[f"{stub_url}/callback"],
+                skip_authorization=True,
+                register_callback_uris=[f"{stub_url}/register"],
+                logout_callback_uris=[f"{stub_url}/logout"],
+                scope=SCOPE.split(),
+                grant_types=["authorization_code"],
+                response_types=["code"],
+                token_endpoint_auth_method="client_secret_basic",
+            ),
+        )
+        if (body or dict()).get("label") != succeed:
+            raise SystemExit(f"application registration failed: {body}")
+        applications.append(body["data"]["client_info"])
+    usernames = [f"load{run_id}{index:04d}" for index in range(users)]
+    for username in usernames:
+        _, _, body = session.request(
+            "POST", "/oauth2/register", json=dict(username=username, password=PASSWORD, email=f"{username}@example.com")
+        )
+        if (body or dict()).get("label") != succeed:
+            raise SystemExit(f"user registration failed: {body}")
+    return applications, usernames
+
+
+def in_process_app(database, manager, concurrency):
+    import fakeredis
+    import sqlite_compat  # noqa: F401
+
+    from oauth2_provider.app import cache, create_app, db
+    from oauth2_provider.app.core.admission import admission_controller
+    from oauth2_provider.database.table import ManageUser
+
+    cache.bind(fakeredis.FakeRedis(decode_responses=True))
+    admission_controller.enabled = False
+    app = create_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{database}",
+            "SQLALCHEMY_ENGINE_OPTIONS": dict(
+                pool_size=concurrency, max_overflow=concurrency, connect_args=dict(timeout=30)
+            ),
+        }
+    )
+    with app.app_context():
+        db.create_all()
+        db.session.add(ManageUser(username=manager[0], password=ManageUser.hash_password(manager[1])))
+        db.session.commit()
+        counter = QueryCounter(db.engine)
+    return app, counter
+
+
+def report(recorder, elapsed, stub, output=None):
+    rows = dict()
+    print(f"{'endpoint':<15}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for endpoint in ENDPOINTS + ["flow"]:
+        values = recorder.flows if endpoint == "flow" else recorder.latencies.get(endpoint, [])
+        errors = recorder.flow_errors if endpoint == "flow" else recorder.errors.get(endpoint, Counter())
+        rows[endpoint] = dict(
+            requests=len(values),
+            errors=dict(errors),
+            throughput=len(values) / elapsed if elapsed else 0,
+            p50=percentile(values, 50) * 1000,
+            p95=percentile(values, 95) * 1000,
+            p99=percentile(values, 99) * 1000,
+        )
+        row = rows[endpoint]
+        print(
+            f"{endpoint:<15}{row['requests']:>9}{sum(errors.values()):>8}{row['throughput']:>9.1f}"
+            f"{row['p50']:>9.1f}{row['p95']:>9.1f}{row['p99']:>9.1f}"
+        )
+    for endpoint, errors in sorted(recorder.errors.items()):
+        for error, count in errors.most_common():
+            print(f"  {endpoint}: {count} x {error}")
+    summary = dict(elapsed=elapsed, endpoints=rows, callbacks=dict(stub.calls))
+    if recorder.queries:
+        summary["queries_per_flow"] = dict(
+            mean=sum(recorder.queries) / len(recorder.queries),
+            p50=percentile(recorder.queries, 50),
+            max=max(recorder.queries),
+        )
+        queries = summary["queries_per_flow"]
+        print(f"database queries per flow: mean {queries['mean']:.1f}, p50 {queries['p50']}, max {queries['max']}")
+    print(f"callbacks received: {sum(stub.calls.values())} {dict(stub.calls)}")
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base url of a running authhub, the application runs in process otherwise")
+    parser.add_argument("--manager", default="loadadmin:" + PASSWORD, help="administrator username:password")
+    parser.add_argument("--flows", type=int, default=200, help="complete flows to run")
+    parser.add_argument("--concurrency", type=int, default=8, help="flows running at the same time")
+    parser.add_argument("--users", type=int, default=0, help="users of the run, default 4 per concurrent flow")
+    parser.add_argument("--introspections", type=int, default=5, help="introspections per flow")
+    parser.add_argument("--think-time", type=float, default=0, help="seconds between two steps of a flow")
+    parser.add_argument("--json", dest="output", help="write the report to this json file")
+    args = parser.parse_args()
+
+    from vulcanus.restful.resp.state import SUCCEED
+
+    manager = tuple(args.manager.split(":", 1))
+    # a new login replaces the session of the user, every concurrent flow needs its own users
+    users = max(args.users or args.concurrency * 4, args.concurrency)
+    run_id = uuid.uuid4().hex[:6]
+    stub = CallbackStub(SUCCEED)
+    directory = tempfile.TemporaryDirectory()
+    counter = None
+    if args.url:
+        new_session = lambda: HttpSession(args.url)
+    else:
+        app, counter = in_process_app(os.path.join(directory.name, "authhub.db"), manager, args.concurrency)
+        new_session = lambda: InProcessSession(app)
+
+    applications, usernames = provision(new_session(), SUCCEED, manager, users, stub.url, run_id)
+    client, sso_client = applications
+    redirect_uri = f"{stub.url}/callback"
+    recorder = Recorder()
+    remaining = iter(range(args.flows))
+    remaining_lock = threading.Lock()
+
+    def worker(slot):
+        # every slot logs in its own users, a user never runs two flows at once
+        own, runs = usernames[slot:: args.concurrency], 0
+        while True:
+            with remaining_lock:
+                index = next(remaining, None)
+            if index is None:
+                return
+            username, runs = own[runs % len(own)], runs + 1
+            flow = Flow(new_session(), recorder, SUCCEED, args.think_time)
+            if counter:
+                counter.take()
+            started = time.perf_counter()
+            try:
+                flow.run(username, client, sso_client, redirect_uri, args.introspections)
+                recorder.flow(time.perf_counter() - started, counter.take() if counter else None)
+            except FlowError as error:
+                recorder.flow(time.perf_counter() - started, None, str(error).split(":", 1)[0])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(worker, slot) for slot in range(args.concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+    report(recorder, elapsed, stub, args.output)
+    stub.close()
+    directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
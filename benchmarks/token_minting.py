@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+"""
+Tokens per second of JwtTokenGenerator against the pyjwt based minting it replaced, run on a host with
+authhub installed and configured:
+
+    python3 benchmarks/token_minting.py --number 20000
+"""
+import argparse
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import jwt
+
+
+def legacy_exp(seconds):
+    import pytz
+
+    date_span = datetime.now(tz=pytz.timezone('Asia/Shanghai')) + timedelta(seconds=seconds)
+    time_span = time.strptime(date_span.strftime("%Y-%m-%d %H:%M:%S"), "%Y-%m-%d %H:%M:%S")
+    return int(time.mktime(time_span))
+
+
+def legacy_generate_token(secret, expires_in, user, client, **kwargs):
+    token_body = dict(iat=int(time.time()), exp=legacy_exp(expires_in), sub=user, aud=client)
+    for jwt_key in set(kwargs.keys()).intersection(set(["iss", "scope", "jti"])):
+        token_body[jwt_key] = kwargs[jwt_key]
+    return jwt.encode(token_body, secret, algorithm="HS256")
+
+
+def rate(func, number):
+    started = time.perf_counter()
+    for _ in range(number):
+        func()
+    return number / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000, help="tokens minted per measurement")
+    args = parser.parse_args()
+
+    from oauth2_provider.app.core.token import jwt_token
+
+    secret, client, user = uuid.uuid4().hex * 2, "benchmark-client", "benchmark-user"
+
+    def legacy():
+        legacy_generate_token(secret, 3600, user, client, scope="openid", jti=uuid.uuid4().hex)
+
+    def current():
+        jwt_token.generate_token(secret, 3600, user, client, scope="openid", jti=uuid.uuid4().hex)
+
+    token = jwt_token.generate_token(secret, 3600, user, client, scope="openid", jti="check")
+    claims = jwt.decode(token, secret, algorithms=["HS256"], audience=client)
+    assert token == jwt.encode(claims, secret, algorithm="HS256"), "tokens differ from pyjwt"
+
+    current()
+    legacy_rate, current_rate = rate(legacy, args.number), rate(current, args.number)
+    print(f"legacy  {legacy_rate:>10.0f} tokens/s")
+    print(f"current {current_rate:>10.0f} tokens/s  x{current_rate / legacy_rate:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,22 +10,68 @@
 # PURPOSE.
 # See the Mulan PSL v2 for more details.
 # ******************************************************************************/
-from authlib.integrations.flask_oauth2 import AuthorizationServer, ResourceProtector
-from authlib.integrations.sqla_oauth2 import (
-    create_query_client_func,
-    create_revocation_endpoint,
-    create_save_token_func,
-)
-from authlib.oauth2.rfc6749 import grants
-from authlib.oauth2.rfc7636 import CodeChallenge
+import os
+import threading
+
 from flask import Flask
-from flask.blueprints import Blueprint
-from flask_restful import Api
 from flask_sqlalchemy import SQLAlchemy
-from vulcanus.database.proxy import RedisProxy
 from werkzeug.utils import import_string
 
-from oauth2_provider.app.settings import configuration
+from oauth2_provider.app.settings import config_option, configuration
+
+
+class LazyRedis:
+    """
+    The redis client of the process, connected on first use so that importing the application has no side
+    effect. Attributes are looked up on the client, the modules keep using ``cache.get`` and so on.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def bind(self, client):
+        """
+        Use the client instead of the vulcanus redis connection, e.g. a fakeredis client of the benchmarks
+        """
+        for hook in self._hooks:
+            hook(client)
+        self._client = client
+
+    def instrument(self, hook):
+        """
+        Call hook with the client once it is connected, e.g. to time its commands
+        """
+        with self._lock:
+            self._hooks.append(hook)
+            if self._client is not None:
+                hook(self._client)
+
+    def _connect(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    client = connect_redis()
+                    for hook in self._hooks:
+                        hook(client)
+                    self._client = client
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._connect(), name)
+
+
+def connect_redis():
+    from vulcanus.database.proxy import RedisProxy
+
+    if not RedisProxy.redis_connect:
+        RedisProxy()
+    return RedisProxy.redis_connect
+
+
+cache = LazyRedis()
+db = SQLAlchemy()
 
 
 def database_connect():
@@ -37,7 +83,28 @@ def database_connect():
     return f'mysql+pymysql://@{host}:{port}/{database}'
 
 
-def config_oauth(application, database, authorization: AuthorizationServer, require_oauth: ResourceProtector):
+def engine_options():
+    """
+    Connection pool of every worker process, size it to the threads of the worker
+    """
+    from oauth2_provider.app.core.pool import TimedQueuePool
+
+    return dict(
+        poolclass=TimedQueuePool,
+        pool_size=int(config_option("mysql", "pool_size", 10)),
+        max_overflow=int(config_option("mysql", "max_overflow", 10)),
+        pool_recycle=int(config_option("mysql", "pool_recycle", 7200)),
+        pool_timeout=int(config_option("mysql", "pool_timeout", 30)),
+        pool_pre_ping=bool(config_option("mysql", "pool_pre_ping", True)),
+    )
+
+
+def config_oauth(application, database, authorization, require_oauth):
+    from authlib.integrations.sqla_oauth2 import create_save_token_func
+    from authlib.oauth2.rfc6749 import grants
+    from authlib.oauth2.rfc7636 import CodeChallenge
+
+    from oauth2_provider.app.core.clients import query_client
     from oauth2_provider.app.core.grant import (
         AuthorizationCodeGrant,
         HybridGrant,
@@ -46,10 +113,14 @@ def config_oauth(application, database, authorization: AuthorizationServer, requ
         PasswordGrant,
         RefreshTokenGrant,
     )
+    from oauth2_provider.app.core.maintenance import reaper
+    from oauth2_provider.app.core.metrics import metrics
+    from oauth2_provider.app.core.pool import pool_monitor, register_postfork
+    from oauth2_provider.app.core.profiling import query_profiler
+    from oauth2_provider.app.core.revocation import RevocationEndpoint
     from oauth2_provider.app.core.validator import JWTBearerTokenValidator
-    from oauth2_provider.database.table import OAuth2Client, OAuth2Token
+    from oauth2_provider.database.table import OAuth2Token
 
-    query_client = create_query_client_func(database.session, OAuth2Client)
     save_token = create_save_token_func(database.session, OAuth2Token)
     authorization.init_app(application, query_client=query_client, save_token=save_token)
 
@@ -65,21 +136,43 @@ def config_oauth(application, database, authorization: AuthorizationServer, requ
     authorization.register_grant(HybridGrant)
 
     # support revocation
-    revocation_cls = create_revocation_endpoint(database.session, OAuth2Token)
-    authorization.register_endpoint(revocation_cls)
+    authorization.register_endpoint(RevocationEndpoint)
     # register token validator
     require_oauth.register_token_validator(JWTBearerTokenValidator())
+    # purge the expired rows in the background of every worker, one node at a time
+    application.before_request(reaper.ensure_started)
+    # every forked worker opens its own database connections
+    with application.app_context():
+        pool_monitor.attach(database.engine)
+        if application.config.get("METRICS_ENABLED", True):
+            metrics.init_app(application, database.engine)
+        query_profiler.init_app(application, database.engine)
+    register_postfork()
+
+
+def create_app(config: dict = None):
+    """
+    Create the authhub application. The database engine is created here but connects on first use, redis
+    connects on first use.
 
+    Args:
+        config: flask configuration overriding the one read from authhub.yml, e.g. SQLALCHEMY_DATABASE_URI
 
-def init_app(name):
-    """
-    init flask app
+    Returns:
+        Flask: the application, its authorization server and resource protector are in app.extensions
     """
+    from authlib.integrations.flask_oauth2 import ResourceProtector
 
-    app = Flask(__import__(name).__name__)
-    app.config.from_mapping(
+    os.environ['AUTHLIB_INSECURE_TRANSPORT'] = "SKIP-HTTPS"
+    config = dict(config or dict())
+    if "SQLALCHEMY_DATABASE_URI" not in config:
+        config["SQLALCHEMY_DATABASE_URI"] = database_connect()
+    if "SQLALCHEMY_ENGINE_OPTIONS" not in config:
+        config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+
+    application = Flask("oauth2_provider")
+    application.config.from_mapping(
         {
-            'SQLALCHEMY_DATABASE_URI': database_connect(),
             'SQLALCHEMY_TRACK_MODIFICATIONS': False,
             "REFRESH_TOKEN_EXPIRES_IN": 60 * 60 * 24 * 30,  # 30 days
             "TOKEN_EXPIRES_IN": 60 * 60 * 24 * 7,  # 7 days
@@ -88,11 +181,25 @@ def init_app(name):
             "OAUTH2_REFRESH_TOKEN_GENERATOR": "oauth2_provider.app.core.token.jwt_token",
         }
     )
-    db = SQLAlchemy(app)
-    return app, db
+    application.config.from_mapping(config)
+    db.init_app(application)
+    register_url(application)
+
+    try:
+        authorization_server = import_string("oauth2_provider.app.core.server.AuthorizationServer")
+    except ImportError:
+        raise NotImplementedError("Authorization server not implemented")
+    authorization, require_oauth = authorization_server(), ResourceProtector()
+    config_oauth(application=application, database=db, authorization=authorization, require_oauth=require_oauth)
+    application.extensions["authorization"] = authorization
+    application.extensions["require_oauth"] = require_oauth
+    return application
 
 
 def register_url(app):
+    from flask.blueprints import Blueprint
+    from flask_restful import Api
+
     def register_blue_point(urls):
         api = Api()
         for view, url in urls:
@@ -111,13 +218,4 @@ def register_url(app):
         app.register_blueprint(Blueprint('manager', __name__))
 
 
-def connect_redis():
-    if not RedisProxy.redis_connect:
-        RedisProxy()
-    return RedisProxy.redis_connect
-
-
-cache = connect_redis()
-
-
-__all__ = ["config_oauth", "init_app", "register_url", "cache"]
+__all__ = ["config_oauth", "create_app", "register_url", "cache", "db"]
@@ -16,9 +16,15 @@ from typing import Tuple
 import sqlalchemy
 from flask import g
 from oauth2_provider.app.constant import secret
+from oauth2_provider.app.core.callbacks import callback_dispatcher
+from oauth2_provider.app.core.clients import client_registry
+from oauth2_provider.app.core.generations import generation_registry
+from oauth2_provider.app.core.login_records import login_recorder
+from oauth2_provider.app.core.password import PasswordHasherBusy, password_hasher
 from oauth2_provider.app.core.token import jwt_token
-from oauth2_provider.database.table import LoginRecords, ManageUser, OAuth2Client, OAuth2ClientScopes, OAuth2Token, User
-from oauth2_provider.manage import db
+from oauth2_provider.app.core.webhooks import enqueue_register_webhooks
+from oauth2_provider.database.table import LoginRecords, ManageUser, OAuth2ClientScopes, User
+from oauth2_provider.app import db
 from vulcanus.conf import constant
 from vulcanus.log.log import LOGGER
 from vulcanus.restful.resp.state import (
@@ -33,10 +39,9 @@ from vulcanus.restful.resp.state import (
     PASSWORD_ERROR,
     PERMESSION_ERROR,
     REPEAT_DATA,
+    SERVER_ERROR,
     SUCCEED,
 )
-from vulcanus.restful.response import BaseResponse
-from werkzeug.security import generate_password_hash
 
 
 class UserProxy:
@@ -68,9 +73,8 @@ class UserProxy:
                 LOGGER.error(f"add user failed, username exists: {username}")
                 return DATA_EXIST
             user_info = self._add_user(username, password, email)
-            callback_res = self._register_callback(user_info)
-            if callback_res != SUCCEED:
-                return callback_res
+            # the webhooks are committed with the user and delivered by the webhook worker
+            enqueue_register_webhooks(user_info)
             db.session.commit()
             LOGGER.debug("add user succeed.")
         except sqlalchemy.exc.SQLAlchemyError as error:
@@ -78,27 +82,12 @@ class UserProxy:
             LOGGER.error("add user failed.")
             db.session.rollback()
             return DATABASE_INSERT_ERROR
+        except PasswordHasherBusy as error:
+            LOGGER.error(f"add user failed: {error}")
+            db.session.rollback()
+            return SERVER_ERROR
         return SUCCEED
 
-    def _register_callback(self, user) -> str:
-        res = SUCCEED
-        for client in db.session.query(OAuth2Client).distinct(OAuth2Client.client_id).all():
-            scope = client.client_metadata["scope"].split()
-            user_info = dict()
-            if "username" in scope:
-                user_info["username"] = user.username
-            if "email" in scope:
-                user_info["email"] = user.email
-            for register_callback_uri in client.register_callback_uris:
-                response_data = BaseResponse.get_response(
-                    method="Post", url=register_callback_uri, data=user_info, header=self.HEADERS
-                )
-                response_status = response_data.get("label")
-                if response_status != SUCCEED:
-                    LOGGER.error(f"register redirect failed: {client.client_id}, {user.username}")
-                    res = PARTIAL_SUCCEED
-        return res
-
     def _check_user_not_exist(self, username: str) -> bool:
         query_res = db.session.query(User).filter_by(username=username).count()
         if query_res != 0:
@@ -182,10 +171,20 @@ class UserProxy:
                 LOGGER.error("login with unknown username.")
                 return LOGIN_ERROR
 
-            res = user.check_password(password)
+            res = password_hasher.verify_and_update(user, password)
             if not res:
                 LOGGER.error("login with wrong password")
                 return PASSWORD_ERROR
+            if user in db.session.dirty:
+                try:
+                    db.session.commit()
+                except sqlalchemy.exc.SQLAlchemyError as error:
+                    # the outdated hash still verifies the password, the upgrade is tried again next login
+                    db.session.rollback()
+                    LOGGER.warning(f"Failed to save the upgraded password hash of {username}: {error}")
+        except PasswordHasherBusy as error:
+            LOGGER.error(f"user login failed: {error}")
+            return SERVER_ERROR
         except sqlalchemy.orm.exc.MultipleResultsFound as error:
             LOGGER.error(error)
             LOGGER.error(f"user should be unique: {username}")
@@ -218,7 +217,7 @@ class UserProxy:
             change_user = db.session.query(User).filter_by(username=username).one_or_none()
             if not change_user:
                 return NO_DATA
-            change_user.password = generate_password_hash(constant.DEFAULT_PASSWORD)
+            change_user.password = User.hash_password(constant.DEFAULT_PASSWORD)
             db.session.commit()
             LOGGER.debug("reset password succeed")
             return SUCCEED
@@ -230,6 +229,9 @@ class UserProxy:
             LOGGER.error("reset password fail")
             db.session.rollback()
             return DATABASE_UPDATE_ERROR
+        except PasswordHasherBusy as error:
+            LOGGER.error(f"reset password fail: {error}")
+            return SERVER_ERROR
 
     def application_logout(self) -> Tuple[str, str]:
         """
@@ -242,9 +244,9 @@ class UserProxy:
             callback_res = self._logout_callback(g.username)
             if callback_res != SUCCEED:
                 return callback_res
-            db.session.query(OAuth2Token).filter_by(username=g.username).delete(synchronize_session=False)
-            db.session.query(LoginRecords).filter_by(username=g.username).delete(synchronize_session=False)
-            db.session.commit()
+            # every token of the user is revoked at once, the rows are purged by the reaper
+            generation_registry.bump(g.username)
+            login_recorder.forget(g.username)
         except sqlalchemy.exc.SQLAlchemyError as error:
             LOGGER.error(error)
             LOGGER.error("logout failed")
@@ -256,32 +258,41 @@ class UserProxy:
         res = SUCCEED
         # verify the request
         login_records = db.session.query(LoginRecords).filter_by(username=username).all()
-        if not login_records:
+        logout_urls = {login_record.client_id: login_record.logout_url for login_record in login_records}
+        # logins still queued for the database
+        queued = login_recorder.client_ids(username) - set(logout_urls)
+        if not logout_urls and not queued:
             LOGGER.debug(f"{username} not in login state.")
             return SUCCEED
 
-        for login_record in login_records:
-            client = db.session.query(OAuth2Client).filter_by(client_id=login_record.client_id).one_or_none()
+        clients = client_registry.get_many(list(logout_urls) + list(queued))
+        for client_id in queued:
+            if client_id in clients:
+                logout_urls[client_id] = ",".join(clients[client_id].logout_callback_uris)
+        calls, call_clients = [], []
+        for client_id, logout_url in logout_urls.items():
+            client = clients.get(client_id)
             if not client:
-                LOGGER.error(f"get client info failed for client: {login_record.client_id}, please check")
+                LOGGER.error(f"get client info failed for client: {client_id}, please check")
                 continue
             # encrypt info: {client_id: client_secret}
-            encrypted_data = str({login_record.client_id: client.client_secret})
+            encrypted_data = str({client_id: client.client_secret})
             encrypted_data = encrypted_data.encode('utf-8')
             encoded_data = base64.b64encode(encrypted_data)
             encrypted_string = encoded_data.decode('utf-8')
-            logout_callback_uris = list(filter(None, login_record.logout_url.split(',')))
+            logout_callback_uris = list(filter(None, (logout_url or "").split(',')))
             for logout_callback_uri in logout_callback_uris:
-                response_data = BaseResponse.get_response(
-                    method="Post",
-                    url=logout_callback_uri,
-                    data=dict(username=username, encrypted_string=encrypted_string),
-                    header=self.HEADERS,
+                calls.append(
+                    (logout_callback_uri, dict(username=username, encrypted_string=encrypted_string), self.HEADERS)
+                )
+                call_clients.append(client_id)
+
+        # the callbacks run concurrently, the logout waits for the slowest one
+        for client_id, result in zip(call_clients, callback_dispatcher.dispatch(calls)):
+            if not result.ok:
+                LOGGER.error(
+                    f"logout for '{result.url}' failed: {client_id}, {username}, "
+                    f"status: {result.status_code}, error: {result.error}"
                 )
-                response_status = response_data.get("label")
-                if response_status != SUCCEED:
-                    LOGGER.error(
-                        f"logout for '{logout_callback_uri}' failed: {login_record.client_id}, {login_record.username}"
-                    )
-                    res = PARTIAL_SUCCEED
+                res = PARTIAL_SUCCEED
         return res
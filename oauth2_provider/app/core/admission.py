@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import hashlib
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from redis.exceptions import RedisError
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache
+from oauth2_provider.app.settings import config_option
+
+# KEYS[1] is the stats hash, KEYS[2..] the windows of the request. ARGV is now and the window in milliseconds,
+# the member added to the windows, the policy name and the limit and dimension of every window.
+# Returns {0} when the request is admitted, {retry after in milliseconds, index of the full window} otherwise.
+SLIDING_WINDOW = """
+local now, window, member, policy = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3], ARGV[4]
+local retry, full = 0, 0
+for index = 2, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[index], '-inf', now - window)
+    if redis.call('ZCARD', KEYS[index]) >= tonumber(ARGV[3 + 2 * (index - 1)]) then
+        local oldest = redis.call('ZRANGE', KEYS[index], 0, 0, 'WITHSCORES')
+        local wait = tonumber(oldest[2]) + window - now
+        if wait > retry then
+            retry, full = wait, index - 1
+        end
+    end
+end
+if full > 0 then
+    redis.call('HINCRBY', KEYS[1], policy .. ':shed:' .. ARGV[4 + 2 * full], 1)
+    return {math.max(retry, 1), full}
+end
+for index = 2, #KEYS do
+    redis.call('ZADD', KEYS[index], now, member)
+    redis.call('PEXPIRE', KEYS[index], window)
+end
+redis.call('HINCRBY', KEYS[1], policy .. ':admitted', 1)
+return {0}
+"""
+
+
+# response labels of the shed requests, neither is an error of the server
+TOO_MANY_REQUESTS = "Too.Many.Requests"
+SERVER_BUSY = "Server.Busy"
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is shed, status is 429 for a rate limit and 503 for the concurrency cap
+    """
+
+    def __init__(self, status: int, retry_after: int, reason: str):
+        super().__init__(f"request shed by {reason}")
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+    @property
+    def label(self) -> str:
+        return TOO_MANY_REQUESTS if self.status == 429 else SERVER_BUSY
+
+
+class AdmissionPolicy:
+    def __init__(self, name: str, limits: dict, concurrency: int):
+        self.name = name
+        # dimension -> requests allowed per window, 0 disables the dimension
+        self.limits = {dimension: limit for dimension, limit in limits.items() if limit > 0}
+        self.concurrency = concurrency
+
+
+class AdmissionController:
+    """
+    Admission control of the expensive endpoints.
+
+    A request first takes a slot of the concurrency cap of its policy in the worker, the cap keeps a burst
+    from queueing behind the password hashing and the token minting already running. Then one Lua script
+    checks the sliding windows of the username, client and IP of the request: every window is a sorted set
+    of the admitted requests of the last window seconds. The admitted and shed requests of every policy are
+    counted in a redis hash. Rate limiting fails open when redis is unavailable.
+    """
+
+    stats_key = "authhub:admission:stats"
+
+    def __init__(self, policies, window: int = 60, enabled: bool = True):
+        self.policies = {policy.name: policy for policy in policies}
+        self.window = window
+        self.enabled = enabled
+        self._script = None
+        self._pid = None
+        self._slots = dict()
+        self._lock = threading.Lock()
+
+    def _ensure_slots(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._slots = {
+                    name: threading.BoundedSemaphore(policy.concurrency)
+                    for name, policy in self.policies.items()
+                    if policy.concurrency > 0
+                }
+                self._pid = os.getpid()
+
+    @staticmethod
+    def _key(policy, dimension, value):
+        # the values come from the request before it is validated, keep the key size bounded
+        return f"authhub:rate:{policy}:{dimension}:{hashlib.sha1(str(value).encode()).hexdigest()}"
+
+    def _count(self, field):
+        try:
+            cache.hincrby(self.stats_key, field, 1)
+        except RedisError as error:
+            LOGGER.debug("Failed to count shed request: %s", error)
+
+    def _check_rate(self, policy: AdmissionPolicy, identities: dict):
+        windows = [
+            (dimension, limit) for dimension, limit in policy.limits.items() if identities.get(dimension) is not None
+        ]
+        if not windows:
+            return
+        if self._script is None:
+            self._script = cache.register_script(SLIDING_WINDOW)
+        keys = [self.stats_key] + [self._key(policy.name, dimension, identities[dimension]) for dimension, _ in windows]
+        args = [int(time.time() * 1000), self.window * 1000, uuid.uuid4().hex, policy.name]
+        for dimension, limit in windows:
+            args += [limit, dimension]
+        try:
+            result = self._script(keys=keys, args=args)
+        except RedisError as error:
+            LOGGER.warning("Rate limiting unavailable, admit the request: %s", error)
+            return
+        if int(result[0]):
+            dimension = windows[int(result[1]) - 1][0]
+            raise AdmissionRejected(429, math.ceil(int(result[0]) / 1000), dimension)
+
+    @contextmanager
+    def admit(self, name: str, identities: dict):
+        """
+        Hold the admission of a request while it is served
+
+        Args:
+            name: policy name
+            identities: dimension to value of the request, e.g. username, client and ip
+
+        Raises:
+            AdmissionRejected: the request must be refused
+        """
+        policy = self.policies.get(name)
+        if not self.enabled or policy is None:
+            yield
+            return
+        self._ensure_slots()
+        slot = self._slots.get(name)
+        if slot is not None and not slot.acquire(blocking=False):
+            self._count(f"{name}:shed:concurrency")
+            raise AdmissionRejected(503, 1, "concurrency")
+        try:
+            self._check_rate(policy, identities)
+            yield
+        finally:
+            if slot is not None:
+                slot.release()
+
+    def stats(self) -> dict:
+        """
+        Admitted and shed requests of every policy since the counters were created
+        """
+        return {name: int(value) for name, value in sorted((cache.hgetall(self.stats_key) or dict()).items())}
+
+
+admission_controller = AdmissionController(
+    policies=[
+        AdmissionPolicy(
+            "login",
+            limits=dict(
+                username=int(config_option("admission", "login_per_username", 10)),
+                ip=int(config_option("admission", "login_per_ip", 100)),
+            ),
+            concurrency=int(config_option("admission", "login_concurrency", 2)),
+        ),
+        AdmissionPolicy(
+            "manager_login",
+            limits=dict(
+                username=int(config_option("admission", "login_per_username", 10)),
+                ip=int(config_option("admission", "login_per_ip", 100)),
+            ),
+            concurrency=int(config_option("admission", "login_concurrency", 2)),
+        ),
+        AdmissionPolicy(
+            "token",
+            limits=dict(
+                client=int(config_option("admission", "token_per_client", 600)),
+                ip=int(config_option("admission", "token_per_ip", 600)),
+            ),
+            concurrency=int(config_option("admission", "token_concurrency", 3)),
+        ),
+    ],
+    window=int(config_option("admission", "window", 60)),
+    enabled=bool(config_option("admission", "enabled", True)),
+)
@@ -28,7 +28,8 @@ from vulcanus.restful.resp.state import (
     SUCCEED,
 )
 
-from oauth2_provider.manage import db
+from oauth2_provider.app import db
+from oauth2_provider.app.core.clients import client_registry
 from oauth2_provider.database.table import OAuth2Client
 
 
@@ -148,6 +149,7 @@ class ApplicationProxy:
                 .update({'_client_metadata': json_dumps(metadata)})
             )
             db.session.commit()
+            client_registry.invalidate(client_id)
             if not ret:
                 LOGGER.info(f'''no application refer to this client_id {client_id}, this user name {username}''')
                 return DATABASE_UPDATE_ERROR
@@ -169,6 +171,7 @@ class ApplicationProxy:
                 LOGGER.info(f'''no application refer to this client_id {client_id}, this user name {username}''')
                 return DATABASE_DELETE_ERROR
             db.session.commit()
+            client_registry.invalidate(client_id)
         except sqlalchemy.exc.SQLAlchemyError as error:
             LOGGER.error(error)
             db.session.rollback()
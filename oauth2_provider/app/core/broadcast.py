@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import json
+import os
+import threading
+import time
+
+from redis.exceptions import RedisError
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache
+
+
+class Broadcast:
+    """
+    Deliver invalidation messages to every worker process through redis pub/sub.
+
+    Each process runs one listener thread, it is started by the first subscribe so that it is created
+    after uwsgi forks the workers. Messages published while a listener is disconnected are lost, so the
+    handlers are called with None after every reconnect and must drop everything they cached.
+    """
+
+    channel = "authhub:broadcast"
+    reconnect_interval = 1
+
+    def __init__(self):
+        self._handlers = dict()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def subscribe(self, topic: str, handler):
+        """
+        Register a handler(message) for the topic, message is None when the handler must drop all its state.
+        Subscribing again in a forked worker starts the listener of that process.
+        """
+        with self._lock:
+            handlers = self._handlers.setdefault(topic, [])
+            if handler not in handlers:
+                handlers.append(handler)
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._listen, name="authhub-broadcast", daemon=True).start()
+
+    def publish(self, topic: str, message=None):
+        try:
+            cache.publish(self.channel, json.dumps(dict(topic=topic, message=message)))
+        except RedisError as error:
+            LOGGER.error("Failed to publish %s invalidation: %s", topic, error)
+
+    def _dispatch(self, topic, message):
+        topics = self._handlers.keys() if topic is None else [topic]
+        for name in list(topics):
+            for handler in self._handlers.get(name, []):
+                try:
+                    handler(message)
+                except Exception as error:
+                    LOGGER.error("Failed to handle %s broadcast: %s", name, error)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = cache.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self._dispatch(None, None)
+                for item in pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    payload = json.loads(item["data"])
+                    self._dispatch(payload["topic"], payload.get("message"))
+            except (RedisError, ValueError) as error:
+                LOGGER.warning("Broadcast listener disconnected: %s", error)
+            time.sleep(self.reconnect_interval)
+
+
+broadcast = Broadcast()
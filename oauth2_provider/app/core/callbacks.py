@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from vulcanus.restful.resp.state import SUCCEED
+
+from oauth2_provider.app.core.metrics import metrics
+from oauth2_provider.app.settings import config_option
+
+
+class CallbackResult:
+    def __init__(self, url: str, ok: bool, status_code: int = None, error: str = None, elapsed: float = 0):
+        self.url = url
+        self.ok = ok
+        self.status_code = status_code
+        self.error = error
+        self.elapsed = elapsed
+
+
+class CallbackDispatcher:
+    """
+    Send the callbacks of the registered clients concurrently.
+
+    The calls run on a bounded thread pool of the worker and share one requests session, which keeps the
+    connections to every host alive between calls. A call succeeds when the client answers with the
+    vulcanus SUCCEED label, the same check BaseResponse.get_response callers apply. The whole dispatch
+    waits at most deadline seconds, the calls still running then are reported as failed.
+    """
+
+    def __init__(
+        self, max_workers: int = 16, connect_timeout: float = 3, read_timeout: float = 5, deadline: float = 10
+    ):
+        self.max_workers = max_workers
+        self.timeout = (connect_timeout, read_timeout)
+        self.deadline = deadline
+        self._pid = None
+        self._executor = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _ensure_pool(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="authhub-callback")
+                self._pid = os.getpid()
+
+    def _post(self, url, data, headers) -> CallbackResult:
+        started = time.monotonic()
+        try:
+            response = self._session.post(url, json=data, headers=headers, timeout=self.timeout)
+            label = response.json().get("label") if response.ok else None
+        except (requests.RequestException, ValueError, AttributeError) as error:
+            result = CallbackResult(url, False, error=str(error), elapsed=time.monotonic() - started)
+        else:
+            result = CallbackResult(url, label == SUCCEED, response.status_code, elapsed=time.monotonic() - started)
+        metrics.observe("callback", result.elapsed, "ok" if result.ok else "failed")
+        return result
+
+    def post(self, url: str, data: dict, headers: dict) -> CallbackResult:
+        """
+        Post one callback in the calling thread
+        """
+        self._ensure_pool()
+        return self._post(url, data, headers)
+
+    def dispatch(self, calls) -> list:
+        """
+        Post the calls and wait for all of them
+
+        Args:
+            calls: iterable of (url, data, headers)
+
+        Returns:
+            list: CallbackResult of every call, in the order of calls
+        """
+        calls = list(calls)
+        if not calls:
+            return []
+        self._ensure_pool()
+        futures = [self._executor.submit(self._post, url, data, headers) for url, data, headers in calls]
+        wait(futures, timeout=self.deadline)
+        results = []
+        for (url, _, _), future in zip(calls, futures):
+            if future.done():
+                results.append(future.result())
+            else:
+                future.cancel()
+                results.append(CallbackResult(url, False, error="deadline exceeded", elapsed=self.deadline))
+        return results
+
+
+callback_dispatcher = CallbackDispatcher(
+    max_workers=int(config_option("callbacks", "max_workers", 16)),
+    connect_timeout=float(config_option("callbacks", "connect_timeout", 3)),
+    read_timeout=float(config_option("callbacks", "read_timeout", 5)),
+    deadline=float(config_option("callbacks", "deadline", 10)),
+)
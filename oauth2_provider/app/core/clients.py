@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.orm import Session
+
+from oauth2_provider.app import db
+from oauth2_provider.app.core.broadcast import broadcast
+from oauth2_provider.app.settings import config_option
+from oauth2_provider.database.table import OAuth2Client
+
+
+class ClientRegistry:
+    """
+    Bounded TTL/LRU cache of the registered clients inside the worker process.
+
+    The cached clients are detached from any session and their client_metadata is parsed once, they must
+    be treated as read only. Updates and deletes are broadcast to all workers by ``invalidate``.
+    """
+
+    topic = "client"
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._subscribed_pid = None
+
+    def _load(self, client_ids):
+        with Session(db.engine, expire_on_commit=False) as session:
+            clients = session.query(OAuth2Client).filter(OAuth2Client.client_id.in_(client_ids)).all()
+            session.expunge_all()
+        for client in clients:
+            # parse the metadata json once, it is kept on the instance
+            client.client_metadata
+        return clients
+
+    def _put(self, client):
+        with self._lock:
+            self._clients[client.client_id] = (client, time.monotonic() + self.ttl)
+            self._clients.move_to_end(client.client_id)
+            while len(self._clients) > self.maxsize:
+                self._clients.popitem(last=False)
+
+    def _cached(self, client_id):
+        with self._lock:
+            item = self._clients.get(client_id)
+            if not item:
+                return None
+            client, expires_at = item
+            if expires_at < time.monotonic():
+                del self._clients[client_id]
+                return None
+            self._clients.move_to_end(client_id)
+            return client
+
+    def _ensure_subscribed(self):
+        if self._subscribed_pid != os.getpid():
+            self._subscribed_pid = os.getpid()
+            broadcast.subscribe(self.topic, self._evict)
+
+    def get(self, client_id: str):
+        """
+        Get the client by client id
+
+        :return: OAuth2Client or None
+        """
+        if not client_id:
+            return None
+        self._ensure_subscribed()
+        client = self._cached(client_id)
+        if client:
+            return client
+        for client in self._load([client_id]):
+            self._put(client)
+            return client
+        return None
+
+    def get_many(self, client_ids):
+        """
+        Get several clients with at most one query
+
+        :return: dict of client_id to OAuth2Client, unknown client ids are missing
+        """
+        self._ensure_subscribed()
+        clients, missing = dict(), []
+        for client_id in set(client_ids):
+            client = self._cached(client_id)
+            if client:
+                clients[client_id] = client
+            else:
+                missing.append(client_id)
+        if missing:
+            for client in self._load(missing):
+                self._put(client)
+                clients[client.client_id] = client
+        return clients
+
+    def _evict(self, client_id=None):
+        with self._lock:
+            if client_id is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(client_id, None)
+
+    def invalidate(self, client_id: str):
+        """
+        Drop the client from the cache of every worker, called after the client is updated or deleted
+        """
+        self._evict(client_id)
+        broadcast.publish(self.topic, client_id)
+
+
+client_registry = ClientRegistry(
+    maxsize=int(config_option("client_cache", "maxsize", 1024)), ttl=int(config_option("client_cache", "ttl", 60))
+)
+
+
+def query_client(client_id):
+    """
+    query_client of the authorization server
+    """
+    return client_registry.get(client_id)
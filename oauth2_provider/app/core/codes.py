@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import hashlib
+import json
+import time
+
+from authlib.oauth2.rfc6749.errors import InvalidRequestError, OAuth2Error
+from redis.exceptions import RedisError, ResponseError
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache
+from oauth2_provider.app.settings import config_option
+from oauth2_provider.database.table import OAuth2AuthorizationCode
+
+# authlib rejects authorization codes older than five minutes
+AUTHORIZATION_CODE_EXPIRES_IN = 300
+
+
+class RedisCodeStore:
+    """
+    Authorization codes kept in redis instead of the oauth2_code table.
+
+    A code is written with ``SET NX EX`` and redeemed with ``GETDEL``, so it can be exchanged only once even
+    when two token requests race, and redis drops the codes nobody redeems. Every nonce of a code is claimed
+    with its own key for as long as the code lives, a second code with the same nonce is refused.
+    """
+
+    code_prefix = "authhub:code:"
+    nonce_prefix = "authhub:nonce:"
+    # attributes of OAuth2AuthorizationCode kept with the code
+    fields = (
+        "code",
+        "client_id",
+        "redirect_uri",
+        "response_type",
+        "scope",
+        "username",
+        "nonce",
+        "auth_time",
+        "code_challenge",
+        "code_challenge_method",
+    )
+
+    def __init__(self, enabled: bool = False, expires_in: int = AUTHORIZATION_CODE_EXPIRES_IN):
+        self.enabled = enabled
+        self.expires_in = expires_in
+        self._getdel = True
+
+    @staticmethod
+    def _digest(value: str) -> str:
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+    def _code_key(self, code, client_id):
+        return f"{self.code_prefix}{client_id}:{self._digest(code)}"
+
+    def _nonce_key(self, nonce, client_id):
+        return f"{self.nonce_prefix}{client_id}:{self._digest(nonce)}"
+
+    def save(self, code: str, request, username: str):
+        """
+        Save the authorization code of the request
+
+        :return: OAuth2AuthorizationCode, it is not added to any session
+        """
+        client_id = request.client.client_id
+        auth_code = OAuth2AuthorizationCode(
+            code=code,
+            client_id=client_id,
+            redirect_uri=request.redirect_uri,
+            response_type=request.response_type,
+            scope=request.scope,
+            username=username,
+            nonce=request.data.get('nonce'),
+            auth_time=int(time.time()),
+            code_challenge=request.data.get('code_challenge'),
+            code_challenge_method=request.data.get('code_challenge_method'),
+        )
+        value = json.dumps({field: getattr(auth_code, field) for field in self.fields})
+        try:
+            if auth_code.nonce and not cache.set(
+                self._nonce_key(auth_code.nonce, client_id), 1, nx=True, ex=self.expires_in
+            ):
+                raise InvalidRequestError("Nonce has already been used")
+            if not cache.set(self._code_key(code, client_id), value, nx=True, ex=self.expires_in):
+                raise OAuth2Error("The authorization code already exists", error="invalid_code")
+        except RedisError as error:
+            LOGGER.error("Failed to save authorization code: %s", error)
+            raise OAuth2Error("Failed to save authorization code", error="temporarily_unavailable", status_code=503)
+        return auth_code
+
+    def _take(self, key):
+        if self._getdel:
+            try:
+                return cache.getdel(key)
+            except ResponseError:
+                # GETDEL needs redis 6.2, MULTI/EXEC is as atomic on older servers
+                LOGGER.info("GETDEL is not supported by the redis server, use GET and DEL in a transaction")
+                self._getdel = False
+        pipeline = cache.pipeline(transaction=True)
+        pipeline.get(key)
+        pipeline.delete(key)
+        value, _ = pipeline.execute()
+        return value
+
+    def redeem(self, code: str, client_id: str):
+        """
+        Take the code out of the store, a code is returned to at most one caller
+
+        :return: OAuth2AuthorizationCode or None
+        """
+        try:
+            value = self._take(self._code_key(code, client_id))
+        except RedisError as error:
+            LOGGER.error("Failed to redeem authorization code: %s", error)
+            return None
+        if value is None:
+            return None
+        return OAuth2AuthorizationCode(**json.loads(value))
+
+    def exists_nonce(self, nonce: str, client_id: str) -> bool:
+        try:
+            return bool(cache.exists(self._nonce_key(nonce, client_id)))
+        except RedisError as error:
+            LOGGER.error("Failed to query nonce: %s", error)
+            return False
+
+
+code_store = RedisCodeStore(enabled=config_option("authorization_code", "store", "database") == "redis")
@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+from redis.exceptions import RedisError
+from sqlalchemy import func
+from sqlalchemy.dialects.mysql import insert
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache, db
+from oauth2_provider.app.core.broadcast import broadcast
+from oauth2_provider.app.settings import config_option
+from oauth2_provider.database.table import SessionGeneration
+
+USER_LEVEL = ""
+LOADED = "*"
+
+# KEYS[1] is the generation hash of a user, ARGV is the ttl, 1 when the fields are all the rows of the user in the
+# database, then field and generation pairs. A field only moves forward, so a write racing a load never goes back.
+# Returns the fields of the hash.
+MERGE_GENERATIONS = """
+for index = 3, #ARGV, 2 do
+    local current = tonumber(redis.call('HGET', KEYS[1], ARGV[index]) or '0')
+    if tonumber(ARGV[index + 1]) > current then
+        redis.call('HSET', KEYS[1], ARGV[index], ARGV[index + 1])
+    end
+end
+if ARGV[2] == '1' then
+    redis.call('HSET', KEYS[1], '*', 1)
+end
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[1]))
+return redis.call('HGETALL', KEYS[1])
+"""
+
+
+class GenerationRegistry:
+    """
+    Session generations of the users, and of every user on every client, kept in the session_generation table
+    and mirrored in one redis hash per user.
+
+    The tokens carry the user generation (ugen claim) and the client generation (cgen claim) they were issued
+    in, a token is current while neither is older than the registry. Logging out bumps the user generation and
+    a new login on a client supersedes the client generation, every token issued before is revoked without
+    touching the token rows. The generations read by a worker are remembered for memo_ttl seconds, a bump is
+    broadcast and every worker drops the user. The redis hash is read again from the database after
+    redis_ttl seconds, a bump that could neither be written to the hash nor drop it is lost for no longer.
+    """
+
+    key_prefix = "authhub:generation:"
+    topic = "generation"
+
+    def __init__(self, maxsize: int = 4096, memo_ttl: int = 5, redis_ttl: int = 300):
+        self.maxsize = maxsize
+        self.memo_ttl = memo_ttl
+        self.ttl = redis_ttl
+        # username -> (generations, monotonic expiry)
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._subscribed_pid = None
+        self._script = None
+
+    def _key(self, username):
+        return self.key_prefix + username
+
+    def _ensure_subscribed(self):
+        if self._subscribed_pid != os.getpid():
+            self._subscribed_pid = os.getpid()
+            broadcast.subscribe(self.topic, self._evict)
+
+    def _evict(self, username=None):
+        with self._lock:
+            if username is None:
+                self._memo.clear()
+            else:
+                self._memo.pop(username, None)
+
+    def _remembered(self, username):
+        with self._lock:
+            item = self._memo.get(username)
+            if not item:
+                return None
+            generations, expires_at = item
+            if expires_at < time.monotonic():
+                del self._memo[username]
+                return None
+            self._memo.move_to_end(username)
+            return generations
+
+    def _remember(self, username, generations):
+        with self._lock:
+            self._memo[username] = (generations, time.monotonic() + self.memo_ttl)
+            self._memo.move_to_end(username)
+            while len(self._memo) > self.maxsize:
+                self._memo.popitem(last=False)
+
+    def _merge(self, username, generations: dict, loaded: bool) -> dict:
+        if self._script is None:
+            self._script = cache.register_script(MERGE_GENERATIONS)
+        args = [self.ttl, 1 if loaded else 0]
+        for field, generation in generations.items():
+            args.extend((field, generation))
+        return self._parse(self._script(keys=[self._key(username)], args=args))
+
+    @staticmethod
+    def _parse(fields) -> dict:
+        if isinstance(fields, list):
+            fields = dict(zip(fields[::2], fields[1::2]))
+        return {field: int(value) for field, value in fields.items() if field != LOADED}
+
+    @staticmethod
+    def _load(usernames) -> dict:
+        generations = {username: dict() for username in usernames}
+        rows = (
+            db.session.query(SessionGeneration.username, SessionGeneration.client_id, SessionGeneration.generation)
+            .filter(SessionGeneration.username.in_(list(generations)))
+            .all()
+        )
+        for username, client_id, generation in rows:
+            generations[username][client_id] = generation
+        return generations
+
+    def generations_many(self, usernames) -> dict:
+        """
+        :return: dict of username to the dict of client_id ("" for the user) to generation
+        """
+        results, missing = dict(), []
+        for username in set(usernames):
+            generations = self._remembered(username) if self.memo_ttl > 0 else None
+            if generations is None:
+                missing.append(username)
+            else:
+                results[username] = generations
+        if not missing:
+            return results
+        try:
+            pipeline = cache.pipeline(transaction=False)
+            for username in missing:
+                pipeline.hgetall(self._key(username))
+            cached = dict(zip(missing, pipeline.execute()))
+            unloaded = [username for username in missing if LOADED not in cached[username]]
+            loaded = self._load(unloaded) if unloaded else dict()
+            for username in missing:
+                if username in loaded:
+                    results[username] = self._merge(username, loaded[username], True)
+                else:
+                    results[username] = self._parse(cached[username])
+        except RedisError as error:
+            LOGGER.warning("Failed to read session generations, fall back to database: %s", error)
+            results.update(self._load([username for username in missing if username not in results]))
+            return results
+        if self.memo_ttl > 0:
+            self._ensure_subscribed()
+            for username in missing:
+                self._remember(username, results[username])
+        return results
+
+    @staticmethod
+    def pick(generations: dict, client_id: str) -> Tuple[int, int]:
+        """
+        :return: (user generation, client generation) of the client among the generations of a user
+        """
+        return generations.get(USER_LEVEL, 0), generations.get(client_id, 0)
+
+    def _current(self, generations, client_id, user_generation, client_generation) -> bool:
+        current_user, current_client = self.pick(generations, client_id)
+        return (user_generation or 0) >= current_user and (client_generation or 0) >= current_client
+
+    def current(self, username: str, client_id: str) -> Tuple[int, int]:
+        """
+        :return: (user generation, client generation) of the user on the client
+        """
+        return self.pick(self.generations_many([username])[username], client_id)
+
+    def is_current(self, username: str, client_id: str, user_generation: int, client_generation: int) -> bool:
+        """
+        Whether a token issued in the given generations is still current, the tokens issued before the
+        generations were introduced carry none and are generation 0
+        """
+        generations = self.generations_many([username])[username]
+        return self._current(generations, client_id, user_generation, client_generation)
+
+    def current_many(self, tokens) -> set:
+        """
+        The current tokens among tokens, the generations of every user are read once
+
+        :param tokens: dict of any key to (username, client_id, user generation, client generation)
+        :return: set of the keys of the current tokens
+        """
+        generations = self.generations_many(username for username, _, _, _ in tokens.values())
+        return {
+            key
+            for key, (username, client_id, user_generation, client_generation) in tokens.items()
+            if self._current(generations[username], client_id, user_generation, client_generation)
+        }
+
+    def _advance(self, username: str, client_id: str, generation: int = None) -> int:
+        """
+        Increment the generation, or move it forward to generation, and publish it to redis and the workers
+
+        :return: the generation in the database
+        """
+        now = int(time.time())
+        values = dict(username=username, client_id=client_id, generation=generation or 1, updated_at=now)
+        statement = insert(SessionGeneration).values(values)
+        advanced = func.greatest(SessionGeneration.generation, statement.inserted.generation)
+        statement = statement.on_duplicate_key_update(
+            generation=SessionGeneration.generation + 1 if generation is None else advanced, updated_at=now
+        )
+        db.session.execute(statement)
+        db.session.commit()
+        generation = (
+            db.session.query(SessionGeneration.generation)
+            .filter_by(username=username, client_id=client_id)
+            .scalar()
+        )
+        try:
+            self._merge(username, {client_id: generation}, False)
+        except RedisError as error:
+            # the hash is read again from the database once it is dropped, or at the latest after redis_ttl
+            LOGGER.error("Failed to publish the session generation of %s: %s", username, error)
+            try:
+                cache.delete(self._key(username))
+            except RedisError:
+                pass
+        self._evict(username)
+        broadcast.publish(self.topic, username)
+        return generation
+
+    def bump(self, username: str, client_id: str = None) -> int:
+        """
+        Revoke every token of the user, or of the user on the client when client_id is given
+
+        :return: the new generation
+        """
+        return self._advance(username, client_id or USER_LEVEL)
+
+    def supersede(self, username: str, client_id: str, client_generation: int) -> int:
+        """
+        Revoke the tokens of the user on the client issued before client_generation, called once a token of
+        that generation is issued
+
+        :return: the generation in the database
+        """
+        return self._advance(username, client_id, client_generation)
+
+
+generation_registry = GenerationRegistry(
+    maxsize=int(config_option("generation_cache", "maxsize", 4096)),
+    memo_ttl=int(config_option("generation_cache", "memo_ttl", 5)),
+    redis_ttl=int(config_option("generation_cache", "redis_ttl", 300)),
+)
@@ -13,15 +13,21 @@
 from copy import deepcopy
 
 from authlib.oauth2.rfc6749 import grants
-from authlib.oauth2.rfc6749.errors import OAuth2Error
+from authlib.oauth2.rfc6749.errors import InvalidGrantError, OAuth2Error
 from authlib.oidc.core.grants import OpenIDCode as _OpenIDCode
 from authlib.oidc.core.grants import OpenIDHybridGrant as _OpenIDHybridGrant
 from authlib.oidc.core.grants import OpenIDImplicitGrant as _OpenIDImplicitGrant
+from redis.exceptions import RedisError
 from sqlalchemy.exc import SQLAlchemyError
 from vulcanus.log.log import LOGGER
 
+from oauth2_provider.app import db
+from oauth2_provider.app.core.codes import code_store
+from oauth2_provider.app.core.keys import key_ring
+from oauth2_provider.app.core.password import PasswordHasherBusy, password_hasher
+from oauth2_provider.app.core.revocation import RevocationUnavailableError
+from oauth2_provider.app.core.rotation import token_rotator
 from oauth2_provider.database.table import OAuth2AuthorizationCode, OAuth2Token, User
-from oauth2_provider.manage import db
 
 JWT_CONFIG = {
     'key': None,
@@ -32,6 +38,20 @@ JWT_CONFIG = {
 }
 
 
+def client_jwt_config(client):
+    """
+    JWT config of the id token issued to the client, signed by the key ring when it holds asymmetric keys
+    """
+    jwt = deepcopy(JWT_CONFIG)
+    if key_ring.asymmetric:
+        private_jwk = key_ring.private_jwk()
+        jwt.update(key=dict(keys=[private_jwk]), alg=key_ring.alg, kid=private_jwk["kid"])
+    else:
+        jwt["key"] = client.client_secret
+    jwt["aud"] = client.client_id
+    return jwt
+
+
 class AuthorizationCodeGrant(grants.AuthorizationCodeGrant):
     """
     Authorization code grant type.
@@ -58,6 +78,8 @@ class AuthorizationCodeGrant(grants.AuthorizationCodeGrant):
 
         :return: authorization code object or raise OAuth2Error
         """
+        if code_store.enabled:
+            return code_store.save(code, request, username=request.user)
 
         try:
             if OAuth2AuthorizationCode.query.filter_by(code=code, client_id=request.client.client_id).one_or_none():
@@ -92,6 +114,11 @@ class AuthorizationCodeGrant(grants.AuthorizationCodeGrant):
 
         :return: The authorization code or None if it does not exist.
         """
+        if code_store.enabled:
+            # the code is taken out of the store here, a second exchange of the same code finds nothing
+            auth_code = code_store.redeem(code, client.client_id)
+            return None if not auth_code or auth_code.is_expired() else auth_code
+
         try:
             auth_code = (
                 db.session.query(OAuth2AuthorizationCode).filter_by(code=code, client_id=client.client_id).one_or_none()
@@ -118,6 +145,9 @@ class AuthorizationCodeGrant(grants.AuthorizationCodeGrant):
         """
         if not authorization_code:
             return False
+        if code_store.enabled:
+            # already removed from the store when it was redeemed
+            return True
         try:
             db.session.query(OAuth2AuthorizationCode).filter_by(id=authorization_code.id).delete()
             db.session.commit()
@@ -158,12 +188,22 @@ class PasswordGrant(grants.ResourceOwnerPasswordCredentialsGrant):
         """
         try:
             user = User.query.filter_by(username=username).one_or_none()
+            if not user or not password_hasher.verify_and_update(user, password):
+                return None
         except SQLAlchemyError as error:
             LOGGER.error('Failed to query user: %s', error)
             return None
-        if not user or not user.check_password(password):
+        except PasswordHasherBusy as error:
+            LOGGER.error('Failed to verify password: %s', error)
             return None
 
+        if user in db.session.dirty:
+            try:
+                db.session.commit()
+            except SQLAlchemyError as error:
+                # the outdated hash still verifies the password, the upgrade is tried again next login
+                db.session.rollback()
+                LOGGER.warning('Failed to save the upgraded password hash of %s: %s', username, error)
         return user
 
 
@@ -179,7 +219,7 @@ class RefreshTokenGrant(grants.RefreshTokenGrant):
         :param refresh_token: Refresh token
         """
         try:
-            token = OAuth2Token.query.filter_by(refresh_token=refresh_token).one_or_none()
+            token = OAuth2Token.query.filter_by(refresh_token_digest=OAuth2Token.digest(refresh_token)).one_or_none()
             if token and token.is_revoked():
                 return token
         except SQLAlchemyError as error:
@@ -201,21 +241,33 @@ class RefreshTokenGrant(grants.RefreshTokenGrant):
 
         return user
 
-    def revoke_old_credential(self, credential: OAuth2Token):
+    def issue_token(self, user: User, refresh_token: OAuth2Token):
         """
-        Revoking the previously issued token
+        Revoke the refresh token before the new token is generated and saved, of concurrent refreshes of one
+        refresh token only the one whose revocation matched the row version is issued a token
 
-        :param credential: OAuth2Token instance
+        :param user: User instance
+        :param refresh_token: OAuth2Token instance of the refresh token
         """
         try:
-            credential.revoked = True
-            db.session.add(credential)
-            db.session.commit()
-            return True
+            revoked = token_rotator.revoke(refresh_token)
         except SQLAlchemyError as error:
+            db.session.rollback()
             LOGGER.error('Failed to revoke token: %s', error)
-            return False
+            raise OAuth2Error("Failed to revoke the refresh token", error="server_error", status_code=500)
+        except RedisError:
+            raise RevocationUnavailableError()
+        if not revoked:
+            raise InvalidGrantError("The refresh token has already been used")
 
+        return super().issue_token(user, refresh_token)
+
+    def revoke_old_credential(self, credential: OAuth2Token):
+        """
+        The refresh token was already revoked by issue_token, before the new token was saved
+
+        :param credential: OAuth2Token instance
+        """
 
 class OIDC:
     def generate_user_info(self, user, scope):
@@ -225,6 +277,8 @@ class OIDC:
         return user_info
 
     def exists_nonce(self, nonce, request):
+        if code_store.enabled:
+            return code_store.exists_nonce(nonce, request.client_id)
         try:
             oauth_code = OAuth2AuthorizationCode.query.filter_by(client_id=request.client_id, nonce=nonce).one_or_none()
         except SQLAlchemyError as error:
@@ -237,25 +291,19 @@ class OIDC:
 class OpenIDCode(OIDC, _OpenIDCode):
 
     def get_jwt_config(self, grant):
-        jwt = deepcopy(JWT_CONFIG)
-        jwt["key"] = grant.client.client_secret
-        jwt["aud"] = grant.client.client_id
-        return jwt
+        return client_jwt_config(grant.client)
 
     def generate_user_info(self, user, scope):
         user_info = dict(id=user.id, username=user.username)
         if "email" in scope:
-            user_info.email = user.email
+            user_info["email"] = user.email
         return user_info
 
 
 class ImplicitGrant(_OpenIDImplicitGrant, OIDC):
 
     def get_jwt_config(self):
-        jwt = deepcopy(JWT_CONFIG)
-        jwt["key"] = self.client.client_secret
-        jwt["aud"] = self.client.client_id
-        return jwt
+        return client_jwt_config(self.client)
 
 
 class HybridGrant(_OpenIDHybridGrant, OIDC):
@@ -269,6 +317,10 @@ class HybridGrant(_OpenIDHybridGrant, OIDC):
 
         :return: authorization code
         """
+        if code_store.enabled:
+            code_store.save(code, request, username=getattr(request.user, "username", request.user))
+            return code
+
         nonce = request.data.get('nonce')
         try:
             if OAuth2AuthorizationCode.query.filter_by(client_id=request.client.client_id, code=code).one_or_none():
@@ -291,7 +343,4 @@ class HybridGrant(_OpenIDHybridGrant, OIDC):
         return code
 
     def get_jwt_config(self):
-        jwt = deepcopy(JWT_CONFIG)
-        jwt["key"] = self.client.client_secret
-        jwt["aud"] = self.client.client_id
-        return jwt
+        return client_jwt_config(self.client)
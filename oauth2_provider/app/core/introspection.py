@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import json
+import threading
+import time
+
+from redis.exceptions import RedisError
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache
+from oauth2_provider.app.core.generations import generation_registry
+from oauth2_provider.app.settings import config_option
+
+# KEYS: the cached result of a token and the revocation mark of the token, ARGV: the result and its ttl.
+# A positive result is only written while the token is not marked revoked, the mark and the deletion of
+# the cached result are written in one transaction by the revocation registry.
+SET_ACTIVE = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+
+class IntrospectionCache:
+    """
+    Introspection results keyed by (sha256(token), client_id).
+
+    Positive results live until the token expires or max_ttl passes, whichever comes first, negative results
+    live negative_ttl seconds. Every path that revokes or replaces a token goes through the revocation
+    registry, which drops the cached result of the token. An introspection that read the token before it was
+    revoked cannot cache it as active afterwards. A positive result keeps the session generations of the
+    token and is ignored once they are superseded.
+    """
+
+    key_prefix = "authhub:introspect:"
+    revoked_key_prefix = "authhub:revoked:"
+    stats_key = "authhub:introspect:stats"
+    stats_flush_interval = 10
+
+    def __init__(self, enabled: bool = True, max_ttl: int = 300, negative_ttl: int = 60):
+        self.enabled = enabled
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self._counters = dict(hit=0, miss=0)
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+        self._script = None
+
+    def key(self, digest: str, client_id: str):
+        return f"{self.key_prefix}{digest}:{client_id}"
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+            if time.monotonic() - self._flushed_at < self.stats_flush_interval:
+                return
+            counters, self._counters = self._counters, dict(hit=0, miss=0)
+            self._flushed_at = time.monotonic()
+        try:
+            pipeline = cache.pipeline(transaction=False)
+            for counter, value in counters.items():
+                pipeline.hincrby(self.stats_key, counter, value)
+            pipeline.execute()
+        except RedisError as error:
+            LOGGER.debug("Failed to flush introspection cache counters: %s", error)
+
+    def get(self, digest: str, client_id: str):
+        """
+        Get the cached result
+
+        :return: (code, data) or None
+        """
+        if not self.enabled:
+            return None
+        try:
+            value = cache.get(self.key(digest, client_id))
+        except RedisError as error:
+            LOGGER.debug("Failed to read introspection cache: %s", error)
+            return None
+        if value is None:
+            self._count("miss")
+            return None
+        code, data, *generations = json.loads(value)
+        if generations and not generation_registry.is_current(data, client_id, *generations[0]):
+            self._count("miss")
+            return None
+        self._count("hit")
+        return code, data
+
+    def get_many(self, digests, client_id: str) -> dict:
+        """
+        Get the cached results of several tokens of one client with one MGET
+
+        :return: dict of digest to (code, data), the digests without a cached result are missing
+        """
+        digests = list(digests)
+        if not self.enabled or not digests:
+            return dict()
+        try:
+            values = cache.mget([self.key(digest, client_id) for digest in digests])
+        except RedisError as error:
+            LOGGER.debug("Failed to read introspection cache: %s", error)
+            return dict()
+        cached = {digest: json.loads(value) for digest, value in zip(digests, values) if value is not None}
+        positive = {digest: (value[1], client_id, *value[2]) for digest, value in cached.items() if value[2:]}
+        current = generation_registry.current_many(positive) if positive else set()
+        results = {
+            digest: (value[0], value[1])
+            for digest, value in cached.items()
+            if digest not in positive or digest in current
+        }
+        if len(results):
+            self._count("hit", len(results))
+        if len(digests) - len(results):
+            self._count("miss", len(digests) - len(results))
+        return results
+
+    def _ttl(self, expires_at):
+        if expires_at is None:
+            return self.negative_ttl
+        return min(int(expires_at - time.time()), self.max_ttl)
+
+    def set(self, digest: str, client_id: str, code: str, data=None, expires_at: int = None, generations=None):
+        """
+        Cache a result, a positive result passes the exp claim of the token as expires_at and its
+        (ugen, cgen) claims as generations
+        """
+        self.set_many([(digest, client_id, code, data, expires_at, generations)])
+
+    def set_many(self, results):
+        """
+        Cache several results in one round trip
+
+        :param results: iterable of (digest, client_id, code, data, expires_at, generations)
+        """
+        if not self.enabled:
+            return
+        if self._script is None:
+            self._script = cache.register_script(SET_ACTIVE)
+        try:
+            pipeline = cache.pipeline(transaction=False)
+            for digest, client_id, code, data, expires_at, generations in results:
+                ttl = self._ttl(expires_at)
+                if ttl <= 0:
+                    continue
+                key = self.key(digest, client_id)
+                if expires_at is None:
+                    pipeline.set(key, json.dumps([code, data]), ex=ttl)
+                    continue
+                value = [code, data, list(generations)] if generations else [code, data]
+                keys = [key, self.revoked_key_prefix + digest]
+                self._script(keys=keys, args=[json.dumps(value), ttl], client=pipeline)
+            if len(pipeline):
+                pipeline.execute()
+        except RedisError as error:
+            LOGGER.debug("Failed to write introspection cache: %s", error)
+
+    def stats(self) -> dict:
+        """
+        Hit and miss counters of all workers
+        """
+        counters = {name: int(value) for name, value in (cache.hgetall(self.stats_key) or dict()).items()}
+        with self._lock:
+            for name, value in self._counters.items():
+                counters[name] = counters.get(name, 0) + value
+        total = counters.get("hit", 0) + counters.get("miss", 0)
+        counters["hit_ratio"] = round(counters.get("hit", 0) / total, 4) if total else 0
+        return counters
+
+
+introspection_cache = IntrospectionCache(
+    enabled=bool(config_option("introspect", "cache", True)),
+    max_ttl=int(config_option("introspect", "cache_max_ttl", 300)),
+    negative_ttl=int(config_option("introspect", "cache_negative_ttl", 60)),
+)
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+from flask import current_app, has_app_context
+from jwt.algorithms import get_default_algorithms
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app.settings import config_option
+
+ASYMMETRIC_ALGORITHMS = ("RS256", "ES256", "EdDSA")
+# members of the public jwk that make up its RFC 7638 thumbprint
+THUMBPRINT_MEMBERS = {"RSA": ("e", "kty", "n"), "EC": ("crv", "kty", "x", "y"), "OKP": ("crv", "kty", "x")}
+
+
+class KeyRingError(Exception):
+    """
+    Raised when the signing keys can not be loaded or generated
+    """
+
+
+class SigningKey:
+    def __init__(self, kid: str, created_at: int, private_key, public_jwk: dict):
+        self.kid = kid
+        self.created_at = created_at
+        self.private_key = private_key
+        self.public_key = private_key.public_key()
+        self.public_jwk = public_jwk
+
+
+class KeyRing:
+    """
+    Asymmetric keys that sign the tokens issued to the clients.
+
+    Every ``<created_at>.pem`` file in key_dir is a private key of the configured algorithm. The newest key
+    that has been published for activation_delay seconds signs new tokens, so resource servers that cache the
+    JWKS learn a rotated key before they see tokens signed by it. The other keys only verify tokens. A key
+    is kept as long as a token it signed may be valid, older keys are removed beyond the newest max_keys.
+    Workers reload the directory when it changes.
+    """
+
+    reload_interval = 30
+    # REFRESH_TOKEN_EXPIRES_IN of the application, rotate() also runs in authhub-cli without it
+    refresh_token_expires_in = 60 * 60 * 24 * 30
+
+    def __init__(
+        self,
+        alg: str = "HS256",
+        key_dir: str = None,
+        max_keys: int = 3,
+        activation_delay: int = 3600,
+        rotation_interval: int = 60 * 60 * 24 * 30,
+    ):
+        if alg != "HS256" and alg not in ASYMMETRIC_ALGORITHMS:
+            raise KeyRingError(f"unsupported signing algorithm {alg}")
+        self.alg = alg
+        self.key_dir = key_dir
+        self.max_keys = max_keys
+        self.activation_delay = activation_delay
+        self.rotation_interval = rotation_interval
+        self._keys = dict()
+        self._active = None
+        self._jwks = dict(keys=[])
+        self._loaded_mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def asymmetric(self) -> bool:
+        return self.alg in ASYMMETRIC_ALGORITHMS
+
+    @property
+    def algorithm(self):
+        return get_default_algorithms()[self.alg]
+
+    def _public_jwk(self, private_key):
+        jwk = json.loads(self.algorithm.to_jwk(private_key.public_key()))
+        jwk.pop("key_ops", None)
+        members = {name: jwk[name] for name in THUMBPRINT_MEMBERS[jwk["kty"]]}
+        digest = hashlib.sha256(json.dumps(members, sort_keys=True, separators=(",", ":")).encode()).digest()
+        jwk.update(kid=base64.urlsafe_b64encode(digest).rstrip(b"=").decode(), alg=self.alg, use="sig")
+        return jwk
+
+    def _load(self):
+        from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+        keys = dict()
+        for file_name in sorted(os.listdir(self.key_dir)):
+            name, suffix = os.path.splitext(file_name)
+            if suffix != ".pem" or not name.isdigit():
+                continue
+            with open(os.path.join(self.key_dir, file_name), "rb") as key_file:
+                private_key = load_pem_private_key(key_file.read(), password=None)
+            public_jwk = self._public_jwk(private_key)
+            keys[public_jwk["kid"]] = SigningKey(public_jwk["kid"], int(name), private_key, public_jwk)
+        if not keys:
+            raise KeyRingError(f"no {self.alg} signing key in {self.key_dir}, run authhub-cli rotate-signing-key")
+
+        ordered = sorted(keys.values(), key=lambda key: key.created_at, reverse=True)
+        now = int(time.time())
+        published = [key for key in ordered if key.created_at + self.activation_delay <= now]
+        self._keys = keys
+        self._active = published[0] if published else ordered[-1]
+        self._jwks = dict(keys=[key.public_jwk for key in ordered])
+        LOGGER.info("signing keys loaded, active kid: %s", self._active.kid)
+
+    def _ensure_loaded(self):
+        if not self.asymmetric:
+            return
+        now = time.monotonic()
+        if self._active and now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.key_dir).st_mtime_ns
+            except OSError as error:
+                raise KeyRingError(f"signing key directory is not readable: {error}")
+            # the active key may change without a new file once its activation delay passes
+            if mtime != self._loaded_mtime or self._active is not self._newest_published():
+                self._load()
+                self._loaded_mtime = mtime
+
+    def _newest_published(self):
+        now = int(time.time())
+        published = [key for key in self._keys.values() if key.created_at + self.activation_delay <= now]
+        return max(published, key=lambda key: key.created_at) if published else self._active
+
+    def signing_key(self) -> SigningKey:
+        self._ensure_loaded()
+        return self._active
+
+    def verification_key(self, kid: str):
+        """
+        Public key of the kid, None if the key is unknown
+        """
+        self._ensure_loaded()
+        key = self._keys.get(kid)
+        return key.public_key if key else None
+
+    def jwks(self) -> dict:
+        self._ensure_loaded()
+        return self._jwks
+
+    def private_jwk(self) -> dict:
+        """
+        Active private key as a jwk, used by the id token of the OpenID Connect grants
+        """
+        key = self.signing_key()
+        jwk = json.loads(self.algorithm.to_jwk(key.private_key))
+        jwk.pop("key_ops", None)
+        jwk.update(kid=key.kid, alg=self.alg)
+        return jwk
+
+    def _generate(self):
+        from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+        if self.alg == "RS256":
+            return rsa.generate_private_key(public_exponent=65537, key_size=3072)
+        if self.alg == "ES256":
+            return ec.generate_private_key(ec.SECP256R1())
+        return ed25519.Ed25519PrivateKey.generate()
+
+    def _retention(self) -> int:
+        """
+        Seconds a key may still verify tokens after it was created: it signs until the next rotation has been
+        published, the last token it signed lives as long as a refresh token
+        """
+        token_lifetime = self.refresh_token_expires_in
+        if has_app_context():
+            token_lifetime = current_app.config.get("REFRESH_TOKEN_EXPIRES_IN") or token_lifetime
+        return self.rotation_interval + self.activation_delay + token_lifetime
+
+    def rotate(self) -> str:
+        """
+        Add a new key to the ring and remove the oldest keys beyond max_keys that can no longer verify a
+        valid token
+
+        Returns:
+            str: kid of the new key
+        """
+        from cryptography.hazmat.primitives import serialization
+
+        if not self.asymmetric:
+            raise KeyRingError("HS256 tokens are signed with the client secret, no key to rotate")
+        os.makedirs(self.key_dir, mode=0o700, exist_ok=True)
+        private_key = self._generate()
+        pem = private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        created_at = int(time.time())
+        path = os.path.join(self.key_dir, f"{created_at}.pem")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as key_file:
+            key_file.write(pem)
+
+        files = [os.path.splitext(file_name) for file_name in os.listdir(self.key_dir)]
+        created = sorted(int(name) for name, suffix in files if suffix == ".pem" and name.isdigit())
+        retention = self._retention()
+        retired = [timestamp for timestamp in created if timestamp + retention <= created_at]
+        for timestamp in retired[: max(len(created) - self.max_keys, 0)]:
+            os.remove(os.path.join(self.key_dir, f"{timestamp}.pem"))
+        return self._public_jwk(private_key)["kid"]
+
+
+key_ring = KeyRing(
+    alg=config_option("jwt", "algorithm", "HS256"),
+    key_dir=config_option("jwt", "key_dir", "/etc/aops/authhub/keys"),
+    max_keys=int(config_option("jwt", "max_keys", 3)),
+    activation_delay=int(config_option("jwt", "activation_delay", 3600)),
+    rotation_interval=int(config_option("jwt", "rotation_interval", 60 * 60 * 24 * 30)),
+)
@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import current_app
+from redis.exceptions import LockError, RedisError
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache, db
+from oauth2_provider.app.core.clients import client_registry
+from oauth2_provider.app.settings import config_option
+from oauth2_provider.database.table import LoginRecords, OAuth2Client
+
+# KEYS: the queue, the index of the batches being written and the list of a new batch, ARGV: the batch
+# size and the deadline of the batch. Moves up to a batch of records from the queue to the batch list.
+CLAIM_BATCH = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items == 0 then
+    return items
+end
+redis.call('LTRIM', KEYS[1], #items, -1)
+redis.call('RPUSH', KEYS[3], unpack(items))
+redis.call('ZADD', KEYS[2], ARGV[2], KEYS[3])
+return items
+"""
+
+# KEYS: the list of a batch, the queue and the index of the batches being written.
+# Moves the records of the batch back to the queue and drops the batch.
+REQUEUE_BATCH = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+if #items > 0 then
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[3], KEYS[1])
+return #items
+"""
+
+
+class LoginRecorder:
+    """
+    Record which applications a user has logged in, the logout callbacks are sent to them.
+
+    The (user, client) pairs already recorded are kept in a redis set per user. A pair seen for the first
+    time is pushed to a redis queue and written by a background thread of the worker in batches of
+    ``INSERT ... ON DUPLICATE KEY UPDATE``, so the request never waits for the database.
+
+    A batch is moved to a list of its own until it is committed, and moved back to the queue when the
+    write fails. The batch of a worker that died meanwhile is queued again once its lease passed. Batches
+    are written under a redis lock, which the logout takes as well to drop the records of the user.
+    """
+
+    key_prefix = "authhub:login-records:"
+    queue_key = "authhub:login-records-queue"
+    batch_prefix = "authhub:login-records-batch:"
+    batches_key = "authhub:login-records-batches"
+    lock_key = "authhub:login-records-lock"
+    separator = "\t"
+    # a pair forgotten by redis is queued once more, the upsert makes that harmless
+    record_ttl = 60 * 60 * 24 * 30
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 1, lease: int = 30):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lease = lease
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+        self._claim_script = None
+        self._requeue_script = None
+
+    def _key(self, username):
+        return self.key_prefix + username
+
+    def _row(self, username: str, client: OAuth2Client):
+        return dict(
+            username=username,
+            client_id=client.client_id,
+            logout_url=",".join(client.logout_callback_uris),
+            login_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        )
+
+    def _upsert(self, rows):
+        statement = insert(LoginRecords).values(rows)
+        statement = statement.on_duplicate_key_update(
+            login_time=statement.inserted.login_time, logout_url=statement.inserted.logout_url
+        )
+        db.session.execute(statement)
+        db.session.commit()
+
+    def save(self, username: str, client: OAuth2Client):
+        """
+        Write the login record synchronously
+        """
+        self._upsert([self._row(username, client)])
+        try:
+            cache.sadd(self._key(username), client.client_id)
+        except RedisError as error:
+            LOGGER.debug("Failed to cache login record of %s: %s", username, error)
+        LOGGER.info(f"Login records successfully: {username},client_id:{client.client_id}")
+
+    def record(self, username: str, client: OAuth2Client):
+        """
+        Record the login, only the first time a pair is seen it is queued for the database.
+        The record is written synchronously when redis is unavailable.
+        """
+        try:
+            pipeline = cache.pipeline(transaction=False)
+            pipeline.sadd(self._key(username), client.client_id)
+            pipeline.expire(self._key(username), self.record_ttl)
+            added, _ = pipeline.execute()
+            if not added:
+                return
+            cache.rpush(self.queue_key, username + self.separator + client.client_id)
+        except RedisError as error:
+            LOGGER.warning("Failed to queue login record, write it directly: %s", error)
+            self.save(username, client)
+            return
+        self._ensure_flusher()
+
+    def recorded(self, username: str, client_id: str = None) -> bool:
+        """
+        Whether the user has logged in an application, client_id when it is given. The pairs still queued
+        for the database are found in redis.
+        """
+        try:
+            if client_id is None:
+                if cache.scard(self._key(username)):
+                    return True
+            elif cache.sismember(self._key(username), client_id):
+                return True
+        except RedisError as error:
+            LOGGER.debug("Failed to read login records cache of %s: %s", username, error)
+        query = LoginRecords.query.filter_by(username=username)
+        if client_id is not None:
+            query = query.filter_by(client_id=client_id)
+        return db.session.query(query.exists()).scalar()
+
+    def client_ids(self, username: str) -> set:
+        """
+        Clients of the pairs recorded in redis, the queued ones included
+
+        :return: set of client ids, empty when redis is unavailable
+        """
+        try:
+            return set(cache.smembers(self._key(username)))
+        except RedisError as error:
+            LOGGER.debug("Failed to read login records cache of %s: %s", username, error)
+            return set()
+
+    def _delete_rows(self, username: str):
+        db.session.query(LoginRecords).filter_by(username=username).delete(synchronize_session=False)
+        db.session.commit()
+
+    def forget(self, username: str):
+        """
+        Delete the login records of the user, called on logout. The recorded pairs and the records queued or
+        in a batch are dropped under the flush lock, a batch written meanwhile cannot bring the rows back.
+        Only the rows are deleted when redis is unavailable.
+        """
+        try:
+            with self._flush_lock(blocking_timeout=self.lease):
+                items = [username + self.separator + client_id for client_id in cache.smembers(self._key(username))]
+                batches = cache.zrange(self.batches_key, 0, -1) if items else []
+                pipeline = cache.pipeline(transaction=False)
+                for key in [self.queue_key, *batches]:
+                    for item in items:
+                        pipeline.lrem(key, 0, item)
+                pipeline.delete(self._key(username))
+                pipeline.execute()
+                self._delete_rows(username)
+                return
+        except RedisError as error:
+            LOGGER.error("Failed to delete login records cache of %s: %s", username, error)
+        self._delete_rows(username)
+
+    def discard(self, pairs):
+        """
+        Drop purged (username, client_id) pairs from the recorded sets, the next login records them again
+        """
+        try:
+            pipeline = cache.pipeline(transaction=False)
+            for username, client_id in pairs:
+                pipeline.srem(self._key(username), client_id)
+            pipeline.execute()
+        except RedisError as error:
+            LOGGER.warning("Failed to discard purged login records: %s", error)
+
+    def _ensure_flusher(self):
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                application = current_app._get_current_object()
+                threading.Thread(
+                    target=self._run_flusher, args=(application,), name="authhub-login-records", daemon=True
+                ).start()
+
+    def _flush_lock(self, blocking_timeout=None):
+        return cache.lock(self.lock_key, timeout=self.lease, blocking_timeout=blocking_timeout, thread_local=False)
+
+    def _register_scripts(self):
+        if self._claim_script is None:
+            self._claim_script = cache.register_script(CLAIM_BATCH)
+            self._requeue_script = cache.register_script(REQUEUE_BATCH)
+
+    def _requeue(self, batch_key):
+        return self._requeue_script(keys=[batch_key, self.queue_key, self.batches_key])
+
+    def _recover(self):
+        for batch_key in cache.zrangebyscore(self.batches_key, "-inf", time.time()):
+            requeued = self._requeue(batch_key)
+            LOGGER.warning("Login records batch %s was not written in time, %s records requeued", batch_key, requeued)
+
+    def flush(self) -> int:
+        """
+        Write one batch of the queued login records, unless another worker is writing one
+
+        :return: number of queued records taken from the queue
+        """
+        self._register_scripts()
+        lock = self._flush_lock()
+        if not lock.acquire(blocking=False):
+            return 0
+        try:
+            self._recover()
+            return self._flush_batch()
+        finally:
+            try:
+                lock.release()
+            except LockError as error:
+                LOGGER.warning("The login records lock expired during the flush: %s", error)
+
+    def _flush_batch(self) -> int:
+        batch_key = self.batch_prefix + uuid.uuid4().hex
+        items = self._claim_script(
+            keys=[self.queue_key, self.batches_key, batch_key], args=[self.batch_size, time.time() + self.lease]
+        )
+        if not items:
+            return 0
+        pairs = [item.split(self.separator, 1) for item in items]
+        try:
+            clients = client_registry.get_many([client_id for _, client_id in pairs])
+            rows = dict()
+            for username, client_id in pairs:
+                if client_id in clients:
+                    rows[(username, client_id)] = self._row(username, clients[client_id])
+            if rows:
+                self._upsert(list(rows.values()))
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            LOGGER.error("Failed to write login records, requeue them: %s", error)
+            self._requeue(batch_key)
+            raise
+        pipeline = cache.pipeline(transaction=False)
+        pipeline.delete(batch_key)
+        pipeline.zrem(self.batches_key, batch_key)
+        pipeline.execute()
+        LOGGER.debug("Login records written: %s", len(rows))
+        return len(items)
+
+    def _run_flusher(self, application):
+        while True:
+            with application.app_context():
+                try:
+                    while self.flush() >= self.batch_size:
+                        pass
+                except (RedisError, SQLAlchemyError) as error:
+                    LOGGER.warning("Login records flush failed: %s", error)
+            time.sleep(self.flush_interval)
+
+
+login_recorder = LoginRecorder(
+    batch_size=int(config_option("login_records", "batch_size", 200)),
+    flush_interval=float(config_option("login_records", "flush_interval", 1)),
+    lease=int(config_option("login_records", "lease", 30)),
+)
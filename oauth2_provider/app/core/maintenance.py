@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+from redis.exceptions import LockError, RedisError
+from sqlalchemy import and_, case, exists, func, or_
+from sqlalchemy.exc import SQLAlchemyError
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache, db
+from oauth2_provider.app.core.codes import AUTHORIZATION_CODE_EXPIRES_IN
+from oauth2_provider.app.core.login_records import login_recorder
+from oauth2_provider.app.settings import config_option
+from oauth2_provider.database.table import (
+    LoginRecords,
+    OAuth2AuthorizationCode,
+    OAuth2ClientScopes,
+    OAuth2Token,
+    SessionGeneration,
+    WebhookOutbox,
+)
+
+
+class LeadershipLost(Exception):
+    """
+    Raised when the reaper lock expired or was taken over by another node during a run
+    """
+
+
+class Reaper:
+    """
+    Purge the rows that can no longer be used: expired authorization codes, tokens whose access and refresh
+    tokens both expired or whose session generation was revoked, expired consents, login records of users
+    without a live token for the client and delivered webhooks.
+
+    Every table is walked by primary key and purged in chunks of chunk_size rows, each chunk is its own short
+    transaction and the deletes are throttled to rows_per_second, so the purge never holds many row locks.
+    Only the node holding the redis lock runs a pass, and a pass is skipped when another node ran one
+    during the last interval.
+    """
+
+    lock_key = "authhub:maintenance:lock"
+    stats_key = "authhub:maintenance:stats"
+    # the lock is renewed after every chunk, it expires soon after its holder dies
+    lock_timeout = 300
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        interval: int = 3600,
+        chunk_size: int = 500,
+        rows_per_second: int = 2000,
+        grace: int = 3600,
+        login_records_retention: int = 60 * 60 * 24 * 30,
+        webhook_retention: int = 60 * 60 * 24 * 7,
+    ):
+        self.enabled = enabled
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.rows_per_second = rows_per_second
+        self.grace = grace
+        self.login_records_retention = login_records_retention
+        self.webhook_retention = webhook_retention
+        self._scheduler_pid = None
+        self._lock = threading.Lock()
+
+    def _expired_codes(self, cutoff):
+        return OAuth2AuthorizationCode.auth_time + AUTHORIZATION_CODE_EXPIRES_IN < cutoff
+
+    def _expired_tokens(self, cutoff):
+        refresh_expires_in = case(
+            (OAuth2Token.refresh_token_expires_in > 0, OAuth2Token.refresh_token_expires_in),
+            else_=current_app.config.get("REFRESH_TOKEN_EXPIRES_IN"),
+        )
+        lifetime = case(
+            (OAuth2Token.refresh_token.is_(None), OAuth2Token.expires_in),
+            else_=func.greatest(OAuth2Token.expires_in, refresh_expires_in),
+        )
+        # a token without expires_in never expires
+        return and_(OAuth2Token.expires_in > 0, OAuth2Token.issued_at + lifetime < cutoff)
+
+    def _superseded_tokens(self):
+        return exists().where(
+            SessionGeneration.username == OAuth2Token.username,
+            or_(
+                and_(SessionGeneration.client_id == "", SessionGeneration.generation > OAuth2Token.user_generation),
+                and_(
+                    SessionGeneration.client_id == OAuth2Token.client_id,
+                    SessionGeneration.generation > OAuth2Token.client_generation,
+                ),
+            ),
+        )
+
+    def _expired_consents(self, cutoff):
+        return and_(
+            OAuth2ClientScopes.expires_in > 0, OAuth2ClientScopes.grant_at + OAuth2ClientScopes.expires_in < cutoff
+        )
+
+    def _stale_login_records(self, cutoff):
+        login_time = datetime.fromtimestamp(cutoff - self.login_records_retention).strftime("%Y-%m-%d %H:%M:%S")
+        live_token = exists().where(
+            OAuth2Token.username == LoginRecords.username, OAuth2Token.client_id == LoginRecords.client_id
+        )
+        return and_(or_(LoginRecords.login_time.is_(None), LoginRecords.login_time < login_time), ~live_token)
+
+    def _delivered_webhooks(self, cutoff):
+        return and_(WebhookOutbox.status == "delivered", WebhookOutbox.delivered_at < cutoff - self.webhook_retention)
+
+    def _throttle(self, deleted, started):
+        if not self.rows_per_second:
+            return
+        delay = deleted / self.rows_per_second - (time.monotonic() - started)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _renew(self, lock):
+        if lock is None:
+            return
+        try:
+            lock.reacquire()
+        except (LockError, RedisError) as error:
+            raise LeadershipLost(str(error))
+
+    def _purge(self, model, condition, lock=None, columns=()) -> int:
+        """
+        Delete the rows matching condition in chunks walked by primary key
+
+        :return: number of rows deleted
+        """
+        purged, last_id = 0, 0
+        while True:
+            started = time.monotonic()
+            rows = (
+                db.session.query(model.id, *columns)
+                .filter(model.id > last_id, condition)
+                .order_by(model.id)
+                .limit(self.chunk_size)
+                .all()
+            )
+            if not rows:
+                db.session.commit()
+                return purged
+            last_id = rows[-1].id
+            deleted = (
+                db.session.query(model)
+                .filter(model.id.in_([row.id for row in rows]), condition)
+                .delete(synchronize_session=False)
+            )
+            db.session.commit()
+            if model is LoginRecords:
+                login_recorder.discard([(row.username, row.client_id) for row in rows])
+            purged += deleted
+            self._throttle(deleted, started)
+            self._renew(lock)
+
+    def run(self, lock=None) -> dict:
+        """
+        Purge every table once
+
+        :return: dict of table name to number of rows deleted
+        """
+        cutoff = int(time.time()) - self.grace
+        tasks = (
+            (OAuth2AuthorizationCode, self._expired_codes(cutoff), ()),
+            (OAuth2Token, or_(self._expired_tokens(cutoff), self._superseded_tokens()), ()),
+            (OAuth2ClientScopes, self._expired_consents(cutoff), ()),
+            (LoginRecords, self._stale_login_records(cutoff), (LoginRecords.username, LoginRecords.client_id)),
+            (WebhookOutbox, self._delivered_webhooks(cutoff), ()),
+        )
+        purged = dict()
+        for model, condition, columns in tasks:
+            purged[model.__tablename__] = self._purge(model, condition, lock, columns)
+        self._record(purged)
+        LOGGER.info("expired rows purged: %s", purged)
+        return purged
+
+    def _record(self, purged):
+        try:
+            pipeline = cache.pipeline(transaction=False)
+            for table, rows in purged.items():
+                pipeline.hincrby(self.stats_key, f"purged:{table}", rows)
+            pipeline.hincrby(self.stats_key, "runs", 1)
+            pipeline.hset(self.stats_key, "last_run", int(time.time()))
+            pipeline.execute()
+        except RedisError as error:
+            LOGGER.warning("Failed to record maintenance stats: %s", error)
+
+    def stats(self) -> dict:
+        """
+        Rows purged per table, number of runs and the time of the last run
+        """
+        return {name: int(value) for name, value in (cache.hgetall(self.stats_key) or dict()).items()}
+
+    def run_as_leader(self):
+        """
+        Run one pass if no other node holds the reaper lock
+
+        :return: the purged rows, None if another node is the leader
+        """
+        lock = cache.lock(self.lock_key, timeout=self.lock_timeout, thread_local=False)
+        if not lock.acquire(blocking=False):
+            return None
+        try:
+            # the schedulers of the nodes are not aligned, the pass runs once per interval across them
+            last_run = int(cache.hget(self.stats_key, "last_run") or 0)
+            if time.time() - last_run < self.interval * 0.9:
+                return None
+            return self.run(lock)
+        except LeadershipLost as error:
+            LOGGER.warning("Maintenance stopped, the reaper lock was lost: %s", error)
+            return None
+        finally:
+            try:
+                lock.release()
+            except (LockError, RedisError):
+                pass
+
+    def ensure_started(self):
+        """
+        Start the scheduler thread of the worker, called before every request
+        """
+        if not self.enabled or self._scheduler_pid == os.getpid():
+            return
+        with self._lock:
+            if self._scheduler_pid != os.getpid():
+                self._scheduler_pid = os.getpid()
+                application = current_app._get_current_object()
+                threading.Thread(
+                    target=self._run_scheduler, args=(application,), name="authhub-maintenance", daemon=True
+                ).start()
+
+    def _run_scheduler(self, application):
+        while True:
+            time.sleep(self.interval)
+            with application.app_context():
+                try:
+                    self.run_as_leader()
+                except (RedisError, SQLAlchemyError) as error:
+                    db.session.rollback()
+                    LOGGER.error("Maintenance failed: %s", error)
+
+
+reaper = Reaper(
+    enabled=bool(config_option("maintenance", "enabled", True)),
+    interval=int(config_option("maintenance", "interval", 3600)),
+    chunk_size=int(config_option("maintenance", "chunk_size", 500)),
+    rows_per_second=int(config_option("maintenance", "rows_per_second", 2000)),
+    grace=int(config_option("maintenance", "grace", 3600)),
+    login_records_retention=int(config_option("maintenance", "login_records_retention", 60 * 60 * 24 * 30)),
+    webhook_retention=int(config_option("maintenance", "webhook_retention", 60 * 60 * 24 * 7)),
+)
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import request
+from sqlalchemy import event
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache
+from oauth2_provider.app.settings import config_option
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Metrics:
+    """
+    Prometheus metrics of the worker: latency of every endpoint, database queries and redis round trips of
+    every request, JWT signing and verification, database pool checkout wait and logout callbacks.
+
+    uwsgi serves the requests with several worker processes, so prometheus_client runs in multiprocess mode:
+    every worker writes its samples to files of multiproc_dir and /metrics adds up the files of all the
+    workers. Nothing is recorded when prometheus_client is not installed or the metrics are disabled.
+    """
+
+    def __init__(self, enabled: bool = True, multiproc_dir: str = None):
+        self.enabled = enabled
+        self.multiproc_dir = multiproc_dir
+        # metric name -> prometheus metric, None until setup
+        self._metrics = None
+        self._registry = None
+        self._redis_instrumented = False
+        self._state = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self._metrics is not None
+
+    def _prepare_directory(self):
+        """
+        Remove the files of the processes no longer running, e.g. the workers of the previous start
+        """
+        os.makedirs(self.multiproc_dir, exist_ok=True)
+        for name in os.listdir(self.multiproc_dir):
+            try:
+                pid = int(name[: -len(".db")].rsplit("_", 1)[1])
+                os.kill(pid, 0)
+            except (IndexError, ValueError):
+                continue
+            except ProcessLookupError:
+                os.remove(os.path.join(self.multiproc_dir, name))
+            except PermissionError:
+                continue
+
+    def setup(self):
+        """
+        Create the metrics once per process, prometheus_client reads PROMETHEUS_MULTIPROC_DIR when it is
+        imported so it is only imported here
+        """
+        with self._lock:
+            if self._metrics is not None or not self.enabled:
+                return
+            if self.multiproc_dir:
+                try:
+                    self._prepare_directory()
+                except OSError as error:
+                    LOGGER.warning("Metrics disabled, %s is not usable: %s", self.multiproc_dir, error)
+                    return
+                os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", self.multiproc_dir)
+            try:
+                from prometheus_client import REGISTRY, Histogram
+            except ImportError:
+                LOGGER.info("Metrics disabled, prometheus_client is not installed")
+                return
+            self._registry = REGISTRY
+            self._metrics = dict(
+                request=Histogram(
+                    "authhub_http_request_duration_seconds",
+                    "Latency of the requests",
+                    ["endpoint", "method", "status"],
+                    buckets=LATENCY_BUCKETS,
+                ),
+                request_queries=Histogram(
+                    "authhub_db_queries_per_request",
+                    "Database queries of a request",
+                    ["endpoint"],
+                    buckets=COUNT_BUCKETS,
+                ),
+                request_db_time=Histogram(
+                    "authhub_db_seconds_per_request",
+                    "Seconds a request spent in database queries",
+                    ["endpoint"],
+                    buckets=LATENCY_BUCKETS,
+                ),
+                request_redis=Histogram(
+                    "authhub_redis_round_trips_per_request",
+                    "Redis round trips of a request",
+                    ["endpoint"],
+                    buckets=COUNT_BUCKETS,
+                ),
+                query=Histogram(
+                    "authhub_db_query_duration_seconds", "Latency of the database queries", buckets=LATENCY_BUCKETS
+                ),
+                pool_wait=Histogram(
+                    "authhub_db_pool_checkout_seconds",
+                    "Seconds waited for a connection of the database pool",
+                    buckets=LATENCY_BUCKETS,
+                ),
+                redis=Histogram(
+                    "authhub_redis_command_duration_seconds",
+                    "Latency of the redis round trips, a pipeline is one round trip",
+                    ["command"],
+                    buckets=LATENCY_BUCKETS,
+                ),
+                jwt=Histogram(
+                    "authhub_jwt_duration_seconds",
+                    "Latency of JWT signing and verification",
+                    ["operation"],
+                    buckets=LATENCY_BUCKETS,
+                ),
+                callback=Histogram(
+                    "authhub_callback_duration_seconds",
+                    "Latency of the logout callbacks of the clients",
+                    ["outcome"],
+                    buckets=LATENCY_BUCKETS,
+                ),
+            )
+
+    def init_app(self, application, engine):
+        """
+        Time the requests of the application, the queries of the engine and the redis commands of app.cache
+        """
+        self.setup()
+        if not self.active:
+            return
+        application.before_request(self._before_request)
+        application.after_request(self._after_request)
+        application.teardown_request(self._teardown_request)
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        with self._lock:
+            if not self._redis_instrumented:
+                self._redis_instrumented = True
+                cache.instrument(self.instrument_redis)
+
+    def observe(self, name: str, seconds: float, *labels):
+        if self._metrics is None:
+            return
+        metric = self._metrics[name]
+        (metric.labels(*labels) if labels else metric).observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, *labels)
+
+    def _before_request(self):
+        state = self._state
+        state.started = time.perf_counter()
+        state.status = 500
+        state.queries = 0
+        state.db_time = 0
+        state.redis = 0
+
+    def _after_request(self, response):
+        self._state.status = response.status_code
+        return response
+
+    def _teardown_request(self, error=None):
+        state = self._state
+        started, state.started = getattr(state, "started", None), None
+        if started is None:
+            return
+        endpoint = request.endpoint or "unmatched"
+        self.observe("request", time.perf_counter() - started, endpoint, request.method, str(state.status))
+        self.observe("request_queries", state.queries, endpoint)
+        self.observe("request_db_time", state.db_time, endpoint)
+        self.observe("request_redis", state.redis, endpoint)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("authhub_query_started", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["authhub_query_started"].pop()
+        self.observe("query", elapsed)
+        state = self._state
+        if getattr(state, "started", None) is not None:
+            state.queries += 1
+            state.db_time += elapsed
+
+    def _round_trip(self, command, started):
+        self.observe("redis", time.perf_counter() - started, command)
+        if getattr(self._state, "started", None) is not None:
+            self._state.redis += 1
+
+    def instrument_redis(self, client):
+        """
+        Time every command and pipeline sent by the client, the methods of the client instance are wrapped
+        """
+        execute_command, pipeline = client.execute_command, client.pipeline
+
+        def timed_execute_command(*args, **options):
+            started = time.perf_counter()
+            try:
+                return execute_command(*args, **options)
+            finally:
+                self._round_trip(str(args[0]).upper() if args else "UNKNOWN", started)
+
+        def timed_pipeline(*args, **kwargs):
+            instance = pipeline(*args, **kwargs)
+            execute = instance.execute
+
+            def timed_execute(*execute_args, **execute_kwargs):
+                started = time.perf_counter()
+                try:
+                    return execute(*execute_args, **execute_kwargs)
+                finally:
+                    self._round_trip("PIPELINE", started)
+
+            instance.execute = timed_execute
+            return instance
+
+        client.execute_command = timed_execute_command
+        client.pipeline = timed_pipeline
+
+    def render(self):
+        """
+        The samples of all the workers in the Prometheus text format
+
+        :return: (body, content type)
+        """
+        from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+
+        registry = self._registry
+        if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            from prometheus_client import multiprocess
+
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+metrics = Metrics(
+    enabled=bool(config_option("metrics", "enabled", True)),
+    multiproc_dir=config_option("metrics", "multiproc_dir", "/run/authhub/metrics"),
+)
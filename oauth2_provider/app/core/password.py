@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from vulcanus.log.log import LOGGER
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from oauth2_provider.app.settings import config_option
+
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+
+ALGORITHMS = ("pbkdf2", "scrypt", "argon2id")
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when the hashing pool has max_pending passwords waiting
+    """
+
+
+class PasswordHasher:
+    """
+    Hash and verify the passwords of the users and administrators.
+
+    pbkdf2 and scrypt hashes use the werkzeug format, argon2id hashes the PHC format of argon2-cffi, so the
+    hashes of every algorithm verify side by side. Hashing runs on a bounded thread pool of the worker: the
+    hash functions release the GIL, the other request threads keep serving while a burst of logins waits in
+    the pool, and the burst is refused once max_pending passwords are queued.
+    """
+
+    def __init__(
+        self,
+        algorithm: str = "pbkdf2",
+        pbkdf2_iterations: int = 260000,
+        scrypt_n: int = 32768,
+        scrypt_r: int = 8,
+        scrypt_p: int = 1,
+        argon2_time_cost: int = 3,
+        argon2_memory_cost: int = 65536,
+        argon2_parallelism: int = 4,
+        max_workers: int = 4,
+        max_pending: int = 64,
+        timeout: float = 10,
+    ):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"unsupported password hash algorithm {algorithm}")
+        if algorithm == "argon2id" and argon2 is None:
+            LOGGER.warning("argon2-cffi is not installed, hash the passwords with pbkdf2")
+            algorithm = "pbkdf2"
+        self.algorithm = algorithm
+        # werkzeug method of the pbkdf2 and scrypt hashes, it is the prefix of the hashes it makes
+        self.method = f"pbkdf2:sha256:{pbkdf2_iterations}"
+        if algorithm == "scrypt":
+            self.method = f"scrypt:{scrypt_n}:{scrypt_r}:{scrypt_p}"
+        self._argon2 = None
+        if argon2 is not None:
+            self._argon2 = argon2.PasswordHasher(
+                time_cost=argon2_time_cost,
+                memory_cost=argon2_memory_cost,
+                parallelism=argon2_parallelism,
+                type=argon2.Type.ID,
+            )
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pid = None
+        self._executor = None
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def _hash(self, password: str) -> str:
+        if self.algorithm == "argon2id":
+            return self._argon2.hash(password)
+        return generate_password_hash(password, method=self.method)
+
+    def _verify(self, stored: str, password: str) -> bool:
+        if stored.startswith("$argon2"):
+            if self._argon2 is None:
+                LOGGER.error("argon2 password hash found but argon2-cffi is not installed")
+                return False
+            try:
+                return self._argon2.verify(stored, password)
+            except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+                return False
+        return check_password_hash(stored, password)
+
+    def _ensure_pool(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="authhub-hasher")
+                self._pending = threading.BoundedSemaphore(self.max_pending)
+                self._pid = os.getpid()
+
+    def _run(self, func, *args):
+        if not self.max_workers:
+            return func(*args)
+        self._ensure_pool()
+        pending = self._pending
+        if not pending.acquire(blocking=False):
+            raise PasswordHasherBusy("too many passwords waiting to be hashed")
+        future = self._executor.submit(func, *args)
+        # the slot is freed when the hash is done, even if the caller stopped waiting for it
+        future.add_done_callback(lambda _: pending.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise PasswordHasherBusy("password hashing timed out")
+
+    def hash(self, password: str) -> str:
+        return self._run(self._hash, password)
+
+    def verify(self, stored: str, password: str) -> bool:
+        if not stored or password is None:
+            return False
+        return self._run(self._verify, stored, password)
+
+    def needs_rehash(self, stored: str) -> bool:
+        """
+        Whether the hash was made by another algorithm or with other parameters than the configured ones
+        """
+        if stored.startswith("$argon2"):
+            return self.algorithm != "argon2id" or self._argon2.check_needs_rehash(stored)
+        if self.algorithm == "argon2id":
+            return True
+        return stored.split("$", 1)[0] != self.method
+
+    def verify_and_update(self, account, password: str) -> bool:
+        """
+        Verify the password of a User or ManageUser, a valid password hashed with outdated parameters is
+        hashed again and set on the account, the caller commits it
+
+        Returns:
+            bool: whether the password is valid
+        """
+        if not self.verify(account.password, password):
+            return False
+        if self.needs_rehash(account.password):
+            try:
+                account.password = self.hash(password)
+                LOGGER.info("password hash of %s upgraded to %s", account.username, self.algorithm)
+            except PasswordHasherBusy as error:
+                LOGGER.warning("Failed to upgrade the password hash of %s: %s", account.username, error)
+        return True
+
+
+password_hasher = PasswordHasher(
+    algorithm=config_option("password", "algorithm", "pbkdf2"),
+    pbkdf2_iterations=int(config_option("password", "pbkdf2_iterations", 260000)),
+    scrypt_n=int(config_option("password", "scrypt_n", 32768)),
+    scrypt_r=int(config_option("password", "scrypt_r", 8)),
+    scrypt_p=int(config_option("password", "scrypt_p", 1)),
+    argon2_time_cost=int(config_option("password", "argon2_time_cost", 3)),
+    argon2_memory_cost=int(config_option("password", "argon2_memory_cost", 65536)),
+    argon2_parallelism=int(config_option("password", "argon2_parallelism", 4)),
+    max_workers=int(config_option("password", "max_workers", 4)),
+    max_pending=int(config_option("password", "max_pending", 64)),
+    timeout=float(config_option("password", "timeout", 10)),
+)
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import json
+import os
+import socket
+import threading
+import time
+
+from redis.exceptions import RedisError
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache
+from oauth2_provider.app.core.metrics import metrics
+
+
+class PoolMonitor:
+    """
+    Saturation of the database connection pool of every worker.
+
+    The pool of the worker is checked on every checkout, the peak of the connections in use and the checkouts
+    that had to open an overflow connection are counted. A snapshot of each worker is written to a redis hash
+    at most every flush_interval seconds, the hash expires when no worker writes it any more.
+
+    A connection opened by another process, e.g. the master that forked the worker, is invalidated on
+    checkout and the pool opens a new one, in case the worker was forked without the postfork hook.
+    """
+
+    stats_key = "authhub:pool-stats"
+    flush_interval = 10
+    stats_ttl = 300
+
+    def __init__(self):
+        self._engine = None
+        self._pid = os.getpid()
+        self._peak = 0
+        self._overflow_checkouts = 0
+        self._flushed_at = 0
+        self._lock = threading.Lock()
+        self._postfork_registered = False
+
+    def attach(self, engine):
+        """
+        Monitor the pool of the engine, the listeners are added once per engine
+        """
+        with self._lock:
+            self._engine = engine
+            if event.contains(engine, "checkout", self._on_checkout):
+                return
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+
+    def status(self) -> dict:
+        pool = self._engine.pool
+        size, checked_out, overflow = pool.size(), pool.checkedout(), max(pool.overflow(), 0)
+        capacity = size + max(getattr(pool, "_max_overflow", 0), 0)
+        return dict(
+            size=size,
+            capacity=capacity,
+            checked_out=checked_out,
+            overflow=overflow,
+            peak=self._peak,
+            overflow_checkouts=self._overflow_checkouts,
+            saturation=round(checked_out / capacity, 4) if capacity else 0,
+            updated_at=int(time.time()),
+        )
+
+    @staticmethod
+    def _on_connect(dbapi_connection, connection_record):
+        connection_record.info["pid"] = os.getpid()
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._reset_counters()
+        if connection_record.info.get("pid", pid) != pid:
+            connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+            raise exc.DisconnectionError(f"connection of process {connection_record.info['pid']} checked out in {pid}")
+        pool = self._engine.pool
+        checked_out = pool.checkedout()
+        with self._lock:
+            self._peak = max(self._peak, checked_out)
+            if pool.overflow() > 0:
+                self._overflow_checkouts += 1
+            if time.monotonic() - self._flushed_at < self.flush_interval:
+                return
+            self._flushed_at = time.monotonic()
+        self.flush()
+
+    def flush(self):
+        try:
+            pipeline = cache.pipeline(transaction=False)
+            pipeline.hset(self.stats_key, f"{socket.gethostname()}:{os.getpid()}", json.dumps(self.status()))
+            pipeline.expire(self.stats_key, self.stats_ttl)
+            pipeline.execute()
+        except RedisError as error:
+            LOGGER.debug("Failed to flush pool stats: %s", error)
+
+    def stats(self) -> dict:
+        """
+        Last snapshot of every worker, the workers that stopped reporting are left out
+        """
+        now = int(time.time())
+        snapshots = dict()
+        for worker, value in (cache.hgetall(self.stats_key) or dict()).items():
+            snapshot = json.loads(value)
+            if now - snapshot["updated_at"] <= self.stats_ttl:
+                snapshots[worker] = snapshot
+        return snapshots
+
+    def _reset_counters(self):
+        # another thread of the parent may have held the lock when it forked
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._peak = 0
+        self._overflow_checkouts = 0
+        self._flushed_at = 0
+
+    def reset_after_fork(self):
+        """
+        Drop the connections inherited from the parent process, the worker opens its own on first use
+        """
+        self._reset_counters()
+        if self._engine is not None:
+            self._engine.dispose(close=False)
+
+    def register_postfork(self):
+        """
+        Reset the pool in every worker forked from the process, once however many applications are created.
+        uWSGI forks its workers without os.fork, its postfork hook is used when the application runs in it.
+        """
+        with self._lock:
+            if self._postfork_registered:
+                return
+            self._postfork_registered = True
+        try:
+            from uwsgidecorators import postfork
+        except ImportError:
+            os.register_at_fork(after_in_child=self.reset_after_fork)
+        else:
+            postfork(self.reset_after_fork)
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool reporting how long every checkout waited for a connection, the pre ping included
+    """
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            metrics.observe("pool_wait", time.perf_counter() - started)
+
+
+pool_monitor = PoolMonitor()
+
+
+def register_postfork():
+    """
+    Reset the database pool in every worker forked from the master that imported the application.
+    The redis connection pool checks the pid itself and reconnects after a fork.
+    """
+    pool_monitor.register_postfork()
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import request
+from sqlalchemy import event
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app.settings import config_option
+
+
+class QueryRecorder:
+    """
+    Statements executed while the recorder is active, a statement is the SQL text with its placeholders so
+    the same query with other parameters counts as a repetition
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0
+        self.statements = Counter()
+        self.slow = 0
+
+    def repeated(self, threshold: int) -> list:
+        """
+        :return: list of (statement, executions) executed at least threshold times, most repeated first
+        """
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+
+class QueryProfiler:
+    """
+    Opt-in SQL profiling of every request, for debugging only.
+
+    The queries of the engine are counted per request with SQLAlchemy cursor events. When the request ends,
+    a statement executed repeated_statements times or more is logged as a suspected N+1 query. A statement
+    slower than slow_query_ms is logged with its EXPLAIN plan. The X-Authhub-Queries response header gives
+    the counts of the request.
+    """
+
+    header = "X-Authhub-Queries"
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        slow_query_ms: float = 100,
+        repeated_statements: int = 3,
+        explain: bool = True,
+        response_header: bool = True,
+    ):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.repeated_statements = repeated_statements
+        self.explain = explain
+        self.response_header = response_header
+        self._engines = set()
+        self._state = threading.local()
+        self._lock = threading.Lock()
+
+    def _recorders(self) -> list:
+        recorders = getattr(self._state, "recorders", None)
+        if recorders is None:
+            recorders = self._state.recorders = []
+        return recorders
+
+    def attach(self, engine):
+        """
+        Listen to the queries of the engine, once per engine
+        """
+        with self._lock:
+            if engine in self._engines:
+                return
+            self._engines.add(engine)
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def init_app(self, application, engine):
+        if not application.config.get("SQL_PROFILING", self.enabled):
+            return
+        self.attach(engine)
+        application.before_request(self._before_request)
+        application.after_request(self._after_request)
+        application.teardown_request(self._teardown_request)
+        LOGGER.warning("SQL profiling is enabled, every request is instrumented")
+
+    @contextmanager
+    def record(self):
+        """
+        Record the queries the current thread executes in the block, the engines must be attached
+
+        Yields:
+            QueryRecorder
+        """
+        recorder = QueryRecorder()
+        recorders = self._recorders()
+        recorders.append(recorder)
+        try:
+            yield recorder
+        finally:
+            recorders.remove(recorder)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._recorders():
+            conn.info.setdefault("authhub_profile_started", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        recorders = self._recorders()
+        started = conn.info.get("authhub_profile_started")
+        if not recorders or not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        slow = elapsed * 1000 >= self.slow_query_ms
+        for recorder in recorders:
+            recorder.count += 1
+            recorder.elapsed += elapsed
+            recorder.statements[statement] += 1
+            recorder.slow += slow
+        if slow:
+            LOGGER.warning(
+                "Slow query %.1f ms: %s %s%s",
+                elapsed * 1000,
+                statement,
+                parameters,
+                self._explain(conn, statement, parameters) if self.explain and not executemany else "",
+            )
+
+    @staticmethod
+    def _explain(conn, statement, parameters) -> str:
+        if not statement.lstrip().upper().startswith("SELECT"):
+            return ""
+        prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as error:
+            return f"\n    EXPLAIN failed: {error}"
+        finally:
+            cursor.close()
+        return "".join(f"\n    {tuple(row)}" for row in rows)
+
+    def _before_request(self):
+        self._state.request_recorder = QueryRecorder()
+        self._recorders().append(self._state.request_recorder)
+
+    def _after_request(self, response):
+        recorder = getattr(self._state, "request_recorder", None)
+        if recorder is not None and self.response_header:
+            response.headers[self.header] = (
+                f"count={recorder.count}; repeated={len(recorder.repeated(self.repeated_statements))}; "
+                f"slow={recorder.slow}; db_ms={recorder.elapsed * 1000:.1f}"
+            )
+        return response
+
+    def _teardown_request(self, error=None):
+        recorder, self._state.request_recorder = getattr(self._state, "request_recorder", None), None
+        if recorder is None:
+            return
+        self._recorders().remove(recorder)
+        for statement, count in recorder.repeated(self.repeated_statements):
+            LOGGER.warning(
+                "Suspected N+1 query in %s %s, executed %s times: %s", request.method, request.path, count, statement
+            )
+
+
+query_profiler = QueryProfiler(
+    enabled=bool(config_option("sql_profiling", "enabled", False)),
+    slow_query_ms=float(config_option("sql_profiling", "slow_query_ms", 100)),
+    repeated_statements=int(config_option("sql_profiling", "repeated_statements", 3)),
+    explain=bool(config_option("sql_profiling", "explain", True)),
+    response_header=bool(config_option("sql_profiling", "response_header", True)),
+)
+
+
+@contextmanager
+def assert_query_budget(budget: int, engine=None):
+    """
+    Fail when the block executes more than budget queries, e.g. around a request of the test client::
+
+        with assert_query_budget(6):
+            client.post("/oauth2/login-status", json=dict(client_id=client_id), headers=headers)
+
+    Args:
+        budget: queries allowed
+        engine: engine of the queries, db.engine of the current application by default
+
+    Raises:
+        AssertionError: the budget is exceeded, the message lists the statements
+    """
+    if engine is None:
+        from oauth2_provider.app import db
+
+        engine = db.engine
+    query_profiler.attach(engine)
+    with query_profiler.record() as recorder:
+        yield recorder
+    if recorder.count > budget:
+        statements = "\n".join(f"  {count} x {statement}" for statement, count in recorder.statements.most_common())
+        raise AssertionError(f"{recorder.count} queries executed, the budget is {budget}:\n{statements}")
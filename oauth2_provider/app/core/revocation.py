@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import time
+
+from authlib.oauth2.rfc6749.errors import OAuth2Error
+from authlib.oauth2.rfc7009 import RevocationEndpoint as _RevocationEndpoint
+from flask import current_app
+from redis.exceptions import RedisError
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache, db
+from oauth2_provider.app.core.introspection import introspection_cache
+from oauth2_provider.app.core.revocation_filter import revocation_filter
+from oauth2_provider.database.table import OAuth2Token
+
+
+class RevocationUnavailableError(OAuth2Error):
+    """
+    The revocation could not be mirrored in redis, the token is left unrevoked so that the client retries
+    """
+
+    error = "temporarily_unavailable"
+    description = "The token revocation is temporarily unavailable"
+    status_code = 503
+
+
+class RevocationRegistry:
+    """
+    Access token digests that are revoked or deleted before they expire, mirrored in redis so that the
+    stateless introspection never has to load the token row. Each digest expires with its token.
+    The cached introspection result of the token is dropped in the same transaction. The revocations are also
+    streamed to the revocation filter of every worker, which answers most checks without redis.
+    """
+
+    key_prefix = introspection_cache.revoked_key_prefix
+    # the exp claim of the tokens minted before it was computed in epoch seconds is shifted by the
+    # timezone offset of the server, keep the digests a day longer than issued_at + expires_in
+    expiry_margin = 60 * 60 * 24
+    attempts = 3
+    retry_interval = 0.05
+
+    def _key(self, digest):
+        return self.key_prefix + digest
+
+    def _ttl(self, issued_at, expires_in, now):
+        expires_in = expires_in or current_app.config.get("TOKEN_EXPIRES_IN")
+        return (issued_at or now) + expires_in + self.expiry_margin - now
+
+    def _mark(self, tokens):
+        now = int(time.time())
+        marked = 0
+        pipeline = cache.pipeline()
+        for digest, client_id, issued_at, expires_in in tokens:
+            if not digest:
+                continue
+            pipeline.delete(introspection_cache.key(digest, client_id))
+            ttl = self._ttl(issued_at, expires_in, now)
+            if ttl > 0:
+                pipeline.set(self._key(digest), 1, ex=ttl)
+                revocation_filter.publish(pipeline, digest, now + ttl)
+                marked += 1
+        if len(pipeline):
+            pipeline.execute()
+        return marked
+
+    def revoke(self, tokens):
+        """
+        Mark access tokens as revoked, the pipeline is retried on a redis error. The marks have to be written
+        before the revocation is committed to the database: RedisError is raised once every attempt failed,
+        the caller then rolls back instead of revoking a token that stateless introspection still accepts
+
+        :param tokens: iterable of (access_token_digest, client_id, issued_at, expires_in)
+        :return: number of digests marked
+        """
+        tokens = list(tokens)
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return self._mark(tokens)
+            except RedisError as error:
+                if attempt == self.attempts:
+                    LOGGER.error("Failed to mark revoked tokens: %s", error)
+                    raise
+                LOGGER.warning("Failed to mark revoked tokens, attempt %s: %s", attempt, error)
+                time.sleep(self.retry_interval * attempt)
+
+    def revoke_token(self, token: OAuth2Token):
+        return self.revoke([(token.access_token_digest, token.client_id, token.issued_at, token.expires_in)])
+
+    def is_revoked(self, digest) -> bool:
+        """
+        Check whether the access token digest is revoked, RedisError is raised to the caller so that it can
+        fall back to the database
+        """
+        revoked = revocation_filter.check(digest)
+        if revoked is not None:
+            return revoked
+        return bool(cache.exists(self._key(digest)))
+
+    def revoked_many(self, digests) -> set:
+        """
+        The revoked digests among digests, the ones the revocation filter cannot answer are checked in one
+        round trip. RedisError is raised to the caller
+        """
+        revoked, unknown = set(), []
+        for digest in digests:
+            known = revocation_filter.check(digest)
+            if known is None:
+                unknown.append(digest)
+            elif known:
+                revoked.add(digest)
+        if not unknown:
+            return revoked
+        pipeline = cache.pipeline(transaction=False)
+        for digest in unknown:
+            pipeline.exists(self._key(digest))
+        return revoked | {digest for digest, exists in zip(unknown, pipeline.execute()) if exists}
+
+
+revocation_registry = RevocationRegistry()
+
+
+class RevocationEndpoint(_RevocationEndpoint):
+    """
+    Token revocation endpoint, tokens are looked up by their digest
+    """
+
+    def query_token(self, token_string, token_type_hint):
+        """
+        Query the token by the access token or refresh token digest
+
+        :param token_string: access token or refresh token
+        :param token_type_hint: access_token, refresh_token or None
+        :return: token or None
+        """
+        digest = OAuth2Token.digest(token_string)
+        query = db.session.query(OAuth2Token)
+        if token_type_hint == "access_token":
+            return query.filter_by(access_token_digest=digest).first()
+        if token_type_hint == "refresh_token":
+            return query.filter_by(refresh_token_digest=digest).first()
+
+        token = query.filter_by(access_token_digest=digest).first()
+        if token:
+            return token
+        return query.filter_by(refresh_token_digest=digest).first()
+
+    def revoke_token(self, token, request):
+        now = int(time.time())
+        hint = request.form.get("token_type_hint")
+        token.access_token_revoked_at = now
+        if hint != "access_token":
+            token.refresh_token_revoked_at = now
+        # a refresh racing the revocation loses its conditional update
+        token.version = OAuth2Token.version + 1
+        db.session.add(token)
+        try:
+            revocation_registry.revoke_token(token)
+        except RedisError:
+            db.session.rollback()
+            raise RevocationUnavailableError()
+        db.session.commit()
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import math
+import os
+import threading
+import time
+
+from redis.exceptions import RedisError
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache
+from oauth2_provider.app.settings import config_option
+
+
+class BloomFilter:
+    """
+    Bloom filter of sha256 hex digests, the bit positions are taken from the digest itself by double hashing
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, digest: str):
+        first, second = int(digest[:16], 16), int(digest[16:32], 16) | 1
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def add(self, digest: str):
+        for position in self._positions(digest):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest: str) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+
+class RevocationFilter:
+    """
+    Revoked access token digests known to the worker, so that most "is it revoked" checks never leave the
+    process.
+
+    Every revocation is appended to a redis stream with the time its redis mark expires. Each worker reads
+    the stream from the start and then follows it with a blocking XREAD, adding the digests to Bloom filters
+    grouped by expiry day and to an exact dict of at most max_exact digests. A filter is dropped once all its
+    digests expired. A digest missing from the filters is not revoked; a digest in the filters that the exact
+    dict does not confirm, a Bloom false positive or a digest beyond max_exact, is checked in redis. The worker
+    answers nothing while it is catching up with the stream or has not heard from redis for stale_after
+    seconds, the callers ask redis then.
+    """
+
+    stream_key = "authhub:revoked:stream"
+    block_ms = 1000
+    batch_size = 1000
+    stale_after = 5
+    reconnect_interval = 1
+    expire_interval = 60
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        capacity: int = 100000,
+        error_rate: float = 0.001,
+        max_exact: int = 50000,
+        bucket_seconds: int = 60 * 60 * 24,
+        retention: int = 60 * 60 * 24 * 8,
+    ):
+        self.enabled = enabled
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.max_exact = max_exact
+        self.bucket_seconds = bucket_seconds
+        self.retention = retention
+        # expiry bucket -> Bloom filters of the digests expiring in it, a new filter is added when one is full
+        self._filters = dict()
+        # digest -> epoch seconds its revocation expires
+        self._exact = dict()
+        # monotonic time the stream was last read to its end, None while catching up or disconnected
+        self._synced_at = None
+        self._expired_at = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def synced(self) -> bool:
+        return self._synced_at is not None and time.monotonic() - self._synced_at < self.stale_after
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._filters, self._exact, self._synced_at = dict(), dict(), None
+                threading.Thread(target=self._listen, name="authhub-revocation-filter", daemon=True).start()
+
+    def _add(self, digest: str, expires_at: int):
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            filters = self._filters.setdefault(expires_at // self.bucket_seconds, [])
+            if not filters or filters[-1].full:
+                filters.append(BloomFilter(self.capacity, self.error_rate))
+            filters[-1].add(digest)
+            if len(self._exact) < self.max_exact:
+                self._exact[digest] = expires_at
+
+    def _expire(self):
+        now = int(time.time())
+        with self._lock:
+            for bucket in [bucket for bucket in self._filters if (bucket + 1) * self.bucket_seconds <= now]:
+                del self._filters[bucket]
+            self._exact = {digest: expires_at for digest, expires_at in self._exact.items() if expires_at > now}
+        self._expired_at = time.monotonic()
+
+    def publish(self, pipeline, digest: str, expires_at: int):
+        """
+        Append a revocation to the stream through the pipeline of the caller, the entries older than retention
+        are trimmed. The worker knows it at once, the others when they read the stream.
+        """
+        if not self.enabled:
+            return
+        pipeline.xadd(
+            self.stream_key,
+            dict(d=digest, e=expires_at),
+            minid=int((time.time() - self.retention) * 1000),
+            approximate=True,
+        )
+        if self._pid == os.getpid():
+            self._add(digest, expires_at)
+
+    def check(self, digest: str):
+        """
+        :return: False when the digest is not revoked, True when it is, None when redis must be asked
+        """
+        if not self.enabled:
+            return None
+        self._ensure_started()
+        if not self.synced:
+            return None
+        if not any(digest in bloom for filters in list(self._filters.values()) for bloom in filters):
+            return False
+        expires_at = self._exact.get(digest)
+        if expires_at is not None and expires_at > time.time():
+            return True
+        return None
+
+    def _read(self, last_id):
+        """
+        Add the entries of the stream after last_id, waiting block_ms for new ones
+
+        :return: id of the last entry read
+        """
+        entries = cache.xread({self.stream_key: last_id}, count=self.batch_size, block=self.block_ms)
+        messages = entries[0][1] if entries else []
+        for message_id, fields in messages:
+            self._add(fields["d"], int(fields["e"]))
+            last_id = message_id
+        if len(messages) < self.batch_size:
+            self._synced_at = time.monotonic()
+        return last_id
+
+    def _listen(self):
+        # the stream is persistent, a reconnect resumes after the last entry read
+        last_id = "0-0"
+        while True:
+            try:
+                while True:
+                    last_id = self._read(last_id)
+                    if time.monotonic() - self._expired_at >= self.expire_interval:
+                        self._expire()
+            except (RedisError, KeyError, ValueError) as error:
+                self._synced_at = None
+                LOGGER.warning("Revocation filter disconnected: %s", error)
+            time.sleep(self.reconnect_interval)
+
+
+revocation_filter = RevocationFilter(
+    enabled=bool(config_option("revocation_filter", "enabled", True)),
+    capacity=int(config_option("revocation_filter", "capacity", 100000)),
+    error_rate=float(config_option("revocation_filter", "error_rate", 0.001)),
+    max_exact=int(config_option("revocation_filter", "max_exact", 50000)),
+    retention=int(config_option("revocation_filter", "retention", 60 * 60 * 24 * 8)),
+)
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import time
+import uuid
+from typing import Tuple
+
+from authlib.common.encoding import json_dumps
+from redis.exceptions import RedisError
+from sqlalchemy import update
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import db
+from oauth2_provider.app.core.revocation import revocation_registry
+from oauth2_provider.app.core.token import ACCESS_TOKEN, jwt_token
+from oauth2_provider.database.table import OAuth2Client, OAuth2Token
+
+
+class TokenRotator:
+    """
+    Rotate and revoke oauth2 tokens with one conditional UPDATE each.
+
+    The UPDATE only matches the row while it still has the version the token was read with, and increments
+    the version. Of concurrent refreshes of one refresh token exactly one rotates the access token, the
+    others read the access token the winner issued and return it, instead of overwriting it.
+
+    The previous access token is marked revoked in redis before the UPDATE is committed, a RedisError rolls
+    the UPDATE back and is raised to the caller.
+    """
+
+    @staticmethod
+    def _previous(token: OAuth2Token):
+        # the row is expired by the commit, keep what the revocation registry needs of the old access token
+        return token.access_token_digest, token.client_id, token.issued_at, token.expires_in
+
+    def _conditional_update(self, token: OAuth2Token, **values) -> bool:
+        previous = self._previous(token)
+        statement = (
+            update(OAuth2Token)
+            .where(OAuth2Token.id == token.id, OAuth2Token.version == token.version)
+            .values(version=OAuth2Token.version + 1, **values)
+            .execution_options(synchronize_session=False)
+        )
+        try:
+            updated = db.session.execute(statement).rowcount == 1
+            if updated:
+                revocation_registry.revoke([previous])
+        except RedisError:
+            db.session.rollback()
+            raise
+        db.session.commit()
+        return updated
+
+    def rotate(self, token: OAuth2Token, client: OAuth2Client) -> Tuple[str, bool]:
+        """
+        Issue a new access token for the refresh token of the row
+
+        Args:
+            token: the token row, as read before the refresh was validated
+            client: the client of the token
+
+        Returns:
+            Tuple: [access token, True when this call rotated it], the access token is None when the row was
+            revoked or deleted meanwhile
+        """
+        access_token = jwt_token.generate_token(
+            secret=client.client_secret,
+            user=token.username,
+            scope=token.scope,
+            client=client.client_id,
+            expires_in=token.expires_in,
+            jti=uuid.uuid4().hex,
+            token_use=ACCESS_TOKEN,
+            ugen=token.user_generation,
+            cgen=token.client_generation,
+        )
+        metadata = dict(
+            token.token_metadata,
+            expires_in=token.expires_in,
+            account_token_exp=jwt_token.timedelta(token.expires_in),
+        )
+        token_id = token.id
+        if self._conditional_update(
+            token,
+            access_token=access_token,
+            access_token_digest=OAuth2Token.digest(access_token),
+            issued_at=int(time.time()),
+            _metadata=json_dumps(metadata),
+        ):
+            return access_token, True
+
+        current = (
+            db.session.query(OAuth2Token)
+            .filter(OAuth2Token.id == token_id)
+            .with_entities(
+                OAuth2Token.access_token, OAuth2Token.access_token_revoked_at, OAuth2Token.refresh_token_revoked_at
+            )
+            .one_or_none()
+        )
+        if not current or current.access_token_revoked_at or current.refresh_token_revoked_at:
+            return None, False
+        LOGGER.debug("Token %s was rotated by a concurrent refresh", token_id)
+        return current.access_token, False
+
+    def revoke(self, token: OAuth2Token) -> bool:
+        """
+        Revoke the access and refresh token of the row unless it changed since it was read
+
+        Returns:
+            bool: False when a concurrent rotation or revocation updated the row first
+        """
+        now = int(time.time())
+        return self._conditional_update(token, access_token_revoked_at=now, refresh_token_revoked_at=now)
+
+
+token_rotator = TokenRotator()
@@ -62,23 +62,25 @@ class AuthorizationServer(AuthlibAuthorizationServer):
         if not scope:
             return
 
+        # the supported scopes depend on the request, they are kept local since the server is shared by the
+        # threads of the worker
         try:
             if request.client.skip_authorization:
-                self.scopes_supported = scope_to_list(request.client.scope)
+                scopes_supported = scope_to_list(request.client.scope)
             else:
                 oauth2_client_scopes = OAuth2ClientScopes.query.filter_by(
                     username=request.user, client_id=request.client_id
                 ).one_or_none()
 
                 if oauth2_client_scopes:
-                    self.scopes_supported = scope_to_list(oauth2_client_scopes.scope)
+                    scopes_supported = scope_to_list(oauth2_client_scopes.scope)
                 else:
-                    self.scopes_supported = scope_to_list(request.client.scope)
+                    scopes_supported = scope_to_list(request.client.scope)
         except SQLAlchemyError:
             raise InvalidScopeError(state=state)
 
         scopes = set(scope_to_list(scope))
-        if not set(self.scopes_supported).issuperset(scopes):
+        if not set(scopes_supported).issuperset(scopes):
             raise InvalidScopeError(state=state)
 
     def create_oauth2_request(self, request):
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from jwt.exceptions import ExpiredSignatureError
+from redis.exceptions import RedisError
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache
+from oauth2_provider.app.constant import secret
+from oauth2_provider.app.core.broadcast import broadcast
+from oauth2_provider.app.core.token import jwt_token
+from oauth2_provider.app.settings import config_option
+
+USER_SESSION_TTL = 60 * 60 * 24 * 30
+MANAGER_SESSION_TTL = 60 * 60 * 2
+
+
+class SessionValidator:
+    """
+    Validate the session tokens of the users and administrators.
+
+    The session of a user is the token stored in redis under ``<username>-token`` (``-manager-token`` for
+    an administrator). A token that was decoded and matched redis is remembered by the worker for at most
+    memo_ttl seconds, and never past its exp claim, so the following requests skip the decode and the redis
+    GET. Logout deletes the key and broadcasts it, every worker drops the tokens of that session.
+    """
+
+    topic = "session"
+
+    def __init__(self, maxsize: int = 4096, memo_ttl: int = 5):
+        self.maxsize = maxsize
+        self.memo_ttl = memo_ttl
+        # token -> (session key, username, monotonic expiry)
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._subscribed_pid = None
+
+    @staticmethod
+    def key(username: str, manager: bool = False) -> str:
+        return username + ("-manager-token" if manager else "-token")
+
+    def _ensure_subscribed(self):
+        if self._subscribed_pid != os.getpid():
+            self._subscribed_pid = os.getpid()
+            broadcast.subscribe(self.topic, self._evict)
+
+    def _remembered(self, token):
+        with self._lock:
+            item = self._memo.get(token)
+            if not item:
+                return None
+            _, username, expires_at = item
+            if expires_at < time.monotonic():
+                del self._memo[token]
+                return None
+            self._memo.move_to_end(token)
+            return username
+
+    def _remember(self, token, key, username, exp):
+        ttl = min(self.memo_ttl, exp - time.time())
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._memo[token] = (key, username, time.monotonic() + ttl)
+            self._memo.move_to_end(token)
+            while len(self._memo) > self.maxsize:
+                self._memo.popitem(last=False)
+
+    def _evict(self, key=None):
+        with self._lock:
+            if key is None:
+                self._memo.clear()
+                return
+            for token in [token for token, item in self._memo.items() if item[0] == key]:
+                del self._memo[token]
+
+    def validate(self, token: str, manager: bool = False):
+        """
+        Validate a session token, the token of an administrator is passed without the "bearer " prefix
+        but it is stored with it
+
+        :return: username of the session, None if the token is not a valid session
+        """
+        stored = "bearer " + token if manager else token
+        if self.memo_ttl > 0:
+            self._ensure_subscribed()
+            username = self._remembered(stored)
+            if username:
+                return username
+        try:
+            token_info = jwt_token.decode(token=token, secret=secret)
+            key = self.key(token_info["sub"], manager)
+            if cache.get(key) != stored:
+                return None
+        except ExpiredSignatureError:
+            LOGGER.debug("Session token has expired")
+            return None
+        except ValueError:
+            LOGGER.debug("It is not a valid session token")
+            return None
+        except RedisError as error:
+            LOGGER.error("Failed to validate session: %s", error)
+            return None
+        if self.memo_ttl > 0:
+            self._remember(stored, key, token_info["sub"], token_info["exp"])
+        return token_info["sub"]
+
+    def store(self, username: str, token: str, manager: bool = False):
+        """
+        Start the session, the token replaces the previous session of the user
+        """
+        key = self.key(username, manager)
+        cache.set(key, token, ex=MANAGER_SESSION_TTL if manager else USER_SESSION_TTL)
+        self.invalidate(key)
+
+    def revoke(self, username: str, manager: bool = False):
+        """
+        End the session of the user in redis and in every worker
+        """
+        key = self.key(username, manager)
+        cache.delete(key)
+        self.invalidate(key)
+
+    def invalidate(self, key: str):
+        self._evict(key)
+        broadcast.publish(self.topic, key)
+
+
+session_validator = SessionValidator(
+    maxsize=int(config_option("session_cache", "maxsize", 4096)),
+    memo_ttl=int(config_option("session_cache", "memo_ttl", 5)),
+)
@@ -10,27 +10,80 @@
 # PURPOSE.
 # See the Mulan PSL v2 for more details.
 # ******************************************************************************/
+import base64
+import hashlib
+import hmac
 import json
+import threading
 import time
-from datetime import datetime
-from datetime import timedelta as _timedelta
+import uuid
+from collections import OrderedDict
 
 import jwt
-import pytz
 from authlib.oauth2.rfc6750.token import BearerTokenGenerator
+from flask import current_app
+from jwt.algorithms import get_default_algorithms
 from jwt.exceptions import ExpiredSignatureError
 
-from oauth2_provider.manage import app
+from oauth2_provider.app.core.generations import generation_registry
+from oauth2_provider.app.core.keys import key_ring
+from oauth2_provider.app.core.metrics import metrics
+
+HMAC_DIGESTS = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+# optional claims copied from the keyword arguments of generate_token
+OPTIONAL_CLAIMS = ("iss", "scope", "jti", "token_use", "ugen", "cgen")
+ACCESS_TOKEN = "access"
+REFRESH_TOKEN = "refresh"
+
+
+def _base64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+class SigningContext:
+    """
+    Key material of one signer and its encoded JWS header, prepared once and reused by every token it signs.
+
+    The tokens are byte for byte what ``jwt.encode`` produces for the same claims and key.
+    """
+
+    def __init__(self, alg: str, key, kid: str = None):
+        header = dict(alg=alg, typ="JWT")
+        if kid:
+            header["kid"] = kid
+        self.header_segment = _base64url(json.dumps(header, separators=(",", ":"), sort_keys=True).encode())
+        self._hmac = None
+        self._key = key
+        if alg in HMAC_DIGESTS:
+            # the keyed inner and outer hash states are computed here, each token copies them
+            self._hmac = hmac.new(key.encode("utf-8") if isinstance(key, str) else key, digestmod=HMAC_DIGESTS[alg])
+        else:
+            self._algorithm = get_default_algorithms()[alg]
+
+    def sign(self, claims: dict) -> str:
+        signing_input = f"{self.header_segment}.{_base64url(json.dumps(claims, separators=(',', ':')).encode())}"
+        if self._hmac is not None:
+            mac = self._hmac.copy()
+            mac.update(signing_input.encode("ascii"))
+            signature = mac.digest()
+        else:
+            signature = self._algorithm.sign(signing_input.encode("ascii"), self._key)
+        return f"{signing_input}.{_base64url(signature)}"
 
 
 class JwtTokenGenerator(BearerTokenGenerator):
     """
     jwt token generate
 
+    Session tokens of authhub itself carry the "oauth" audience and are always signed with HS256. Tokens issued
+    to the clients are signed with the client secret, or with the key ring when an asymmetric algorithm is
+    configured. The signing contexts are cached per secret or key id.
     """
 
     refresh_token_expires_in = 2592000
     essential_options = {"exp", "sub", "aud"}
+    session_audience = "oauth"
+    max_signing_contexts = 1024
 
     def __init__(self, access_token_generator=None, refresh_token_generator=None, expires_generator=None, alg='HS256'):
         super().__init__(access_token_generator, refresh_token_generator, expires_generator)
@@ -39,55 +92,68 @@ class JwtTokenGenerator(BearerTokenGenerator):
         if self.refresh_token_generator is None:
             self.refresh_token_generator = self.generate_token
         self.alg = alg
+        self._contexts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _signing_context(self, secret, client) -> SigningContext:
+        if client != self.session_audience and key_ring.asymmetric:
+            signing_key = key_ring.signing_key()
+            alg, key, kid = key_ring.alg, signing_key.private_key, signing_key.kid
+            cache_key = (alg, kid)
+        else:
+            alg, key, kid = self.alg, secret, None
+            cache_key = (alg, secret)
+        with self._lock:
+            context = self._contexts.get(cache_key)
+            if context is not None:
+                self._contexts.move_to_end(cache_key)
+                return context
+        context = SigningContext(alg, key, kid)
+        with self._lock:
+            self._contexts[cache_key] = context
+            while len(self._contexts) > self.max_signing_contexts:
+                self._contexts.popitem(last=False)
+        return context
+
+    def _verification_key(self, token, secret, client):
+        """
+        Tokens without a kid were signed with the client secret before the key ring was enabled
+
+        :return: (key, algorithm)
+        """
+        if client != self.session_audience and key_ring.asymmetric:
+            kid = jwt.get_unverified_header(token).get("kid")
+            if kid:
+                public_key = key_ring.verification_key(kid)
+                if public_key is None:
+                    raise ValueError("Unknown signing key")
+                return public_key, key_ring.alg
+        return secret, self.alg
 
     def timedelta(self, seconds: int = 3600) -> int:
-        date_span = datetime.now(tz=pytz.timezone('Asia/Shanghai'))
-        if seconds:
-            date_span = date_span + _timedelta(seconds=seconds)
-        time_span = time.strptime(date_span.strftime("%Y-%m-%d %H:%M:%S"), "%Y-%m-%d %H:%M:%S")
-        return int(time.mktime(time_span))
+        """
+        Epoch seconds after the given number of seconds
+        """
+        return int(time.time()) + (seconds or 0)
 
-    def generate_token(self, secret, expires_in: int, user, client="oauth", **kwargs):
+    def generate_token(self, secret, expires_in: int, user, client=session_audience, signing_context=None, **kwargs):
 
         if not user:
             return ValueError("A unique identifier is missing")
-        token_body = dict(
-            iat=int(time.time()),
-            exp=self.timedelta(expires_in),
-            sub=user,
-            aud=client,
-        )
-        for jwt_key in set(kwargs.keys()).intersection(set(["iss", "scope", "jti"])):
-            token_body[jwt_key] = kwargs[jwt_key]
+        now = int(time.time())
+        token_body = dict(iat=now, exp=now + (expires_in or 0), sub=user, aud=client)
+        for claim in OPTIONAL_CLAIMS:
+            if claim in kwargs:
+                token_body[claim] = kwargs[claim]
         try:
-            _jwt_token = jwt.encode(
-                token_body,
-                secret,
-                algorithm=self.alg,
-            )
-            if isinstance(_jwt_token, bytes):
-                _jwt_token = _jwt_token.decode("utf-8")
-
-            return _jwt_token
+            with metrics.timer("jwt", "sign"):
+                return (signing_context or self._signing_context(secret, client)).sign(token_body)
         except Exception:
             raise ValueError("Token generation failed")
 
-    def generate(self, grant_type, client, user=None, scope=None, expires_in=None, include_refresh_token=True):
-        """Generate a bearer token for OAuth 2.0 authorization token endpoint.
-
-        :param client: the client that making the request.
-        :param grant_type: current requested grant_type.
-        :param user: current authorized user.
-        :param expires_in: if provided, use this value as expires_in.
-        :param scope: current requested scope.
-        :param include_refresh_token: should refresh_token be included.
-        :return: Token dict
-        """
-
-        scope = self.get_allowed_scope(client, scope)
-        if expires_in is None:
-            expires_in = app.config.get('TOKEN_EXPIRES_IN') or self._get_expires_in(client, grant_type)
-
+    def _generate(self, client, user, scope, expires_in, include_refresh_token, generations, signing_context=None):
+        # the token is one client generation ahead, issuing it supersedes the tokens issued before
+        user_generation, client_generation = generations[0], generations[1] + 1
         token = {
             "username": user.username,
             'token_type': 'Bearer',
@@ -97,19 +163,33 @@ class JwtTokenGenerator(BearerTokenGenerator):
                 scope=scope,
                 user=user.username,
                 secret=client.client_secret,
+                jti=uuid.uuid4().hex,
+                token_use=ACCESS_TOKEN,
+                ugen=user_generation,
+                cgen=client_generation,
+                signing_context=signing_context,
             ),
+            "user_generation": user_generation,
+            "client_generation": client_generation,
         }
         meta = dict(account_token_exp=self.timedelta(expires_in), expires_in=expires_in)
         if scope:
             token['scope'] = scope
         if include_refresh_token:
-            refresh_token_expires_in = app.config.get('REFRESH_TOKEN_EXPIRES_IN') or self.refresh_token_expires_in
+            refresh_token_expires_in = (
+                current_app.config.get('REFRESH_TOKEN_EXPIRES_IN') or self.refresh_token_expires_in
+            )
             token['refresh_token'] = self.refresh_token_generator(
                 client=client.client_id,
                 expires_in=refresh_token_expires_in,
                 scope=scope,
                 user=user.username,
                 secret=client.client_secret,
+                jti=uuid.uuid4().hex,
+                token_use=REFRESH_TOKEN,
+                ugen=user_generation,
+                cgen=client_generation,
+                signing_context=signing_context,
             )
             meta['refresh_token_exp'] = self.timedelta(refresh_token_expires_in)
             meta["refresh_token_expires_in"] = refresh_token_expires_in
@@ -117,12 +197,64 @@ class JwtTokenGenerator(BearerTokenGenerator):
         token["_metadata"] = json.dumps(meta)
         return token
 
-    def decode(self, token, secret, client="oauth"):
+    def generate(self, grant_type, client, user=None, scope=None, expires_in=None, include_refresh_token=True):
+        """Generate a bearer token for OAuth 2.0 authorization token endpoint.
+
+        :param client: the client that making the request.
+        :param grant_type: current requested grant_type.
+        :param user: current authorized user.
+        :param expires_in: if provided, use this value as expires_in.
+        :param scope: current requested scope.
+        :param include_refresh_token: should refresh_token be included.
+        :return: Token dict
+        """
+
+        scope = self.get_allowed_scope(client, scope)
+        if expires_in is None:
+            expires_in = current_app.config.get('TOKEN_EXPIRES_IN') or self._get_expires_in(client, grant_type)
+        generations = generation_registry.current(user.username, client.client_id)
+        return self._generate(client, user, scope, expires_in, include_refresh_token, generations)
+
+    def generate_many(self, grant_type, client, users, scope=None, expires_in=None, include_refresh_token=True):
+        """Generate bearer tokens of one client for several users, the scope, the expiry and the signing
+        context are resolved once for the whole batch.
+
+        :param client: the client that making the request.
+        :param grant_type: current requested grant_type.
+        :param users: iterable of the authorized users.
+        :param expires_in: if provided, use this value as expires_in.
+        :param scope: current requested scope.
+        :param include_refresh_token: should refresh_token be included.
+        :return: list of token dict, in the order of users
+        """
+
+        scope = self.get_allowed_scope(client, scope)
+        if expires_in is None:
+            expires_in = current_app.config.get('TOKEN_EXPIRES_IN') or self._get_expires_in(client, grant_type)
+        users = list(users)
+        generations = generation_registry.generations_many(user.username for user in users)
+        signing_context = self._signing_context(client.client_secret, client.client_id)
+        return [
+            self._generate(
+                client,
+                user,
+                scope,
+                expires_in,
+                include_refresh_token,
+                generation_registry.pick(generations[user.username], client.client_id),
+                signing_context,
+            )
+            for user in users
+        ]
+
+    def decode(self, token, secret, client=session_audience):
         if not token:
             raise ValueError("Please enter a valid token")
 
         try:
-            claims = jwt.decode(token, secret, algorithms=[self.alg], audience=client)
+            with metrics.timer("jwt", "verify"):
+                key, algorithm = self._verification_key(token, secret, client)
+                claims = jwt.decode(token, key, algorithms=[algorithm], audience=client)
             if not self.essential_options.issubset(set(claims.keys())):
                 raise ValueError("It is not a valid token")
 
@@ -14,9 +14,11 @@ from authlib.oauth2.rfc6750.errors import InsufficientScopeError, InvalidTokenEr
 from authlib.oauth2.rfc7523.validator import JWTBearerTokenValidator as _JWTBearerTokenValidator
 from vulcanus.log.log import LOGGER
 
+from oauth2_provider.app import db
+from oauth2_provider.app.core.generations import generation_registry
+from oauth2_provider.app.core.revocation_filter import revocation_filter
 from oauth2_provider.app.core.server import OAuth2Request
 from oauth2_provider.database.table import OAuth2Token
-from oauth2_provider.manage import db
 
 
 class JWTBearerTokenValidator(_JWTBearerTokenValidator):
@@ -38,8 +40,12 @@ class JWTBearerTokenValidator(_JWTBearerTokenValidator):
         :return: token
         """
 
+        digest = OAuth2Token.digest(token_string)
+        if revocation_filter.check(digest):
+            LOGGER.debug("Token revoked: %s", digest)
+            return None
         try:
-            token = db.session.query(OAuth2Token).filter_by(access_token=token_string).first()
+            token = db.session.query(OAuth2Token).filter_by(access_token_digest=digest).first()
             if not token:
                 LOGGER.warning("Token not found: %s", token_string)
 
@@ -57,6 +63,11 @@ class JWTBearerTokenValidator(_JWTBearerTokenValidator):
         if token.is_revoked():
             raise InvalidTokenError("The token has been revoked")
 
+        if not generation_registry.is_current(
+            token.username, token.client_id, token.user_generation, token.client_generation
+        ):
+            raise InvalidTokenError("The token has been revoked")
+
         # Check that the token is by the client
         if token.client_id != request.client_id:
             raise InvalidTokenError("The token does not match the client")
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+import json
+import math
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from redis.exceptions import RedisError
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import cache, db
+from oauth2_provider.app.core.callbacks import callback_dispatcher
+from oauth2_provider.app.settings import config_option
+from oauth2_provider.database.table import OAuth2Client, WebhookOutbox
+
+PENDING, DELIVERED, FAILED = "pending", "delivered", "failed"
+HEADERS = {"Content-Type": "application/json", "User-Agent": 'authhub'}
+
+
+def enqueue_register_webhooks(user):
+    """
+    Add the registration webhooks of every client to the session of the new user, they are committed with
+    the user and delivered by the webhook worker
+    """
+    for client in db.session.query(OAuth2Client).all():
+        scope = client.client_metadata["scope"].split()
+        user_info = dict()
+        if "username" in scope:
+            user_info["username"] = user.username
+        if "email" in scope:
+            user_info["email"] = user.email
+        payload = json.dumps(user_info)
+        for register_callback_uri in client.register_callback_uris:
+            db.session.add(
+                WebhookOutbox(client_id=client.client_id, event="register", url=register_callback_uri, payload=payload)
+            )
+
+
+class WebhookWorker:
+    """
+    Deliver the webhooks of the outbox.
+
+    Due rows are claimed with ``SELECT ... FOR UPDATE SKIP LOCKED`` and leased by moving next_attempt_at,
+    so several workers never post the same row at once. A failed delivery is retried with exponential
+    backoff and jitter until max_attempts, then the row is marked failed. At most per_client calls of one
+    client run at the same time, a slow client only delays its own webhooks.
+
+    The lease lasts at least as long as the longest lane of a batch takes when every call times out. The
+    results are only recorded for the rows still leased by the worker, a row claimed again by another
+    worker meanwhile is left to it.
+    """
+
+    stats_key = "authhub:webhooks:stats"
+
+    def __init__(
+        self,
+        batch_size: int = 100,
+        max_workers: int = 16,
+        per_client: int = 2,
+        max_attempts: int = 8,
+        backoff: int = 10,
+        max_backoff: int = 3600,
+        lease: int = 60,
+        poll_interval: float = 1,
+    ):
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.per_client = per_client
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        lane_timeout = math.ceil(batch_size / per_client) * sum(callback_dispatcher.timeout)
+        self.lease = max(lease, math.ceil(lane_timeout))
+        self.poll_interval = poll_interval
+
+    def _claim(self):
+        """
+        Lease the due rows
+
+        :return: (the claimed webhooks, next_attempt_at of the lease)
+        """
+        now = int(time.time())
+        leased_until = now + self.lease
+        rows = (
+            db.session.query(WebhookOutbox)
+            .filter(WebhookOutbox.status == PENDING, WebhookOutbox.next_attempt_at <= now)
+            .order_by(WebhookOutbox.next_attempt_at)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for row in rows:
+            row.next_attempt_at = leased_until
+        db.session.commit()
+        return [(row.id, row.client_id, row.url, json.loads(row.payload)) for row in rows], leased_until
+
+    def _deliver_lane(self, lane):
+        return [(row_id, callback_dispatcher.post(url, payload, HEADERS)) for row_id, url, payload in lane]
+
+    def _lanes(self, claimed):
+        """
+        Split the claimed webhooks of every client into at most per_client lanes delivered one after another
+        """
+        lanes = defaultdict(list)
+        counts = defaultdict(int)
+        for row_id, client_id, url, payload in claimed:
+            lanes[(client_id, counts[client_id] % self.per_client)].append((row_id, url, payload))
+            counts[client_id] += 1
+        return list(lanes.values())
+
+    def _retry_delay(self, attempts):
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        return int(delay * random.uniform(0.8, 1.2))
+
+    def _record(self, results, leased_until):
+        now = int(time.time())
+        counters = defaultdict(int)
+        query = db.session.query(WebhookOutbox).filter(WebhookOutbox.id.in_(results)).with_for_update()
+        rows = {row.id: row for row in query.all()}
+        for row_id, result in results.items():
+            row = rows.get(row_id)
+            if row is None:
+                continue
+            if row.status != PENDING or row.next_attempt_at != leased_until:
+                LOGGER.warning("webhook %s was claimed again before its delivery was recorded", row.id)
+                counters["lease_lost"] += 1
+                continue
+            row.attempts += 1
+            if result.ok:
+                row.status, row.delivered_at, row.last_error = DELIVERED, now, None
+                counters["delivered"] += 1
+                counters["latency_total"] += now - row.created_at
+                continue
+            row.last_error = (result.error or f"status {result.status_code}")[:255]
+            if row.attempts >= self.max_attempts:
+                row.status = FAILED
+                counters["failed"] += 1
+                LOGGER.error("webhook %s to %s failed after %s attempts", row.id, row.url, row.attempts)
+            else:
+                row.next_attempt_at = now + self._retry_delay(row.attempts)
+                counters["retried"] += 1
+        db.session.commit()
+        try:
+            pipeline = cache.pipeline(transaction=False)
+            for name, value in counters.items():
+                pipeline.hincrby(self.stats_key, name, value)
+            pipeline.execute()
+        except RedisError as error:
+            LOGGER.debug("Failed to record webhook stats: %s", error)
+
+    def run_once(self, executor) -> int:
+        """
+        Deliver one batch of due webhooks
+
+        :return: number of webhooks attempted
+        """
+        claimed, leased_until = self._claim()
+        if not claimed:
+            return 0
+        futures = [executor.submit(self._deliver_lane, lane) for lane in self._lanes(claimed)]
+        self._record({row_id: result for future in futures for row_id, result in future.result()}, leased_until)
+        return len(claimed)
+
+    def run(self):
+        """
+        Deliver the webhooks until the process is stopped, called in an application context
+        """
+        application = current_app._get_current_object()
+        LOGGER.info("webhook worker started")
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="authhub-webhook") as executor:
+            while True:
+                with application.app_context():
+                    try:
+                        if self.run_once(executor) >= self.batch_size:
+                            continue
+                    except SQLAlchemyError as error:
+                        db.session.rollback()
+                        LOGGER.error("Webhook delivery failed: %s", error)
+                time.sleep(self.poll_interval)
+
+    def stats(self) -> dict:
+        """
+        Queue depth per status, age of the oldest pending webhook and delivery counters
+        """
+        now = int(time.time())
+        queues = db.session.query(WebhookOutbox.status, func.count()).group_by(WebhookOutbox.status).all()
+        stats = {f"queue:{status}": count for status, count in queues}
+        oldest = db.session.query(func.min(WebhookOutbox.created_at)).filter(WebhookOutbox.status == PENDING).scalar()
+        stats["oldest_pending_age"] = now - oldest if oldest else 0
+        counters = {name: int(value) for name, value in (cache.hgetall(self.stats_key) or dict()).items()}
+        stats.update(counters)
+        delivered = counters.get("delivered", 0)
+        stats["latency_avg"] = round(counters.get("latency_total", 0) / delivered, 2) if delivered else 0
+        return stats
+
+
+webhook_worker = WebhookWorker(
+    batch_size=int(config_option("webhooks", "batch_size", 100)),
+    max_workers=int(config_option("webhooks", "max_workers", 16)),
+    per_client=int(config_option("webhooks", "per_client", 2)),
+    max_attempts=int(config_option("webhooks", "max_attempts", 8)),
+    backoff=int(config_option("webhooks", "backoff", 10)),
+    max_backoff=int(config_option("webhooks", "max_backoff", 3600)),
+    lease=int(config_option("webhooks", "lease", 60)),
+)
@@ -12,6 +12,8 @@
 # ******************************************************************************/
 from marshmallow import Schema, fields, validate
 
+from oauth2_provider.app.settings import config_option
+
 
 class OauthTokenSchema(Schema):
     """
@@ -33,6 +35,19 @@ class OauthTokenIntrospectSchema(Schema):
     client_id = fields.String(required=True, validate=validate.Length(min=1))
 
 
+class OauthTokenIntrospectBatchSchema(Schema):
+    """
+    oauth2 batch token introspect schema
+    """
+
+    tokens = fields.List(
+        fields.String(required=True, validate=validate.Length(min=1)),
+        required=True,
+        validate=validate.Length(min=1, max=config_option("introspect", "batch_max_tokens", 100)),
+    )
+    client_id = fields.String(required=True, validate=validate.Length(min=1))
+
+
 class RefreshTokenSchema(Schema):
     """
     oauth2 refresh token schema
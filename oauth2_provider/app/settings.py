@@ -14,3 +14,14 @@ from vulcanus.conf import ConfigHandle
 
 # read manager configuration
 configuration = ConfigHandle("authhub").parser
+
+
+def config_option(section: str, option: str, default=None):
+    """
+    Read an optional option of authhub.yml, the default is returned if the section or option is missing
+    """
+    try:
+        value = getattr(getattr(configuration, section), option)
+    except (AttributeError, KeyError):
+        return default
+    return default if value is None else value
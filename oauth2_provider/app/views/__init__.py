@@ -15,13 +15,14 @@ from functools import wraps
 from urllib.parse import unquote
 
 from flask import g, jsonify, request
-from jwt.exceptions import ExpiredSignatureError
 from vulcanus.restful.resp import make_response, state
 from vulcanus.restful.serialize.validate import validate
 
-from oauth2_provider.app import cache
-from oauth2_provider.app.constant import secret
-from oauth2_provider.app.core.token import jwt_token
+from oauth2_provider.app.core.admission import AdmissionRejected, admission_controller
+from oauth2_provider.app.core.sessions import session_validator
+from oauth2_provider.app.settings import config_option
+
+TRUST_FORWARDED_FOR = bool(config_option("admission", "trust_forwarded_for", True))
 
 
 def validate_request(schema=None):
@@ -69,25 +70,61 @@ def login_require(api):
         token = request.headers.get('Authorization') or request.cookies.get('Authorization')
         if not token:
             return jsonify(make_response(label=state.TOKEN_ERROR))
-        try:
-            is_manage_user = token.startswith("bearer ")
-            if is_manage_user:
-                token_info = jwt_token.decode(token=token.split(None, 1)[-1], secret=secret)
-            else:
-                token_info = jwt_token.decode(token=token, secret=secret)
-            # check cache token
-            cache_token_key = token_info["sub"] + "-manager-token" if is_manage_user else token_info["sub"] + "-token"
-            cache_token = cache.get(cache_token_key)
-            if not cache_token or cache_token != token:
-                return jsonify(make_response(label=state.TOKEN_ERROR))
-
-            g.username = token_info["sub"]
-            g.is_manage_user = is_manage_user
-
-        except ExpiredSignatureError:
-            return jsonify(make_response(label=state.TOKEN_ERROR))
-        except ValueError:
+        is_manage_user = token.startswith("bearer ")
+        if is_manage_user:
+            token = token.split(None, 1)[-1]
+        username = session_validator.validate(token, manager=is_manage_user)
+        if not username:
             return jsonify(make_response(label=state.TOKEN_ERROR))
+
+        g.username = username
+        g.is_manage_user = is_manage_user
         return api(*args, **kwargs)
 
     return wrapper
+
+
+def client_ip():
+    """
+    Address of the client, the last X-Forwarded-For entry is the one added by the nginx in front of authhub
+    """
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if TRUST_FORWARDED_FOR and forwarded_for:
+        return forwarded_for.rsplit(",", 1)[-1].strip()
+    return request.remote_addr
+
+
+def _request_identities():
+    body = request.get_json(silent=True) or request.form
+    if not isinstance(body, dict):
+        body = dict()
+    client = body.get("client_id")
+    if not client and request.authorization:
+        client = request.authorization.username
+    return dict(username=body.get("username"), client=client, ip=client_ip())
+
+
+def admission_control(policy):
+    """
+    Refuse the request with 429 when a rate limit of the policy is reached and with 503 when the worker
+    already serves the allowed number of requests of the policy, both with a Retry-After header. The label
+    is Too.Many.Requests for a rate limit and Server.Busy for the concurrency cap.
+
+    :param policy: admission policy name
+    """
+
+    def admission_control_handle(api):
+        @wraps(api)
+        def wrapper(*args, **kwargs):
+            try:
+                with admission_controller.admit(policy, _request_identities()):
+                    return api(*args, **kwargs)
+            except AdmissionRejected as rejected:
+                response = jsonify(make_response(label=rejected.label, message=str(rejected)))
+                response.status_code = rejected.status
+                response.headers["Retry-After"] = str(rejected.retry_after)
+                return response
+
+        return wrapper
+
+    return admission_control_handle
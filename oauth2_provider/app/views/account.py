@@ -11,10 +11,10 @@
 # See the Mulan PSL v2 for more details.
 # ******************************************************************************/
 from flask import g, make_response, request
-from oauth2_provider.app import cache
 from oauth2_provider.app.core.account import UserProxy
+from oauth2_provider.app.core.sessions import session_validator
 from oauth2_provider.app.serialize.account import AddUserSchema, LoginSchema, ResetPasswordSchema
-from oauth2_provider.app.views import login_require, validate_request
+from oauth2_provider.app.views import admission_control, login_require, validate_request
 from vulcanus.restful.resp import state
 from vulcanus.restful.response import BaseResponse
 
@@ -50,6 +50,7 @@ class Login(BaseResponse):
     Restful API: post
     """
 
+    @admission_control("login")
     @validate_request(schema=LoginSchema)
     def post(self, request_body, *args, **kwargs):
         """
@@ -69,8 +70,7 @@ class Login(BaseResponse):
         if not request_body["for_validate"]:
             # 30 days expire
             response.set_cookie("Authorization", user_token, 60 * 60 * 24 * 30)
-            cache.set(request_body["username"] + "-token", user_token)
-            cache.expire(request_body["username"] + "-token", 60 * 60 * 24 * 30)
+            session_validator.store(request_body["username"], user_token)
         return response
 
 
@@ -80,6 +80,7 @@ class ManagerLogin(BaseResponse):
     Restful API: post
     """
 
+    @admission_control("manager_login")
     @validate_request(schema=LoginSchema)
     def post(self, request_body, *args, **kwargs):
         """
@@ -98,8 +99,7 @@ class ManagerLogin(BaseResponse):
         user_token = "bearer " + user_token
         response = make_response(self.response(code=status_code, data=dict(user_token=user_token)))
         response.set_cookie('Authorization', '', expires=0)
-        cache.set(request_body["username"] + "-manager-token", user_token)
-        cache.expire(request_body["username"] + "-manager-token", 60 * 60 * 2)
+        session_validator.store(request_body["username"], user_token, manager=True)
         return response
 
 
@@ -132,12 +132,12 @@ class Logout(BaseResponse):
         """
         # authhub manager user does not process application logout callback operations
         if g.is_manage_user:
-            cache.delete(g.username + "-manager-token")
+            session_validator.revoke(g.username, manager=True)
             return make_response(self.response(code=state.SUCCEED))
         logout_res = UserProxy().application_logout()
         if logout_res != state.SUCCEED:
             return self.response(code=logout_res)
-        cache.delete(g.username + "-token")
+        session_validator.revoke(g.username)
         response = make_response(self.response(code=state.SUCCEED))
         response.set_cookie("Authorization", "", 0)
         response.status_code = 302
@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+from flask import make_response
+from vulcanus.restful.response import BaseResponse
+
+from oauth2_provider.app.core.metrics import metrics
+
+
+class MetricsView(BaseResponse):
+    """
+    Prometheus metrics of all the workers, keep it reachable from the monitoring network only
+    """
+
+    def get(self):
+        if not metrics.active:
+            return make_response("metrics are disabled\n", 404, {"Content-Type": "text/plain"})
+        body, content_type = metrics.render()
+        return make_response(body, 200, {"Content-Type": content_type})
@@ -11,8 +11,6 @@
 # See the Mulan PSL v2 for more details.
 # ******************************************************************************/
 import json
-import time
-from datetime import datetime
 from urllib.parse import quote
 
 from authlib.integrations.flask_oauth2 import AuthorizationServer, ResourceProtector
@@ -23,26 +21,35 @@ from authlib.oauth2.rfc6749.errors import (
     UnsupportedTokenTypeError,
 )
 from authlib.oauth2.rfc6750.errors import InsufficientScopeError, InvalidTokenError
-from flask import g, redirect, request
+from flask import current_app, g, jsonify, redirect, request
 from jwt.exceptions import ExpiredSignatureError
+from redis.exceptions import RedisError
 from sqlalchemy.exc import SQLAlchemyError
 from vulcanus.log.log import LOGGER
 from vulcanus.restful.resp import state
 from vulcanus.restful.response import BaseResponse
-from werkzeug.utils import cached_property, import_string
-
-from oauth2_provider.app import cache
-from oauth2_provider.app.constant import secret
-from oauth2_provider.app.core.token import jwt_token
+from werkzeug.utils import cached_property
+
+from oauth2_provider.app import db
+from oauth2_provider.app.core.clients import client_registry
+from oauth2_provider.app.core.generations import generation_registry
+from oauth2_provider.app.core.introspection import introspection_cache
+from oauth2_provider.app.core.keys import KeyRingError, key_ring
+from oauth2_provider.app.core.login_records import login_recorder
+from oauth2_provider.app.core.revocation import revocation_registry
+from oauth2_provider.app.core.rotation import token_rotator
+from oauth2_provider.app.core.sessions import session_validator
+from oauth2_provider.app.core.token import ACCESS_TOKEN, jwt_token
 from oauth2_provider.app.serialize.oauth2 import (
     AuthorizationStatusSchema,
+    OauthTokenIntrospectBatchSchema,
     OauthTokenIntrospectSchema,
     OauthTokenSchema,
     RefreshTokenSchema,
 )
-from oauth2_provider.app.views import login_require, validate_request
-from oauth2_provider.database.table import LoginRecords, OAuth2Client, OAuth2ClientScopes, OAuth2Token, User
-from oauth2_provider.manage import db
+from oauth2_provider.app.settings import config_option
+from oauth2_provider.app.views import admission_control, login_require, validate_request
+from oauth2_provider.database.table import OAuth2ClientScopes, OAuth2Token, User
 
 
 class OAuth2:
@@ -55,9 +62,8 @@ class OAuth2:
 
         """
         try:
-            authorization = import_string("oauth2_provider.manage.authorization")
-            return authorization
-        except ImportError:
+            return current_app.extensions["authorization"]
+        except KeyError:
             raise NotImplementedError("You must implement the authorization property")
 
     @cached_property
@@ -66,9 +72,8 @@ class OAuth2:
         oAuth2 validation endpoints. This property is created automaticly
         """
         try:
-            validate = import_string("oauth2_provider.manage.require_oauth")
-            return validate
-        except ImportError:
+            return current_app.extensions["require_oauth"]
+        except KeyError:
             raise NotImplementedError("You must implement the require_oauth property")
 
     def redirect(self, url, **kwargs):
@@ -103,19 +108,12 @@ class OauthorizeView(BaseResponse, OAuth2):
         return True
 
     def _validate_token(self, token):
-        try:
-            token_info = jwt_token.decode(token=token, secret=secret)
-            g.username = token_info["sub"]
-            cache_token = cache.get(token_info["sub"] + "-token")
-            if token != cache_token:
-                raise ValueError
-            return True
-        except ExpiredSignatureError as error:
-            LOGGER.error("Signature has expired: %s" % token)
-            return False
-        except ValueError:
-            LOGGER.error("It is not a valid token: %s" % token)
+        username = session_validator.validate(token) if token else None
+        if not username:
+            LOGGER.error("It is not a valid session token: %s" % token)
             return False
+        g.username = username
+        return True
 
     def get(self):
         auth_request = self.server.create_oauth2_request(request)
@@ -163,6 +161,7 @@ class OauthTokenView(BaseResponse, OAuth2):
     oauth2 code view
     """
 
+    @admission_control("token")
     @validate_request(schema=OauthTokenSchema)
     def post(self, request_body, *args, **kwargs):
         """
@@ -189,17 +188,19 @@ class OauthTokenView(BaseResponse, OAuth2):
             data = dict(access_token=response_data["access_token"], refresh_token=response_data["refresh_token"])
             if "id_token" in response_data:
                 data["id_token"] = response_data["id_token"]
-            # delete old token
-            client = OAuth2Client.query.filter_by(client_id=request_body["client_id"]).first()
-            token_info = jwt_token.decode(
-                token=response_data["access_token"], secret=client.client_secret, client=client.client_id
-            )
-            OAuth2Token.query.filter(
-                OAuth2Token.username == token_info["sub"],
-                OAuth2Token.client_id == request_body["client_id"],
-                OAuth2Token.access_token != response_data["access_token"],
-            ).delete()
-            db.session.commit()
+            # revoke the tokens issued to the user on the client before this one. The token is already stored,
+            # on failure they stay current until the next token issued to the user on the client
+            try:
+                client = client_registry.get(request_body["client_id"])
+                token_info = jwt_token.decode(
+                    token=response_data["access_token"], secret=client.client_secret, client=client.client_id
+                )
+                generation_registry.supersede(token_info["sub"], client.client_id, token_info["cgen"])
+            except SQLAlchemyError as error:
+                db.session.rollback()
+                LOGGER.error("Failed to supersede the previous tokens: %s", error)
+            except (ExpiredSignatureError, ValueError) as error:
+                LOGGER.error("Failed to read the generation of the issued token: %s", error)
             return self.response(code=state.SUCCEED, data=data)
         LOGGER.error("Validate code failed: %s", response_data["error"])
         return self.response(code=state.AUTH_ERROR, message=response_data["error"])
@@ -220,77 +221,227 @@ class OauthIntrospectView(BaseResponse):
     oauth2 token introspect view
     """
 
-    @validate_request(schema=OauthTokenIntrospectSchema)
-    def post(self, request_body, *args, **kwargs):
+    stateless = config_option("introspect", "mode", "database") == "stateless"
+    cacheable_codes = (state.SUCCEED, state.TOKEN_ERROR, state.TOKEN_EXPIRE)
+
+    @staticmethod
+    def _generations(token_info):
+        return token_info.get("ugen", 0), token_info.get("cgen", 0)
+
+    @staticmethod
+    def _access_token(token_info):
+        """
+        Refresh tokens are signed with the same secret and audience, only the token_use claim tells them apart.
+        Tokens minted before the claim existed are looked up in the database by their access token digest
+
+        :return: True if the claim marks an access token, None if the claim is missing
+        """
+        token_use = token_info.get("token_use")
+        if token_use is None:
+            return None
+        return token_use == ACCESS_TOKEN
+
+    def _validate_stateless(self, digest, token_info, client):
+        """
+        The signature, exp and aud of the token are verified by decode, only the revocation is checked in redis
+
+        :return: True if the token is active, None if redis is unavailable
+        """
         try:
-            client = (
-                db.session.query(OAuth2Client).filter(OAuth2Client.client_id == request_body["client_id"]).one_or_none()
-            )
-            if not client:
-                return self.response(code=state.PARAM_ERROR)
-            token_info = jwt_token.decode(
-                token=request_body["token"], secret=client.client_secret, client=client.client_id
-            )
-            token = (
-                db.session.query(OAuth2Token)
-                .filter(OAuth2Token.access_token == request_body["token"], OAuth2Token.username == token_info["sub"])
-                .one_or_none()
-            )
-            if not token:
-                return self.response(code=state.TOKEN_ERROR)
-            if token.client_id != client.client_id:
-                return self.response(code=state.TOKEN_ERROR)
-            if not LoginRecords.query.filter_by(username=token.username, client_id=client.client_id).one_or_none():
+            if revocation_registry.is_revoked(digest):
+                return False
+        except RedisError as error:
+            LOGGER.warning("Stateless introspection unavailable, fall back to database: %s", error)
+            return None
+        login_recorder.record(token_info["sub"], client)
+        return True
 
-                login_records = LoginRecords(
-                    username=token.username,
-                    client_id=client.client_id,
-                    logout_url=",".join(client.logout_callback_uris),
-                    login_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                )
-                db.session.add(login_records)
-                db.session.commit()
-                LOGGER.info(f"Login records successfully: {token_info['sub']},client_id:{client.client_id}")
+    def _validate_database(self, digest, token_info, client):
+        token = (
+            db.session.query(OAuth2Token)
+            .filter(OAuth2Token.access_token_digest == digest, OAuth2Token.username == token_info["sub"])
+            .one_or_none()
+        )
+        if not token:
+            return False
+        if token.client_id != client.client_id:
+            return False
+        login_recorder.record(token.username, client)
+        return True
+
+    def _introspect(self, token_string, digest, client_id):
+        """
+        Introspect the token
+
+        :return: (code, data, expires_at, generations), expires_at and generations are the exp claim and the
+            (ugen, cgen) claims of an active token
+        """
+        try:
+            client = client_registry.get(client_id)
+            if not client:
+                return state.PARAM_ERROR, None, None, None
+            token_info = jwt_token.decode(token=token_string, secret=client.client_secret, client=client.client_id)
+            access_token = self._access_token(token_info)
+            if access_token is False:
+                return state.TOKEN_ERROR, None, None, None
+            generations = self._generations(token_info)
+            if not generation_registry.is_current(token_info["sub"], client.client_id, *generations):
+                return state.TOKEN_ERROR, None, None, None
+            active = None
+            if self.stateless and access_token:
+                active = self._validate_stateless(digest, token_info, client)
+            if active is None:
+                active = self._validate_database(digest, token_info, client)
+            if not active:
+                return state.TOKEN_ERROR, None, None, None
         except SQLAlchemyError as error:
             LOGGER.error(error)
-            return self.response(code=state.DATABASE_QUERY_ERROR)
+            return state.DATABASE_QUERY_ERROR, None, None, None
         except ValueError:
-            return self.response(code=state.TOKEN_ERROR)
+            return state.TOKEN_ERROR, None, None, None
         except ExpiredSignatureError:
-            return self.response(code=state.TOKEN_EXPIRE)
+            return state.TOKEN_EXPIRE, None, None, None
 
-        return self.response(code=state.SUCCEED, data=token_info["sub"])
+        return state.SUCCEED, token_info["sub"], token_info["exp"], generations
 
+    @validate_request(schema=OauthTokenIntrospectSchema)
+    def post(self, request_body, *args, **kwargs):
+        digest = OAuth2Token.digest(request_body["token"])
+        cached = introspection_cache.get(digest, request_body["client_id"])
+        if cached:
+            code, data = cached
+            return self.response(code=code, data=data)
 
-class RefreshTokenView(BaseResponse):
+        code, data, expires_at, generations = self._introspect(request_body["token"], digest, request_body["client_id"])
+        if code in self.cacheable_codes:
+            introspection_cache.set(digest, request_body["client_id"], code, data, expires_at, generations)
+        return self.response(code=code, data=data)
+
+
+class OauthIntrospectBatchView(OauthIntrospectView):
     """
-    refresh oauth2 token
+    oauth2 token introspect of several tokens of one client
     """
 
-    def _update_token(self, token: OAuth2Token, client: OAuth2Client):
-        token.access_token = jwt_token.generate_token(
-            secret=client.client_secret,
-            user=token.username,
-            scope=token.scope,
-            client=client.client_id,
-            expires_in=token.expires_in,
+    def _active_digests(self, tokens, client):
+        """
+        Digests of the decoded tokens that are still active, revocations are checked in one redis round trip
+        in stateless mode and the tokens are fetched with one IN query otherwise
+
+        :param tokens: dict of digest to the decoded token_info
+        """
+        current = generation_registry.current_many(
+            {
+                digest: (token_info["sub"], client.client_id, *self._generations(token_info))
+                for digest, token_info in tokens.items()
+            }
+        )
+        tokens = {digest: token_info for digest, token_info in tokens.items() if digest in current}
+        if not tokens:
+            return set()
+        active = set()
+        if self.stateless:
+            claimed = {digest: token_info for digest, token_info in tokens.items() if self._access_token(token_info)}
+            try:
+                revoked = revocation_registry.revoked_many(claimed)
+                active = {digest for digest in claimed if digest not in revoked}
+                tokens = {digest: token_info for digest, token_info in tokens.items() if digest not in claimed}
+            except RedisError as error:
+                LOGGER.warning("Stateless introspection unavailable, fall back to database: %s", error)
+            if not tokens:
+                return active
+        rows = (
+            db.session.query(OAuth2Token.access_token_digest, OAuth2Token.username, OAuth2Token.client_id)
+            .filter(OAuth2Token.access_token_digest.in_(list(tokens)))
+            .all()
         )
-        token.issued_at = int(time.time())
-        token.token_metadata["expires_in"] = token.expires_in
-        token.token_metadata["account_token_exp"] = jwt_token.timedelta(token.expires_in)
-        db.session.commit()
+        return active | {
+            digest
+            for digest, username, client_id in rows
+            if client_id == client.client_id and username == tokens[digest]["sub"]
+        }
+
+    def _introspect_many(self, token_strings, client_id):
+        """
+        Introspect the tokens that are not cached
+
+        :return: dict of digest to (code, data, expires_at, generations)
+        """
+        client = client_registry.get(client_id)
+        if not client:
+            return {digest: (state.PARAM_ERROR, None, None, None) for digest in token_strings}
+        results, decoded = dict(), dict()
+        for digest, token_string in token_strings.items():
+            try:
+                token_info = jwt_token.decode(token=token_string, secret=client.client_secret, client=client_id)
+                if self._access_token(token_info) is False:
+                    results[digest] = (state.TOKEN_ERROR, None, None, None)
+                    continue
+                decoded[digest] = token_info
+            except ValueError:
+                results[digest] = (state.TOKEN_ERROR, None, None, None)
+            except ExpiredSignatureError:
+                results[digest] = (state.TOKEN_EXPIRE, None, None, None)
+        if not decoded:
+            return results
+        try:
+            active = self._active_digests(decoded, client)
+        except SQLAlchemyError as error:
+            LOGGER.error(error)
+            results.update({digest: (state.DATABASE_QUERY_ERROR, None, None, None) for digest in decoded})
+            return results
+        try:
+            for username in {decoded[digest]["sub"] for digest in active}:
+                login_recorder.record(username, client)
+        except SQLAlchemyError as error:
+            # the record is written synchronously without redis, the tokens are active all the same
+            db.session.rollback()
+            LOGGER.error("Failed to record the logins of the introspected tokens: %s", error)
+        for digest, token_info in decoded.items():
+            if digest in active:
+                results[digest] = (state.SUCCEED, token_info["sub"], token_info["exp"], self._generations(token_info))
+            else:
+                results[digest] = (state.TOKEN_ERROR, None, None, None)
+        return results
+
+    @validate_request(schema=OauthTokenIntrospectBatchSchema)
+    def post(self, request_body, *args, **kwargs):
+        client_id = request_body["client_id"]
+        digests = [OAuth2Token.digest(token) for token in request_body["tokens"]]
+        results = introspection_cache.get_many(digests, client_id)
+        uncached = {digest: token for digest, token in zip(digests, request_body["tokens"]) if digest not in results}
+        if uncached:
+            introspected = self._introspect_many(uncached, client_id)
+            introspection_cache.set_many(
+                (digest, client_id, code, data, expires_at, generations)
+                for digest, (code, data, expires_at, generations) in introspected.items()
+                if code in self.cacheable_codes
+            )
+            results.update({digest: (code, data) for digest, (code, data, _, _) in introspected.items()})
+        return self.response(
+            code=state.SUCCEED, data=[dict(code=results[digest][0], data=results[digest][1]) for digest in digests]
+        )
+
+
+class RefreshTokenView(BaseResponse):
+    """
+    refresh oauth2 token
+    """
 
     @validate_request(schema=RefreshTokenSchema)
     def post(self, request_body, *args, **kwargs):
         try:
-            client = OAuth2Client.query.filter_by(client_id=request_body["client_id"]).one_or_none()
+            client = client_registry.get(request_body["client_id"])
             if not client:
                 return self.response(code=state.GENERATION_TOKEN_ERROR)
 
             token = OAuth2Token.query.filter_by(
-                refresh_token=request_body["refresh_token"], client_id=request_body["client_id"]
+                refresh_token_digest=OAuth2Token.digest(request_body["refresh_token"]),
+                client_id=request_body["client_id"],
             ).one_or_none()
-            if not token:
+            if not token or not generation_registry.is_current(
+                token.username, token.client_id, token.user_generation, token.client_generation
+            ):
                 return self.response(code=state.TOKEN_ERROR)
             if token.is_revoked() or token.is_expired():
                 db.session.delete(token)
@@ -301,14 +452,20 @@ class RefreshTokenView(BaseResponse):
             if token_info["sub"] != token.username:
                 return self.response(code=state.TOKEN_ERROR)
 
-            self._update_token(token, client)
-            LOGGER.info("Token refreshed successfully: %s " % token_info['sub'])
-            return self.response(code=state.SUCCEED, data=dict(access_token=token.access_token))
+            # a concurrent refresh of the same token that won the race gives its access token back
+            access_token, rotated = token_rotator.rotate(token, client)
+            if not access_token:
+                return self.response(code=state.TOKEN_EXPIRE)
+            if rotated:
+                LOGGER.info("Token refreshed successfully: %s " % token_info['sub'])
+            return self.response(code=state.SUCCEED, data=dict(access_token=access_token))
         except (ExpiredSignatureError, ValueError) as error:
             return self.response(code=state.TOKEN_EXPIRE)
         except SQLAlchemyError as error:
             LOGGER.error(error)
             return self.response(code=state.DATABASE_QUERY_ERROR)
+        except RedisError:
+            return self.response(code=state.SERVER_ERROR)
 
 
 class AuthorizationStatusView(BaseResponse, OAuth2):
@@ -328,39 +485,36 @@ class AuthorizationStatusView(BaseResponse, OAuth2):
     @validate_request(schema=AuthorizationStatusSchema)
     def post(self, request_body, *args, **kwargs):
         try:
-            login_record_count = LoginRecords.query.filter_by(username=g.username).count()
-            if not login_record_count:
+            if not login_recorder.recorded(g.username):
                 return self.response(code=state.AUTH_ERROR)
             # create a new token by client id and username
             client_id = request_body["client_id"]
-            client = OAuth2Client.query.filter_by(client_id=client_id).one_or_none()
+            client = client_registry.get(client_id)
             if not client:
                 return self.response(code=state.PARAM_ERROR, message="not a valid client")
             user = User.query.filter_by(username=g.username).one_or_none()
-            login_records = LoginRecords.query.filter_by(
-                username=user.username, client_id=client.client_id
-            ).one_or_none()
-            if not login_records:
-                OAuth2Token.query.filter_by(username=user.username, client_id=client.client_id).delete()
+            if not login_recorder.recorded(user.username, client.client_id):
                 token = self._generate_token(user, client)
+                # the tokens issued to the user on the client before are revoked
+                generation_registry.supersede(user.username, client.client_id, token["client_generation"])
                 # record login
-                login_records = LoginRecords(
-                    username=user.username,
-                    client_id=client.client_id,
-                    logout_url=",".join(client.logout_callback_uris),
-                    login_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                )
-                db.session.add(login_records)
-                db.session.commit()
-                LOGGER.info(f"Login records successfully: {g.username},client_id:{client.client_id}")
+                login_recorder.save(user.username, client)
                 data = dict(access_token=token["access_token"], refresh_token=token["refresh_token"])
                 if "id_token" in token:
                     data["id_token"] = token["id_token"]
             else:
-                # query user tokens
-                user_oauth_token = OAuth2Token.query.filter_by(
-                    username=user.username, client_id=client.client_id
-                ).one_or_none()
+                # the latest token of the user on the client, unless its session generation was revoked
+                user_generation, client_generation = generation_registry.current(user.username, client.client_id)
+                user_oauth_token = (
+                    OAuth2Token.query.filter(
+                        OAuth2Token.username == user.username,
+                        OAuth2Token.client_id == client.client_id,
+                        OAuth2Token.user_generation >= user_generation,
+                        OAuth2Token.client_generation >= client_generation,
+                    )
+                    .order_by(OAuth2Token.id.desc())
+                    .first()
+                )
                 if user_oauth_token:
                     data = dict(
                         access_token=user_oauth_token.access_token, refresh_token=user_oauth_token.refresh_token
@@ -373,3 +527,46 @@ class AuthorizationStatusView(BaseResponse, OAuth2):
         except SQLAlchemyError as error:
             LOGGER.error(error)
             return self.response(code=state.DATABASE_QUERY_ERROR)
+
+
+class JwksView(BaseResponse):
+    """
+    Public keys that verify the tokens and id tokens issued to the clients
+    """
+
+    max_age = 300
+
+    def get(self):
+        try:
+            response = jsonify(key_ring.jwks())
+        except KeyRingError as error:
+            LOGGER.error(error)
+            return self.response(code=state.SERVER_ERROR)
+        response.headers["Cache-Control"] = f"public, max-age={self.max_age}"
+        return response
+
+
+class OpenidConfigurationView(BaseResponse):
+    """
+    OpenID Connect discovery document
+    """
+
+    max_age = 3600
+
+    def get(self):
+        issuer = request.host_url.rstrip("/")
+        response = jsonify(
+            issuer=issuer,
+            authorization_endpoint=issuer + "/oauth2/authorize",
+            token_endpoint=issuer + "/oauth2/token",
+            introspection_endpoint=issuer + "/oauth2/introspect",
+            revocation_endpoint=issuer + "/oauth2/revoke-token",
+            jwks_uri=issuer + "/oauth2/jwks",
+            response_types_supported=["code", "id_token", "code id_token", "code token", "code id_token token"],
+            grant_types_supported=["authorization_code", "implicit", "password", "client_credentials", "refresh_token"],
+            subject_types_supported=["public"],
+            id_token_signing_alg_values_supported=[key_ring.alg],
+            token_endpoint_auth_methods_supported=["client_secret_basic", "client_secret_post", "none"],
+        )
+        response.headers["Cache-Control"] = f"public, max-age={self.max_age}"
+        return response
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+"""
+authhub maintenance commands, e.g.
+
+    authhub-cli migrate
+    authhub-cli migrate --status --check-drift
+    authhub-cli backfill-token-digest --chunk-size 500
+    authhub-cli introspect-stats
+    authhub-cli rotate-signing-key
+    authhub-cli purge-expired --stats
+    authhub-cli webhook-worker
+    authhub-cli pool-stats
+    authhub-cli admission-stats
+"""
+import argparse
+import sys
+import time
+
+
+def backfill_token_digest(args):
+    from oauth2_provider.database.backfill import backfill_token_digest as _backfill_token_digest
+
+    filled = _backfill_token_digest(chunk_size=args.chunk_size, pause=args.pause)
+    print(f"{filled} oauth2 token rows filled")
+    return 0
+
+
+def migrate(args):
+    from oauth2_provider.database.migrations import MigrationError, MigrationRunner
+
+    runner = MigrationRunner()
+    if args.status or args.check_drift:
+        if args.status:
+            for migration, applied_at in runner.status():
+                applied = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(applied_at)) if applied_at else "pending"
+                print(f"{migration.version:04d}  {applied:<19}  {migration.description}")
+        if args.check_drift:
+            drift = runner.index_drift()
+            for table, indexes in drift.items():
+                for index in indexes["missing"]:
+                    print(f"{table}: missing index {index}")
+                for index in indexes["unexpected"]:
+                    print(f"{table}: index {index} is not defined by the models")
+            if drift:
+                return 1
+            print("no index drift")
+        return 0
+
+    try:
+        applied = runner.upgrade(target=args.target)
+    except MigrationError as error:
+        print(error, file=sys.stderr)
+        return 1
+    for migration in applied:
+        print(f"applied {migration.name}")
+    if not applied:
+        print("database schema is up to date")
+    return 0
+
+
+def introspect_stats(args):
+    from oauth2_provider.app.core.introspection import introspection_cache
+
+    for name, value in introspection_cache.stats().items():
+        print(f"{name}: {value}")
+    return 0
+
+
+def rotate_signing_key(args):
+    from oauth2_provider.app.core.keys import KeyRingError, key_ring
+
+    try:
+        kid = key_ring.rotate()
+    except (KeyRingError, OSError) as error:
+        print(error, file=sys.stderr)
+        return 1
+    print(f"new {key_ring.alg} signing key {kid}, it signs tokens after {key_ring.activation_delay} seconds")
+    return 0
+
+
+def purge_expired(args):
+    from oauth2_provider.app.core.maintenance import reaper
+
+    if not args.stats:
+        purged = reaper.run() if args.force else reaper.run_as_leader()
+        if purged is None:
+            print("skipped, another node holds the maintenance lock or ran it recently")
+        else:
+            for table, rows in purged.items():
+                print(f"{table}: {rows} rows purged")
+    else:
+        for name, value in reaper.stats().items():
+            print(f"{name}: {value}")
+    return 0
+
+
+def webhook_worker(args):
+    from oauth2_provider.app.core.webhooks import webhook_worker as _webhook_worker
+
+    if args.stats:
+        for name, value in _webhook_worker.stats().items():
+            print(f"{name}: {value}")
+        return 0
+    _webhook_worker.run()
+    return 0
+
+
+def pool_stats(args):
+    from oauth2_provider.app.core.pool import pool_monitor
+
+    snapshots = pool_monitor.stats()
+    if not snapshots:
+        print("no worker reported its connection pool")
+    for worker, snapshot in sorted(snapshots.items()):
+        print(
+            f"{worker}: {snapshot['checked_out']}/{snapshot['capacity']} in use, peak {snapshot['peak']}, "
+            f"overflow checkouts {snapshot['overflow_checkouts']}, saturation {snapshot['saturation']:.0%}"
+        )
+    return 0
+
+
+def admission_stats(args):
+    from oauth2_provider.app.core.admission import admission_controller
+
+    stats = admission_controller.stats()
+    if not stats:
+        print("no request went through admission control")
+    for name, value in stats.items():
+        print(f"{name}: {value}")
+    return 0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog="authhub-cli", description="authhub maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="apply the pending schema migrations")
+    migrate_parser.add_argument("--target", type=int, help="the last migration version to apply")
+    migrate_parser.add_argument("--status", action="store_true", help="list the migrations and exit")
+    migrate_parser.add_argument(
+        "--check-drift", action="store_true", help="compare the live indexes with the models and exit"
+    )
+    migrate_parser.set_defaults(handle=migrate)
+
+    backfill = subparsers.add_parser(
+        "backfill-token-digest", help="add and fill the oauth2_token digest columns of an existing database"
+    )
+    backfill.add_argument("--chunk-size", type=int, default=500, help="rows updated per transaction")
+    backfill.add_argument("--pause", type=float, default=0.05, help="seconds to sleep between two chunks")
+    backfill.set_defaults(handle=backfill_token_digest)
+
+    stats = subparsers.add_parser("introspect-stats", help="show the hit/miss counters of the introspection cache")
+    stats.set_defaults(handle=introspect_stats)
+
+    rotate = subparsers.add_parser("rotate-signing-key", help="add a new key to the jwt signing key ring")
+    rotate.set_defaults(handle=rotate_signing_key)
+
+    purge = subparsers.add_parser("purge-expired", help="purge the expired codes, tokens, consents and login records")
+    purge.add_argument("--force", action="store_true", help="run without taking the maintenance lock")
+    purge.add_argument("--stats", action="store_true", help="show the rows purged so far and exit")
+    purge.set_defaults(handle=purge_expired)
+
+    webhooks = subparsers.add_parser("webhook-worker", help="deliver the registration webhooks of the outbox")
+    webhooks.add_argument("--stats", action="store_true", help="show the queue depth and delivery stats and exit")
+    webhooks.set_defaults(handle=webhook_worker)
+
+    pool = subparsers.add_parser("pool-stats", help="show the database connection pool usage of every worker")
+    pool.set_defaults(handle=pool_stats)
+
+    admission = subparsers.add_parser("admission-stats", help="show the admitted and shed requests of every endpoint")
+    admission.set_defaults(handle=admission_stats)
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    from oauth2_provider.app import create_app
+
+    # the commands do not serve requests, they do not write metrics
+    with create_app({"METRICS_ENABLED": False}).app_context():
+        return args.handle(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
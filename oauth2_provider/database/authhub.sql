@@ -41,6 +41,7 @@ CREATE TABLE IF NOT EXISTS `login_records` (
   `client_id` varchar(48) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL,
   `logout_url` varchar(200) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL,
   PRIMARY KEY (`id`),
+  UNIQUE KEY `uq_login_records_username_client_id` (`username`, `client_id`),
   CONSTRAINT `login_records_ibfk_1` FOREIGN KEY (`client_id`) REFERENCES `oauth2_client` (`client_id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
 
@@ -52,6 +53,7 @@ CREATE TABLE IF NOT EXISTS `oauth2_client_scopes` (
   `grant_at` int NOT NULL,
   `expires_in` int NOT NULL,
   PRIMARY KEY (`id`),
+  KEY `ix_oauth2_client_scopes_username_client_id` (`username`, `client_id`),
   CONSTRAINT `oauth2_client_scopes_ibfk_1` FOREIGN KEY (`client_id`) REFERENCES `oauth2_client` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
 
@@ -67,7 +69,9 @@ CREATE TABLE IF NOT EXISTS `oauth2_code` (
   `auth_time` int  NOT NULL,
   `code_challenge` text CHARACTER SET utf8mb4 COLLATE utf8mb4_bin,
   `code_challenge_method` varchar(48) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `ix_oauth2_code_code_client_id` (`code`, `client_id`),
+  KEY `ix_oauth2_code_client_id_nonce` (`client_id`, `nonce`(64))
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
 
 CREATE TABLE IF NOT EXISTS `oauth2_token` (
@@ -85,12 +89,47 @@ CREATE TABLE IF NOT EXISTS `oauth2_token` (
   `access_token_revoked_at` int NOT NULL,
   `refresh_token_revoked_at` int NOT NULL,
   `expires_in` int NOT NULL,
+  `access_token_digest` char(64) CHARACTER SET ascii COLLATE ascii_bin DEFAULT NULL,
+  `refresh_token_digest` char(64) CHARACTER SET ascii COLLATE ascii_bin DEFAULT NULL,
+  `version` int NOT NULL DEFAULT 0,
+  `user_generation` int NOT NULL DEFAULT 0,
+  `client_generation` int NOT NULL DEFAULT 0,
   PRIMARY KEY (`id`),
+  UNIQUE KEY `ix_oauth2_token_access_token_digest` (`access_token_digest`),
+  UNIQUE KEY `ix_oauth2_token_refresh_token_digest` (`refresh_token_digest`),
+  KEY `ix_oauth2_token_username_client_id` (`username`, `client_id`),
   KEY `user_id` (`user_id`),
   CONSTRAINT `oauth2_token_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`id`) ON DELETE CASCADE,
   CONSTRAINT `oauth2_token_ibfk_2` FOREIGN KEY (`client_id`) REFERENCES `oauth2_client` (`client_id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
 
+CREATE TABLE IF NOT EXISTS `session_generation` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `username` varchar(36) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `client_id` varchar(48) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `generation` int NOT NULL,
+  `updated_at` int NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uq_session_generation_username_client_id` (`username`, `client_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
+
+CREATE TABLE IF NOT EXISTS `webhook_outbox` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `client_id` varchar(48) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `event` varchar(32) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `url` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `payload` text CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `status` varchar(16) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+  `attempts` int NOT NULL,
+  `next_attempt_at` int NOT NULL,
+  `created_at` int NOT NULL,
+  `delivered_at` int DEFAULT NULL,
+  `last_error` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `ix_webhook_outbox_status_next_attempt_at` (`status`, `next_attempt_at`),
+  CONSTRAINT `webhook_outbox_ibfk_1` FOREIGN KEY (`client_id`) REFERENCES `oauth2_client` (`client_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
+
 SET FOREIGN_KEY_CHECKS = 1;
 SET @username := "admin";
 SET @password := "pbkdf2:sha256:260000$LEwtriXN8UQ1UIA7$4de6cc1d67263c6579907eab7c1cba7c7e857b32e957f9ff5429592529d7d1b0";
@@ -102,4 +141,4 @@ WHERE NOT EXISTS(SELECT 1 FROM user WHERE username = @username);
 INSERT INTO manage_user (username, password)
 SELECT @manage_username, @password
 FROM DUAL
-WHERE NOT EXISTS(SELECT 1 FROM manage_user WHERE username = @username);
\ No newline at end of file
+WHERE NOT EXISTS(SELECT 1 FROM manage_user WHERE username = @username);
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+"""
+Online backfill of the oauth2_token digest columns.
+
+The digest columns are added as nullable columns, so the service keeps running on the old version while
+existing rows are filled in small chunks; the unique indexes are created once every row has its digest.
+"""
+import time
+
+from sqlalchemy import func, inspect, or_, text
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import db
+from oauth2_provider.database.table import OAuth2Token
+
+DIGEST_COLUMNS = ("access_token_digest", "refresh_token_digest")
+
+
+def _add_digest_columns():
+    columns = {column["name"] for column in inspect(db.engine).get_columns(OAuth2Token.__tablename__)}
+    missing = [column for column in DIGEST_COLUMNS if column not in columns]
+    if not missing:
+        return
+    add_columns = ", ".join(
+        f"ADD COLUMN `{column}` char(64) CHARACTER SET ascii COLLATE ascii_bin DEFAULT NULL" for column in missing
+    )
+    db.session.execute(text(f"ALTER TABLE `oauth2_token` {add_columns}, ALGORITHM=INPLACE, LOCK=NONE"))
+    LOGGER.info("add columns to oauth2_token: %s", ", ".join(missing))
+
+
+def _fill_digest(chunk_size: int, pause: float) -> int:
+    filled, last_id = 0, 0
+    while True:
+        rows = (
+            db.session.query(OAuth2Token.id, OAuth2Token.access_token, OAuth2Token.refresh_token)
+            .filter(
+                OAuth2Token.id > last_id,
+                or_(
+                    OAuth2Token.access_token_digest.is_(None),
+                    OAuth2Token.refresh_token.isnot(None) & OAuth2Token.refresh_token_digest.is_(None),
+                ),
+            )
+            .order_by(OAuth2Token.id)
+            .limit(chunk_size)
+            .all()
+        )
+        if not rows:
+            return filled
+        db.session.bulk_update_mappings(
+            OAuth2Token,
+            [
+                dict(
+                    id=row.id,
+                    access_token_digest=OAuth2Token.digest(row.access_token),
+                    refresh_token_digest=OAuth2Token.digest(row.refresh_token),
+                )
+                for row in rows
+            ],
+        )
+        db.session.commit()
+        filled += len(rows)
+        last_id = rows[-1].id
+        LOGGER.debug("token digest filled up to id %s", last_id)
+        if pause:
+            time.sleep(pause)
+
+
+def _remove_duplicate_tokens(column) -> int:
+    """
+    Identical token strings cannot be told apart, keep the newest row of each so the unique index can be built
+    """
+    removed = 0
+    duplicates = (
+        db.session.query(column, func.max(OAuth2Token.id))
+        .filter(column.isnot(None))
+        .group_by(column)
+        .having(func.count(OAuth2Token.id) > 1)
+        .all()
+    )
+    for digest, newest_id in duplicates:
+        removed += (
+            db.session.query(OAuth2Token)
+            .filter(column == digest, OAuth2Token.id != newest_id)
+            .delete(synchronize_session=False)
+        )
+    db.session.commit()
+    return removed
+
+
+def _add_unique_indexes():
+    indexes = {index["name"] for index in inspect(db.engine).get_indexes(OAuth2Token.__tablename__)}
+    for column in DIGEST_COLUMNS:
+        index_name = f"ix_oauth2_token_{column}"
+        if index_name in indexes:
+            continue
+        db.session.execute(
+            text(f"CREATE UNIQUE INDEX `{index_name}` ON `oauth2_token` (`{column}`) ALGORITHM=INPLACE LOCK=NONE")
+        )
+        LOGGER.info("create unique index %s", index_name)
+
+
+def backfill_token_digest(chunk_size: int = 500, pause: float = 0.05) -> int:
+    """
+    Add, fill and index the access/refresh token digest columns of an existing install.
+    It is safe to run repeatedly and while the service is serving requests.
+
+    Args:
+        chunk_size (int): rows updated per transaction
+        pause (float): seconds to sleep between two chunks
+
+    Returns:
+        int: number of rows filled
+    """
+    _add_digest_columns()
+    filled = _fill_digest(chunk_size, pause)
+    # rows written by an old version while filling are picked up by a second pass
+    filled += _fill_digest(chunk_size, pause)
+    removed = _remove_duplicate_tokens(OAuth2Token.access_token_digest)
+    removed += _remove_duplicate_tokens(OAuth2Token.refresh_token_digest)
+    if removed:
+        LOGGER.warning("remove %s duplicate oauth2 token rows", removed)
+    _add_unique_indexes()
+    LOGGER.info("token digest backfill finished, %s rows filled", filled)
+    return filled
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+"""
+Versioned schema migrations.
+
+Every module named ``v<version>_<name>.py`` in this package is a migration and provides a ``DESCRIPTION``
+and an ``upgrade()`` function. Migrations must be idempotent, a fresh install created from authhub.sql
+already has their changes and only records the version.
+"""
+import importlib
+import pkgutil
+import re
+import time
+from typing import Dict, List, Tuple
+
+from sqlalchemy import inspect, text
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import db
+
+VERSION_TABLE = "authhub_schema_version"
+MIGRATION_LOCK = "authhub_schema_migration"
+
+_MODULE_PATTERN = re.compile(r"^v(\d+)_\w+$")
+
+
+class MigrationError(Exception):
+    """
+    Raised when the migrations can not be applied
+    """
+
+
+class Migration:
+    def __init__(self, version: int, name: str, module):
+        self.version = version
+        self.name = name
+        self.description = getattr(module, "DESCRIPTION", name)
+        self._upgrade = module.upgrade
+
+    def upgrade(self):
+        self._upgrade()
+
+
+def load_migrations() -> List[Migration]:
+    migrations = []
+    for module_info in pkgutil.iter_modules(__path__):
+        matched = _MODULE_PATTERN.match(module_info.name)
+        if not matched:
+            continue
+        module = importlib.import_module(f"{__name__}.{module_info.name}")
+        migrations.append(Migration(int(matched.group(1)), module_info.name, module))
+    migrations.sort(key=lambda migration: migration.version)
+    return migrations
+
+
+def index_exists(table: str, index_name: str) -> bool:
+    return index_name in {index["name"] for index in inspect(db.engine).get_indexes(table)}
+
+
+def add_index(table: str, index_name: str, columns: str, unique: bool = False):
+    """
+    Create an index with online DDL, reads and writes to the table are not blocked while it is built
+
+    Args:
+        table (str): table name
+        index_name (str): index name
+        columns (str): column list of the index, e.g. "`username`, `client_id`"
+        unique (bool): create an unique index
+    """
+    if index_exists(table, index_name):
+        return
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    db.session.execute(text(f"CREATE {kind} `{index_name}` ON `{table}` ({columns}) ALGORITHM=INPLACE LOCK=NONE"))
+    LOGGER.info("create index %s on %s", index_name, table)
+
+
+def drop_index(table: str, index_name: str):
+    if not index_exists(table, index_name):
+        return
+    db.session.execute(text(f"DROP INDEX `{index_name}` ON `{table}` ALGORITHM=INPLACE LOCK=NONE"))
+    LOGGER.info("drop index %s on %s", index_name, table)
+
+
+class MigrationRunner:
+    """
+    Apply the pending migrations and compare the live indexes with the models
+    """
+
+    def __init__(self):
+        self.migrations = load_migrations()
+
+    def _ensure_version_table(self):
+        db.session.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS `{VERSION_TABLE}` ("
+                "`version` int NOT NULL, "
+                "`name` varchar(100) NOT NULL, "
+                "`applied_at` int NOT NULL, "
+                "PRIMARY KEY (`version`)"
+                ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin"
+            )
+        )
+        db.session.commit()
+
+    def applied_versions(self) -> Dict[int, int]:
+        self._ensure_version_table()
+        rows = db.session.execute(text(f"SELECT `version`, `applied_at` FROM `{VERSION_TABLE}`")).fetchall()
+        return {version: applied_at for version, applied_at in rows}
+
+    def status(self) -> List[Tuple[Migration, int]]:
+        """
+        Returns:
+            list: (migration, applied_at), applied_at is None for a pending migration
+        """
+        applied = self.applied_versions()
+        return [(migration, applied.get(migration.version)) for migration in self.migrations]
+
+    def pending(self) -> List[Migration]:
+        return [migration for migration, applied_at in self.status() if applied_at is None]
+
+    def upgrade(self, target: int = None) -> List[Migration]:
+        """
+        Apply the pending migrations up to the target version in order
+
+        Args:
+            target (int): the last version to apply, all pending migrations by default
+
+        Returns:
+            list: migrations applied
+        """
+        # DDL commits implicitly, the lock is held on its own connection for the whole run
+        lock_connection = db.engine.connect()
+        if not lock_connection.execute(text("SELECT GET_LOCK(:name, 0)"), dict(name=MIGRATION_LOCK)).scalar():
+            lock_connection.close()
+            raise MigrationError("another migration is running")
+        applied = []
+        try:
+            for migration in self.pending():
+                if target is not None and migration.version > target:
+                    break
+                LOGGER.info("apply migration %s: %s", migration.name, migration.description)
+                migration.upgrade()
+                db.session.execute(
+                    text(f"INSERT INTO `{VERSION_TABLE}` (`version`, `name`, `applied_at`) VALUES (:v, :n, :t)"),
+                    dict(v=migration.version, n=migration.name, t=int(time.time())),
+                )
+                db.session.commit()
+                applied.append(migration)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            lock_connection.execute(text("SELECT RELEASE_LOCK(:name)"), dict(name=MIGRATION_LOCK))
+            lock_connection.close()
+        return applied
+
+    def index_drift(self) -> Dict[str, Dict[str, list]]:
+        """
+        Compare the indexes of the live database with the models in database/table.py.
+        Indexes are matched by (columns, unique), the index names of old installs may differ.
+
+        Returns:
+            dict: {table: {"missing": [...], "unexpected": [...]}} for the tables that drift
+        """
+        inspector = inspect(db.engine)
+        live_tables = set(inspector.get_table_names())
+        drift = dict()
+        for table in db.metadata.sorted_tables:
+            if table.name not in live_tables:
+                drift[table.name] = dict(missing=["<table>"], unexpected=[])
+                continue
+            expected = dict()
+            for index in table.indexes:
+                expected[(tuple(column.name for column in index.columns), bool(index.unique))] = index.name
+            for constraint in table.constraints:
+                if constraint.__class__.__name__ == "UniqueConstraint":
+                    columns = tuple(column.name for column in constraint.columns)
+                    expected.setdefault((columns, True), constraint.name or columns[0])
+
+            live = dict()
+            for index in inspector.get_indexes(table.name):
+                live[(tuple(index["column_names"]), bool(index.get("unique")))] = index["name"]
+            for constraint in inspector.get_unique_constraints(table.name):
+                live.setdefault((tuple(constraint["column_names"]), True), constraint["name"])
+            # InnoDB creates an index for every foreign key that is not covered by another index
+            foreign_keys = {tuple(column.name for column in fk.columns) for fk in table.foreign_key_constraints}
+
+            missing = [name for key, name in expected.items() if key not in live]
+            unexpected = [
+                name for key, name in live.items() if key not in expected and not (key[0] in foreign_keys and not key[1])
+            ]
+            if missing or unexpected:
+                drift[table.name] = dict(missing=sorted(missing), unexpected=sorted(unexpected))
+        return drift
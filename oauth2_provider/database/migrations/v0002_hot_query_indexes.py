@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+from oauth2_provider.database.migrations import add_index
+
+DESCRIPTION = "composite indexes for the (username, client_id), (code, client_id) and (client_id, nonce) lookups"
+
+
+def upgrade():
+    # the (username, client_id) indexes also serve the username only lookups of logout
+    add_index("oauth2_token", "ix_oauth2_token_username_client_id", "`username`, `client_id`")
+    add_index("login_records", "ix_login_records_username_client_id", "`username`, `client_id`")
+    add_index("oauth2_client_scopes", "ix_oauth2_client_scopes_username_client_id", "`username`, `client_id`")
+    add_index("oauth2_code", "ix_oauth2_code_code_client_id", "`code`, `client_id`")
+    add_index("oauth2_code", "ix_oauth2_code_client_id_nonce", "`client_id`, `nonce`(64)")
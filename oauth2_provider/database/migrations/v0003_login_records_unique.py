@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+from sqlalchemy import func
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import db
+from oauth2_provider.database.migrations import add_index, drop_index
+from oauth2_provider.database.table import LoginRecords
+
+DESCRIPTION = "unique (username, client_id) key on login_records for the batched upsert of login records"
+
+
+def _remove_duplicate_records():
+    removed = 0
+    duplicates = (
+        db.session.query(LoginRecords.username, LoginRecords.client_id, func.max(LoginRecords.id))
+        .group_by(LoginRecords.username, LoginRecords.client_id)
+        .having(func.count(LoginRecords.id) > 1)
+        .all()
+    )
+    for username, client_id, newest_id in duplicates:
+        removed += (
+            db.session.query(LoginRecords)
+            .filter(
+                LoginRecords.username == username, LoginRecords.client_id == client_id, LoginRecords.id != newest_id
+            )
+            .delete(synchronize_session=False)
+        )
+        db.session.commit()
+    if removed:
+        LOGGER.info("remove %s duplicate login records", removed)
+
+
+def upgrade():
+    _remove_duplicate_records()
+    add_index("login_records", "uq_login_records_username_client_id", "`username`, `client_id`", unique=True)
+    drop_index("login_records", "ix_login_records_username_client_id")
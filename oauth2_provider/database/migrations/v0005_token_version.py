@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+from sqlalchemy import inspect, text
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import db
+
+DESCRIPTION = "oauth2_token version column of the optimistic refresh token rotation"
+
+
+def upgrade():
+    columns = {column["name"] for column in inspect(db.engine).get_columns("oauth2_token")}
+    if "version" in columns:
+        return
+    db.session.execute(
+        text("ALTER TABLE `oauth2_token` ADD COLUMN `version` int NOT NULL DEFAULT 0, ALGORITHM=INPLACE, LOCK=NONE")
+    )
+    LOGGER.info("add column version to oauth2_token")
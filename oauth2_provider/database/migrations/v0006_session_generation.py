@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+from sqlalchemy import inspect, text
+from vulcanus.log.log import LOGGER
+
+from oauth2_provider.app import db
+from oauth2_provider.database.table import SessionGeneration
+
+DESCRIPTION = "session_generation table and the oauth2_token generation columns of the bulk session revocation"
+
+GENERATION_COLUMNS = ("user_generation", "client_generation")
+
+
+def upgrade():
+    SessionGeneration.__table__.create(db.engine, checkfirst=True)
+    columns = {column["name"] for column in inspect(db.engine).get_columns("oauth2_token")}
+    missing = [column for column in GENERATION_COLUMNS if column not in columns]
+    if not missing:
+        return
+    add_columns = ", ".join(f"ADD COLUMN `{column}` int NOT NULL DEFAULT 0" for column in missing)
+    db.session.execute(text(f"ALTER TABLE `oauth2_token` {add_columns}, ALGORITHM=INPLACE, LOCK=NONE"))
+    LOGGER.info("add columns to oauth2_token: %s", ", ".join(missing))
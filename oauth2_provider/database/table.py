@@ -10,16 +10,17 @@
 # PURPOSE.
 # See the Mulan PSL v2 for more details.
 # ******************************************************************************/
+import hashlib
 import time
 
 from authlib.common.encoding import json_dumps, json_loads
 from authlib.integrations.sqla_oauth2 import OAuth2AuthorizationCodeMixin, OAuth2ClientMixin, OAuth2TokenMixin
-from sqlalchemy import Column, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, Index
+from sqlalchemy.orm import relationship, validates
 from sqlalchemy.sql.sqltypes import Integer, String, Text
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from oauth2_provider.manage import db
+from oauth2_provider.app import db
+from oauth2_provider.app.core.password import password_hasher
 
 
 class ManageUser(db.Model):
@@ -31,11 +32,11 @@ class ManageUser(db.Model):
     password = Column(String(255), nullable=False)
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return password_hasher.verify(self.password, password)
 
     @staticmethod
     def hash_password(password):
-        return generate_password_hash(password)
+        return password_hasher.hash(password)
 
 
 class User(db.Model):
@@ -52,11 +53,11 @@ class User(db.Model):
         return self.id
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return password_hasher.verify(self.password, password)
 
     @staticmethod
     def hash_password(password):
-        return generate_password_hash(password)
+        return password_hasher.hash(password)
 
 
 class OAuth2Client(db.Model, OAuth2ClientMixin):
@@ -86,8 +87,12 @@ class OAuth2Client(db.Model, OAuth2ClientMixin):
 
 class OAuth2Token(db.Model, OAuth2TokenMixin):
     __tablename__ = 'oauth2_token'
+    __table_args__ = (Index('ix_oauth2_token_username_client_id', 'username', 'client_id'),)
 
     id = Column(Integer, primary_key=True)
+    # tokens are looked up by access_token_digest/refresh_token_digest, the raw columns are not indexed
+    access_token = Column(String(4096), nullable=False)
+    refresh_token = Column(String(4096))
     user_id = Column(Integer, ForeignKey('user.id', ondelete='CASCADE'))
     username = Column(String(36), nullable=False)
     user = relationship('User')
@@ -99,6 +104,30 @@ class OAuth2Token(db.Model, OAuth2TokenMixin):
     client = relationship('OAuth2Client')
     _metadata = Column('token_metadata', Text)
     refresh_token_expires_in = Column(Integer, nullable=False, default=0)
+    access_token_digest = Column(String(64), unique=True, index=True)
+    refresh_token_digest = Column(String(64), unique=True, index=True)
+    # incremented by every rotation and revocation, a rotation only updates the version it read
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    # ugen and cgen claims of the tokens, the row is superseded once session_generation moved past them
+    user_generation = Column(Integer, nullable=False, default=0, server_default="0")
+    client_generation = Column(Integer, nullable=False, default=0, server_default="0")
+
+    @staticmethod
+    def digest(token):
+        """
+        Fixed width sha256 digest of a token, the access/refresh token columns are only looked up by it
+
+        :param token: access token or refresh token
+        :return: hex digest or None
+        """
+        if not token:
+            return None
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    @validates("access_token", "refresh_token")
+    def _update_token_digest(self, key, value):
+        setattr(self, key + "_digest", self.digest(value))
+        return value
 
     @property
     def default_scope(self):
@@ -146,13 +175,19 @@ class OAuth2Token(db.Model, OAuth2TokenMixin):
 
 class OAuth2AuthorizationCode(db.Model, OAuth2AuthorizationCodeMixin):
     __tablename__ = 'oauth2_code'
+    __table_args__ = (
+        Index('ix_oauth2_code_code_client_id', 'code', 'client_id'),
+        Index('ix_oauth2_code_client_id_nonce', 'client_id', 'nonce', mysql_length={'nonce': 64}),
+    )
 
     id = Column(Integer, primary_key=True)
+    code = Column(String(120), nullable=False)
     username = Column(String(50))
 
 
 class OAuth2ClientScopes(db.Model):
     __tablename__ = 'oauth2_client_scopes'
+    __table_args__ = (Index('ix_oauth2_client_scopes_username_client_id', 'username', 'client_id'),)
 
     id = Column(Integer, primary_key=True)
     username = Column(String(50))
@@ -171,9 +206,44 @@ class OAuth2ClientScopes(db.Model):
 
 class LoginRecords(db.Model):
     __tablename__ = 'login_records'
+    __table_args__ = (Index('uq_login_records_username_client_id', 'username', 'client_id', unique=True),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     username = Column(String(50))
     login_time = Column(String(20))
     client_id = Column(String(48), ForeignKey('oauth2_client.client_id', ondelete='CASCADE'))
     logout_url = Column(String(200))
+
+
+class SessionGeneration(db.Model):
+    """
+    Generation of the sessions of a user (client_id is empty) and of a user on one client, the tokens carry
+    the generations they were issued in and are revoked by incrementing it
+    """
+
+    __tablename__ = 'session_generation'
+    __table_args__ = (Index('uq_session_generation_username_client_id', 'username', 'client_id', unique=True),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    username = Column(String(36), nullable=False)
+    client_id = Column(String(48), nullable=False, default="")
+    generation = Column(Integer, nullable=False, default=0)
+    updated_at = Column(Integer, nullable=False, default=0)
+
+
+class WebhookOutbox(db.Model):
+    __tablename__ = 'webhook_outbox'
+    __table_args__ = (Index('ix_webhook_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    client_id = Column(String(48), ForeignKey('oauth2_client.client_id', ondelete='CASCADE'), nullable=False)
+    event = Column(String(32), nullable=False)
+    url = Column(String(255), nullable=False)
+    payload = Column(Text, nullable=False)
+    # pending, delivered or failed once max attempts are used up
+    status = Column(String(16), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(Integer, nullable=False, default=lambda: int(time.time()))
+    created_at = Column(Integer, nullable=False, default=lambda: int(time.time()))
+    delivered_at = Column(Integer)
+    last_error = Column(String(255))
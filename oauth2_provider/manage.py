@@ -10,28 +10,11 @@
 # PURPOSE.
 # See the Mulan PSL v2 for more details.
 # ******************************************************************************/
-import os
-
-from authlib.integrations.flask_oauth2 import ResourceProtector
-from werkzeug.utils import import_string
-
-from oauth2_provider.app import config_oauth, init_app, register_url
-
-
-def main(application, database):
-
-    os.environ['AUTHLIB_INSECURE_TRANSPORT'] = "SKIP-HTTPS"
-    register_url(application)
-    try:
-        authorization_server = import_string("oauth2_provider.app.core.server.AuthorizationServer")
-    except ImportError:
-        raise NotImplementedError("Authorization server not implemented")
-
-    _authorization = authorization_server()
-    _require_oauth = ResourceProtector()
-    config_oauth(application=application, database=database, authorization=_authorization, require_oauth=_require_oauth)
-    return _authorization, _require_oauth
-
-
-app, db = init_app(name="oauth2_provider")
-authorization, require_oauth = main(app, db)
+"""
+WSGI entry of the authhub service, the application is created when this module is imported. The other modules
+import db and cache from oauth2_provider.app and build an application with create_app when they need one.
+"""
+from oauth2_provider.app import create_app, db
+
+app = create_app()
+authorization, require_oauth = app.extensions["authorization"], app.extensions["require_oauth"]
@@ -13,12 +13,16 @@
 
 from oauth2_provider.app.views.account import AddUser, ChangePassword, Login, Logout, ManagerLogin
 from oauth2_provider.app.views.applications import ApplicationsDetailView, ApplicationsRegisteView, ApplicationsView
+from oauth2_provider.app.views.metrics import MetricsView
 from oauth2_provider.app.views.oauth2 import (
     AuthorizationStatusView,
+    JwksView,
+    OauthIntrospectBatchView,
     OauthIntrospectView,
     OauthorizeView,
     OauthRevokeView,
     OauthTokenView,
+    OpenidConfigurationView,
     RefreshTokenView,
 )
 
@@ -32,7 +36,10 @@ URLS = [
     (OauthTokenView, "/oauth2/token"),
     (OauthRevokeView, "/oauth2/revoke-token"),
     (OauthIntrospectView, "/oauth2/introspect"),
+    (OauthIntrospectBatchView, "/oauth2/introspect/batch"),
     (RefreshTokenView, "/oauth2/refresh-token"),
+    (JwksView, "/oauth2/jwks"),
+    (OpenidConfigurationView, "/.well-known/openid-configuration"),
     # account
     (AddUser, "/oauth2/register"),
     (ManagerLogin, "/oauth2/manager-login"),
@@ -40,4 +47,6 @@ URLS = [
     (Logout, "/oauth2/logout"),
     (ChangePassword, "/oauth2/password"),
     (AuthorizationStatusView, "/oauth2/login-status"),
+    # monitoring
+    (MetricsView, "/metrics"),
 ]
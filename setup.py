@@ -26,11 +26,16 @@ setup(
         "flask_sqlalchemy",
         "redis",
         "authlib",
+        "requests",
+        "cryptography",
     ],
     data_files=[
         ('/etc/aops/conf.d', ['authhub.yml']),
-        ('/usr/lib/systemd/system', ["authhub.service"]),
+        ('/usr/lib/systemd/system', ["authhub.service", "authhub-webhook.service"]),
         ("/opt/aops/database", ["oauth2_provider/database/authhub.sql"]),
     ],
+    entry_points={
+        'console_scripts': ['authhub-cli=oauth2_provider.cli:main'],
+    },
     zip_safe=False,
 )
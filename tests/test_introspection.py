@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# ******************************************************************************
+# Copyright (c) Huawei Technologies Co., Ltd. 2021-2024. All rights reserved.
+# licensed under the Mulan PSL v2.
+# You can use this software according to the terms and conditions of the Mulan PSL v2.
+# You may obtain a copy of Mulan PSL v2 at:
+#     http://license.coscl.org.cn/MulanPSL2
+# THIS SOFTWARE IS PROVIDED ON AN 'AS IS' BASIS, WITHOUT WARRANTIES OF ANY KIND, EITHER EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO NON-INFRINGEMENT, MERCHANTABILITY OR FIT FOR A PARTICULAR
+# PURPOSE.
+# See the Mulan PSL v2 for more details.
+# ******************************************************************************/
+"""
+Stateless introspection only reports access tokens as active, on a temporary SQLite database and fakeredis:
+
+    python3 -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import fakeredis
+from vulcanus.restful.resp import state
+
+import sqlite_compat  # noqa: F401
+from oauth2_provider.app import cache, create_app, db
+from oauth2_provider.app.core.token import jwt_token
+from oauth2_provider.app.views.oauth2 import OauthIntrospectView
+from oauth2_provider.database.table import OAuth2Client, OAuth2Token, User
+
+
+class StatelessIntrospectionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cache.bind(fakeredis.FakeRedis(decode_responses=True))
+        cls.app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": f"sqlite:///{cls.directory.name}/authhub.db",
+                "SQLALCHEMY_ENGINE_OPTIONS": {},
+                "METRICS_ENABLED": False,
+            }
+        )
+        with cls.app.app_context():
+            db.create_all()
+            user = User(username="introspect-user", password=User.hash_password("Test@2024pass"))
+            client = OAuth2Client(
+                client_id="introspect-client",
+                client_secret="introspect-secret",
+                username="admin",
+                app_name="introspect",
+            )
+            client.set_client_metadata({"client_name": "introspect", "grant_types": ["authorization_code"]})
+            db.session.add_all([user, client])
+            db.session.commit()
+            cls.token = jwt_token.generate("authorization_code", client, user, scope="openid username")
+            db.session.add(
+                OAuth2Token(
+                    client_id=client.client_id,
+                    username=user.username,
+                    user_id=user.id,
+                    token_type="Bearer",
+                    access_token=cls.token["access_token"],
+                    refresh_token=cls.token["refresh_token"],
+                    scope="openid username",
+                    issued_at=int(time.time()),
+                    expires_in=3600,
+                    _metadata=cls.token["_metadata"],
+                    user_generation=cls.token["user_generation"],
+                    client_generation=cls.token["client_generation"],
+                )
+            )
+            db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        cache.flushall()
+        patcher = mock.patch.object(OauthIntrospectView, "stateless", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = self.app.test_client()
+
+    def introspect(self, token):
+        response = self.client.post("/oauth2/introspect", json=dict(token=token, client_id="introspect-client"))
+        return response.get_json()["label"]
+
+    def introspect_batch(self, *tokens):
+        response = self.client.post(
+            "/oauth2/introspect/batch", json=dict(tokens=list(tokens), client_id="introspect-client")
+        )
+        return [result["code"] for result in response.get_json()["data"]]
+
+    def test_access_token_is_active(self):
+        self.assertEqual(self.introspect(self.token["access_token"]), state.SUCCEED)
+
+    def test_refresh_token_is_not_active(self):
+        self.assertEqual(self.introspect(self.token["refresh_token"]), state.TOKEN_ERROR)
+
+    def test_refresh_token_is_not_active_in_batch(self):
+        self.assertEqual(
+            self.introspect_batch(self.token["access_token"], self.token["refresh_token"]),
+            [state.SUCCEED, state.TOKEN_ERROR],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()